@@ -28,6 +28,9 @@ import detex.results
 import detex.streamPick
 import detex.pandas_dbms
 import detex.detect
+import detex.persist
+import detex.columnar
+import detex.partitioned
 
 # import warnings
 
@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar (directory based) storage for detection databases
+
+The detection tables (ss_df, sg_df) of a subspace database are written as
+one file per station and day (of MSTAMPmin) with the columns stored as
+typed arrays, either in numpy .npz files (default, no extra dependencies)
+or parquet files (requires pyarrow). A manifest records the time range and
+the highest DS and DS_STALTA of each partition so reads only open the
+partitions that can hold matching detections; the rows of the opened
+partitions are then filtered on time and DS (in the parquet reader when
+parquet is used). The small tables (ss_info, sg_info, filt_params and
+the histograms) are written unpartitioned. detex.results.detResults
+accepts the directory as ssDB.
+"""
+# python 2 and 3 compatibility imports
+from __future__ import print_function, absolute_import, unicode_literals
+from __future__ import with_statement, nested_scopes, generators, division
+
+import json
+import os
+from sqlite3 import connect
+
+import numpy as np
+import pandas as pd
+from six import string_types
+
+import detex
+
+FORMAT_NAME = 'detex-columnar'
+FORMAT_VERSION = 1
+MANIFEST = 'manifest.json'
+DETECTION_TABLES = ['ss_df', 'sg_df']  # partitioned by station and day
+INFO_TABLES = ['ss_info', 'sg_info', 'filt_params', 'ss_hist', 'sg_hist']
+FILE_FORMATS = {'npz': '.npz', 'parquet': '.parquet'}
+DAY = 3600 * 24
+
+
+def _importParquet():
+    """
+    Return pyarrow and pyarrow.parquet, raise if they are not installed
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        msg = 'pyarrow is required to use the parquet format, use npz'
+        detex.log(__name__, msg, level='error', e=ImportError)
+    return pyarrow, pyarrow.parquet
+
+
+def _toArrays(df):
+    """
+    Return a dict of column name: typed array of DataFrame df, object
+    columns become numeric if possible, non numeric columns unicode
+    """
+    arrays = {}
+    for col in df.columns:
+        ser = df[col]
+        if ser.dtype.kind == 'O':
+            try:
+                ser = pd.to_numeric(ser)
+            except (ValueError, TypeError):
+                pass
+        arr = np.asarray(ser.values)
+        if arr.dtype.kind not in 'biuf':
+            arr = arr.astype('U')
+        arrays[str(col)] = arr
+    return arrays
+
+
+def _writeFile(df, fileName, fileFormat):
+    """
+    Write DataFrame df to fileName in fileFormat (npz or parquet)
+    """
+    if fileFormat == 'npz':
+        arrays = _toArrays(df)
+        arrays['__columns__'] = np.array([str(x) for x in df.columns])
+        with open(fileName, 'wb') as fi:
+            np.savez(fi, **arrays)
+    else:
+        pa, pq = _importParquet()
+        arrays = _toArrays(df)
+        frame = pd.DataFrame(arrays, columns=[str(x) for x in df.columns])
+        pq.write_table(pa.Table.from_pandas(frame, preserve_index=False),
+                       fileName)
+
+
+def _readFile(fileName, fileFormat, columns=None, filters=None):
+    """
+    Read a file written by _writeFile, only columns (all if None) and the
+    rows meeting filters (list of (column, '>=' or '<=', value)) are
+    returned
+    """
+    if fileFormat == 'parquet':
+        pa, pq = _importParquet()
+        table = pq.read_table(fileName, columns=columns,
+                              filters=filters or None)
+        return table.to_pandas()
+    with np.load(fileName, allow_pickle=False) as npz:
+        allCols = [str(x) for x in npz['__columns__']]
+        cols = allCols if columns is None else columns
+        mask = None
+        for col, op, value in filters or []:  # evaluate on needed columns
+            arr = npz[col]
+            cond = arr >= value if op == '>=' else arr <= value
+            mask = cond if mask is None else mask & cond
+        data = {}
+        for col in cols:
+            arr = npz[col]
+            data[col] = arr if mask is None else arr[mask]
+    return pd.DataFrame(data, columns=cols)
+
+
+def readManifest(path):
+    """
+    Read the manifest of a columnar detection directory, raise if path is
+    not one
+    """
+    mpath = os.path.join(path, MANIFEST)
+    if not os.path.exists(mpath):
+        msg = '%s is not a detex columnar directory' % path
+        detex.log(__name__, msg, level='error', e=IOError)
+    with open(mpath) as fi:
+        manifest = json.load(fi)
+    if manifest.get('format') != FORMAT_NAME:
+        msg = '%s is not a detex columnar directory' % path
+        detex.log(__name__, msg, level='error', e=IOError)
+    if manifest.get('version', 0) > FORMAT_VERSION:
+        msg = ('%s was written with a newer version of detex (format '
+               'version %s)') % (path, manifest['version'])
+        detex.log(__name__, msg, level='error', e=IOError)
+    return manifest
+
+
+def _writeManifest(path, manifest):
+    """
+    Write the manifest of path, the old one is replaced only once the new
+    one is complete
+    """
+    tmp = os.path.join(path, MANIFEST + '.tmp')
+    with open(tmp, 'w') as fi:
+        json.dump(manifest, fi, indent=2, sort_keys=True)
+    if os.path.exists(os.path.join(path, MANIFEST)):
+        os.remove(os.path.join(path, MANIFEST))
+    os.rename(tmp, os.path.join(path, MANIFEST))
+
+
+def isColumnar(path):
+    """
+    Return True if path is a directory written by this module
+    """
+    return (isinstance(path, string_types) and os.path.isdir(path) and
+            os.path.exists(os.path.join(path, MANIFEST)))
+
+
+def _initDirectory(path, fileFormat):
+    """
+    Create the directory path (if needed) and return its manifest
+    """
+    if fileFormat not in FILE_FORMATS:
+        msg = 'fileFormat must be one of %s' % list(FILE_FORMATS.keys())
+        detex.log(__name__, msg, level='error', e=ValueError)
+    if isColumnar(path):
+        manifest = readManifest(path)
+        if manifest['fileFormat'] != fileFormat:
+            msg = '%s is written in %s format, not %s' % (
+                path, manifest['fileFormat'], fileFormat)
+            detex.log(__name__, msg, level='error', e=ValueError)
+        return manifest
+    if not os.path.exists(path):
+        os.makedirs(path)
+    manifest = {'format': FORMAT_NAME, 'version': FORMAT_VERSION,
+                'fileFormat': fileFormat, 'tables': {}, 'partitions': {}}
+    _writeManifest(path, manifest)
+    return manifest
+
+
+def writeDetections(df, path, tableName, fileFormat='npz'):
+    """
+    Add the detections in DataFrame df (columns of ss_df/sg_df) to table
+    tableName of columnar directory path (created if needed), rows falling
+    in existing partitions are merged with them
+
+    Parameters
+    ----------
+    df : pandas DataFrame
+        The detections, must have Sta, MSTAMPmin and DS columns
+    path : str
+        Path to the columnar directory
+    tableName : str
+        Name of the table (ss_df or sg_df)
+    fileFormat : str
+        npz or parquet, must match the format of path if it exists
+    """
+    manifest = _initDirectory(path, fileFormat)
+    if df is None or len(df) < 1:
+        return
+    ext = FILE_FORMATS[fileFormat]
+    parts = manifest['partitions'].setdefault(tableName, {})
+    df = df.copy()
+    df['MSTAMPmin'] = df.MSTAMPmin.astype(float)
+    days = np.floor(df.MSTAMPmin.values / DAY).astype(np.int64)
+    for (sta, day), part in df.groupby([df.Sta.values, days]):
+        dayStr = pd.to_datetime(day * DAY, unit='s').strftime('%Y-%m-%d')
+        key = '%s/%s' % (sta, dayStr)
+        fileName = os.path.join(tableName, sta, dayStr + ext)
+        fullName = os.path.join(path, fileName)
+        if key in parts:  # merge with existing partition
+            old = _readFile(fullName, fileFormat)
+            part = pd.concat([old, part[old.columns]], ignore_index=True)
+        elif not os.path.exists(os.path.dirname(fullName)):
+            os.makedirs(os.path.dirname(fullName))
+        part = part.sort_values(by='MSTAMPmin', kind='mergesort')
+        _writeFile(part, fullName, fileFormat)
+        stalta = pd.to_numeric(part.get('DS_STALTA', pd.Series([np.nan])))
+        parts[key] = {'file': fileName, 'sta': str(sta), 'rows': len(part),
+                      'tmin': float(part.MSTAMPmin.min()),
+                      'tmax': float(part.MSTAMPmin.max()),
+                      'dsmax': float(pd.to_numeric(part.DS).max()),
+                      'staltamax': float(np.nanmax(stalta.values))
+                      if stalta.notnull().any() else None}
+    _writeManifest(path, manifest)
+
+
+def writeTable(df, path, tableName, fileFormat='npz'):
+    """
+    Write (replace) the unpartitioned table tableName (for info, filter
+    and histogram tables) of columnar directory path
+    """
+    manifest = _initDirectory(path, fileFormat)
+    if df is None:
+        return
+    fileName = tableName + FILE_FORMATS[fileFormat]
+    _writeFile(df, os.path.join(path, fileName), fileFormat)
+    manifest['tables'][tableName] = fileName
+    _writeManifest(path, manifest)
+
+
+def exportDetections(ssDB, path, fileFormat='npz', chunksize=100000):
+    """
+    Write the detection, info and histogram tables of a subspace database
+    (created by SubSpace.detex) to columnar directory path
+
+    Parameters
+    ----------
+    ssDB : str
+        Path to the subspace database
+    path : str
+        Path to the columnar directory, it must not exist or be a
+        columnar directory of the same fileFormat (tables are added)
+    fileFormat : str
+        npz (numpy) or parquet (requires pyarrow)
+    chunksize : int
+        Number of detections read from ssDB at a time
+    """
+    if not os.path.exists(ssDB):
+        msg = '%s does not exist' % ssDB
+        detex.log(__name__, msg, level='error', e=IOError)
+    _initDirectory(path, fileFormat)
+    with connect(ssDB) as con:
+        for tableName in INFO_TABLES:
+            if detex.util._hasTable(con, tableName):
+                df = detex.util.loadSQLite(ssDB, tableName)
+                writeTable(df, path, tableName, fileFormat)
+        for tableName in DETECTION_TABLES:
+            if not detex.util._hasTable(con, tableName):
+                continue
+            sql = 'SELECT * FROM %s ORDER BY Sta, MSTAMPmin' % tableName
+            for chunk in pd.read_sql(sql, con, chunksize=chunksize):
+                chunk = detex.util._applySchema(chunk, tableName)
+                writeDetections(chunk, path, tableName, fileFormat)
+    return path
+
+
+def _selectPartitions(parts, stations, starttime, endtime, minDS, minSTALTA):
+    """
+    Return the partitions (manifest entries) that can hold detections
+    meeting the requirements
+    """
+    out = []
+    for key in sorted(parts.keys()):
+        part = parts[key]
+        if stations is not None and part['sta'] not in stations:
+            continue
+        if starttime is not None and part['tmax'] < starttime:
+            continue
+        if endtime is not None and part['tmin'] > endtime:
+            continue
+        if minDS is not None and part['dsmax'] < minDS:
+            continue
+        if minSTALTA is not None and (part['staltamax'] is None or
+                                      part['staltamax'] < minSTALTA):
+            continue
+        out.append(part)
+    return out
+
+
+def readDetections(path, tableName, stations=None, starttime=None,
+                   endtime=None, minDS=None, minSTALTA=None, columns=None):
+    """
+    Read the detections of tableName (ss_df or sg_df) from columnar
+    directory path
+
+    Parameters
+    ----------
+    path : str
+        Path to the columnar directory
+    tableName : str
+        Name of the table
+    stations : None or list of str
+        If not None only detections on these stations (net.sta)
+    starttime : None or float
+        If not None only detections with MSTAMPmin >= starttime
+    endtime : None or float
+        If not None only detections with MSTAMPmin <= endtime
+    minDS : None or float
+        If not None only detections with DS >= minDS
+    minSTALTA : None or float
+        If not None only detections with DS_STALTA >= minSTALTA
+    columns : None or list of str
+        The columns to read, all if None
+
+    Returns
+    -------
+    A DataFrame sorted by station and MSTAMPmin, None if the table does not
+    exist or no detections match
+    """
+    manifest = readManifest(path)
+    if tableName not in manifest['partitions']:
+        return None
+    if isinstance(stations, string_types):
+        stations = [stations]
+    filters = []
+    for col, op, value in [('MSTAMPmin', '>=', starttime),
+                           ('MSTAMPmin', '<=', endtime),
+                           ('DS', '>=', minDS),
+                           ('DS_STALTA', '>=', minSTALTA)]:
+        if value is not None:
+            filters.append((col, op, float(value)))
+    parts = _selectPartitions(manifest['partitions'][tableName], stations,
+                              starttime, endtime, minDS, minSTALTA)
+    fileFormat = manifest['fileFormat']
+    dfs = [_readFile(os.path.join(path, part['file']), fileFormat, columns,
+                     filters) for part in parts]
+    dfs = [x for x in dfs if len(x)]
+    if not dfs:
+        return None
+    return pd.concat(dfs, ignore_index=True)
+
+
+def readTable(path, tableName):
+    """
+    Read table tableName from columnar directory path, detection tables
+    are read completely. Returns None if the table does not exist
+    """
+    if tableName in DETECTION_TABLES:
+        return readDetections(path, tableName)
+    manifest = readManifest(path)
+    if tableName not in manifest['tables']:
+        return None
+    fileName = os.path.join(path, manifest['tables'][tableName])
+    return _readFile(fileName, manifest['fileFormat'])
+
+
+def getTimeRange(path, tableNames=DETECTION_TABLES):
+    """
+    Return the first and last MSTAMPmin of the detections in tableNames
+    of columnar directory path, (None, None) if there are none
+    """
+    manifest = readManifest(path)
+    parts = [part for table in tableNames for part in
+             manifest['partitions'].get(table, {}).values()]
+    if not parts:
+        return None, None
+    return (min([x['tmin'] for x in parts]), max([x['tmax'] for x in parts]))
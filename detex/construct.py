@@ -8,6 +8,11 @@ Created on Thu Oct 29 18:39:50 2015
 from __future__ import print_function, absolute_import, unicode_literals
 from __future__ import with_statement, nested_scopes, generators, division
 
+import collections
+import itertools
+import multiprocessing
+import weakref
+
 import numpy as np
 import obspy
 import pandas as pd
@@ -19,6 +24,11 @@ import detex
 
 pd.options.mode.chained_assignment = None  # mute setting copy warning
 
+try:  # python 2/3 compat
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
 
 ################ CLUSTERING FUNCTIONS AND CLASSES  ################
 
@@ -35,7 +45,8 @@ def createCluster(CCreq=0.5,
                   eventsOnAllStations=False,
                   enforceOrigin=False,
                   fillZeros=False,
-                  phases=None):
+                  phases=None,
+                  keepWaveforms=False):
     """ 
     Function to create an instance of the ClusterStream class 
     
@@ -95,6 +106,12 @@ def createCluster(CCreq=0.5,
         will be used for trim values rather than referencing the origin time
         of each event. See issue 25 on detex github page for why this
         might be useful. 
+    keepWaveforms : bool
+        If True keep the multiplexed waveforms and channels of the events 
+        in the ClusterStream so createSubSpace, updateCluster and 
+        SubSpace.addEvents don't need to load them again. This makes 
+        saved instances much larger, consider writing them with 
+        write(..., binary=True).
         
     Returns
     ---------
@@ -155,8 +172,11 @@ def createCluster(CCreq=0.5,
         cx = _flatNoNan(cxdf)
         link = linkage(cx)  # get cluster linkage
         TRDF.loc[ind, 'Link'] = link
+    spectraCache.clear()  # spectra are not needed after correlation
     # define columns to keep
     colstk = ['Station', 'Link', 'CCs', 'Lags', 'Subsamp', 'Events', 'Stats']
+    if keepWaveforms:
+        colstk += ['MPtd', 'Channels']
     trdf = TRDF[colstk]
     eventListAll = list(set.union(*[set(x) for x in TRDF.Events]))
     eventListAll.sort()
@@ -171,11 +191,205 @@ def createCluster(CCreq=0.5,
     return clust
 
 
+def updateCluster(clust='clust.pkl', templateKey='TemplateKey.csv',
+                  saveclust=True, fileName=None, keepWaveforms=None):
+    """
+    Add the events in a template key that are not yet in a ClusterStream 
+    instance (for example events added by SSResults.writeDetections). Only
+    the new events are loaded and correlated against the existing ones, 
+    the correlation and lag matrices are extended and the linkages 
+    recalculated from them. The processing parameters (filter, trim, 
+    decimation etc.) and required correlation coefficient of each station
+    are taken from clust.
+
+    Parameters
+    ----------
+    clust : str or instance of detex.subspace.ClusterStream
+        The path to a saved ClusterStream instance or the instance
+    templateKey : str or pd.DataFrame
+        Path to the template key or loaded template key in DataFrame, must 
+        contain all the events already in clust
+    saveclust : bool
+        If True save the updated instance
+    fileName : None or str
+        Path used to save the updated instance, if None use the filename
+        of clust
+    keepWaveforms : None or bool
+        If True keep the waveforms of the events in the updated instance
+        (see createCluster), if None only keep them if clust holds them
+
+    Returns
+    ---------
+    A new instance of detex.subspace.ClusterStream
+    """
+    if isinstance(clust, string_types):
+        cl = detex.util.loadClusters(clust)
+    elif isinstance(clust, detex.subspace.ClusterStream):
+        cl = clust
+    else:
+        msg = 'Invalid clust type, must be a path or ClusterStream instance.'
+        detex.log(__name__, msg, level='error', e=ValueError)
+    temkey = detex.util.readKey(templateKey, key_type='template')
+    newkey = temkey[~temkey.NAME.isin(cl.temkey.NAME)]
+    if len(newkey) < 1:
+        msg = 'No new events found in template key, nothing to update'
+        detex.log(__name__, msg, level='info', pri=True)
+        return cl
+    allkey = pd.concat([cl.temkey, newkey], ignore_index=True)
+    trdf = cl.trdf.copy()
+    if keepWaveforms is None:
+        keepWaveforms = 'MPtd' in trdf.columns
+    for col in ['MPtd', 'Channels']:  # instances without waveforms
+        if col not in trdf.columns:
+            trdf[col] = None
+    trdf = trdf.astype(object)
+    for ind, row in trdf.iterrows():
+        msg = 'adding new events to cluster analysis on ' + row.Station
+        detex.log(__name__, msg, level='info', pri=True)
+        mptd, chans, stats = _getClusterWFs(cl, row)
+        dtype = 'single' if _getDtype(mptd) == np.float32 else 'double'
+        newtd, newchans, newstats = _loadNewEvents(cl, row.Station, newkey,
+                                                   dtype)
+        oldEvents = list(row.Events)
+        wflen = len(mptd[oldEvents[0]])
+        Nc = len(chans[oldEvents[0]])
+        newEvents = []
+        for eve in sorted(newtd.keys()):
+            # new waveforms must match the length and channels of the old
+            if len(newtd[eve]) < wflen or len(newchans[eve]) != Nc:
+                msg = ('%s on %s does not match the waveforms in the cluster '
+                       'analysis, removing' % (eve, row.Station))
+                detex.log(__name__, msg, level='warn', pri=True)
+                continue
+            mptd[eve] = newtd[eve][:wflen]
+            chans[eve] = newchans[eve]
+            stats[eve] = newstats[eve]
+            newEvents.append(eve)
+        if not newEvents:
+            continue
+        events = oldEvents + newEvents
+        DFcc, DFlag, DFsubsamp = _extendDFcclags(row, events, mptd, chans)
+        trdf.CCs[ind] = DFcc
+        trdf.Lags[ind] = DFlag
+        trdf.Subsamp[ind] = DFsubsamp
+        trdf.Events[ind] = events
+        trdf.MPtd[ind] = mptd
+        trdf.Channels[ind] = chans
+        trdf.Stats[ind] = stats
+        cxdf = 1.0000001 - DFcc  # get dissimilarities
+        trdf.Link[ind] = linkage(_flatNoNan(cxdf))
+    spectraCache.clear()
+    if not keepWaveforms:
+        trdf = trdf.drop(['MPtd', 'Channels'], axis=1)
+    eventListAll = list(set.union(*[set(x) for x in trdf.Events]))
+    eventListAll.sort()
+    fileName = cl.filename if fileName is None else fileName
+    clust = detex.subspace.ClusterStream(trdf, allkey, cl.stakey, cl.fetcher,
+                                         eventListAll, cl[0].ccReq, cl.filt,
+                                         cl.decimate, cl.trim, fileName,
+                                         cl.eventsOnAllStations,
+                                         cl.enforceOrigin)
+    for num, clu in enumerate(cl.clusters):  # keep ccReq of each station
+        if clust[num].ccReq != clu.ccReq:
+            clust[num].updateReqCC(clu.ccReq)
+    if saveclust:
+        clust.write()
+    return clust
+
+
+def _getClusterWFs(cl, row):
+    """
+    Get copies of the multiplexed waveforms, channels and stats dicts of 
+    the events on a station of a ClusterStream, the waveforms are reloaded
+    for instances that did not store them
+    """
+    if isinstance(row.MPtd, dict):
+        return dict(row.MPtd), dict(row.Channels), dict(row.Stats)
+    oldkey = cl.temkey[cl.temkey.NAME.isin(row.Events)]
+    mptd, chans, stats = _loadNewEvents(cl, row.Station, oldkey, 'double')
+    missing = set(row.Events) - set(mptd.keys())
+    if missing:
+        msg = (('Could not reload %s on %s, recreate the cluster with '
+                'createCluster') % (sorted(missing), row.Station))
+        detex.log(__name__, msg, level='error')
+    wflen = min(len(mptd[x]) for x in row.Events)
+    mptd = {x: mptd[x][:wflen] for x in row.Events}
+    return mptd, chans, dict(row.Stats)
+
+
+def _getEventWFs(cl, row, events, dtype='double'):
+    """
+    Get dicts of the multiplexed waveforms and channels of events on a 
+    station (row of ClusterStream.trdf) of ClusterStream cl, the events 
+    are loaded (as dtype) if cl does not hold the waveforms. Events that 
+    can't be loaded are missing from the dicts
+    """
+    if isinstance(row.get('MPtd'), dict):
+        return ({x: row.MPtd[x] for x in events if x in row.MPtd},
+                {x: row.Channels[x] for x in events if x in row.Channels})
+    newkey = cl.temkey[cl.temkey.NAME.isin(events)]
+    mptd, chans, stats = _loadNewEvents(cl, row.Station, newkey, dtype)
+    return mptd, chans
+
+
+def _getDtype(mptd):
+    """
+    return the dtype of the waveforms in a dict of multiplexed waveforms
+    """
+    return next(iter(mptd.values())).dtype
+
+
+def _loadNewEvents(cl, station, temkey, dtype):
+    """
+    Load and multiplex the events in temkey on station using the 
+    processing parameters of ClusterStream cl. Returns dicts of multiplexed
+    waveforms, channels and stats keyed by event name
+    """
+    sts, eves, chans, stats = _loadStream(cl.fetcher, cl.filt, cl.trim,
+                                          cl.decimate, station, dtype, temkey,
+                                          cl.stakey, cl.enforceOrigin,
+                                          minEvents=1)
+    if sts is None:
+        return {}, {}, {}
+    mptd = {eve: multiplex(sts[eve], stats[eve]['Nc']) for eve in eves}
+    return mptd, chans, stats
+
+
+def _extendDFcclags(row, events, mptd, chans):
+    """
+    Extend the correlation, lag and subsample matrices of a station (row 
+    of ClusterStream.trdf) to events, only the pairs that include an event
+    not in row.Events are correlated
+    """
+    cols = np.arange(1, len(events))
+    indicies = np.arange(0, len(events) - 1)
+    DFcc = pd.DataFrame(columns=cols, index=indicies)
+    DFlag = pd.DataFrame(columns=cols, index=indicies)
+    DFsubsamp = pd.DataFrame(columns=cols, index=indicies)
+    numOld = 0  # number of events with correlations already calculated
+    if isinstance(row.CCs, pd.DataFrame) and len(row.CCs) > 0:
+        numOld = len(row.Events)
+        for old, new in [(row.CCs, DFcc), (row.Lags, DFlag),
+                         (row.Subsamp, DFsubsamp)]:
+            new.loc[old.index, old.columns] = old.values
+    spectra = LazySpectra(mptd)
+    for b in DFcc.index.values:
+        for c in range(max(b + 1, numOld), len(events)):
+            eve1, eve2 = events[b], events[c]
+            maxcc, sampleLag, subsamp = _CCX2(spectra[eve1], spectra[eve2],
+                                              mptd[eve1], mptd[eve2],
+                                              chans[eve1], chans[eve2])
+            DFcc.loc[b, c] = maxcc
+            DFlag.loc[b, c] = sampleLag
+            DFsubsamp.loc[b, c] = subsamp
+    return DFcc, DFlag, DFsubsamp
+
+
 ######################### SUBSPACE FUNCTIONS AND CLASSES #####################
 
 
 def createSubSpace(Pf=10 ** -12, clust='clust.pkl', minEvents=2, dtype='double',
-                   conDatFetcher=None):
+                   conDatFetcher=None, processes=1):
     """
     Function to create subspaces on all available stations based on the 
     clusters in Clustering object which will either be passed directly as the 
@@ -213,6 +427,9 @@ def createSubSpace(Pf=10 ** -12, clust='clust.pkl', minEvents=2, dtype='double',
         3. (instance of detex.getdata.DataFetcher) If an instance of 
         detex.getdata.DataFetcher is passed then it will be used as the
         continuous data fetcher.
+    processes : int or None
+        The number of processes used to build the subspaces, each station
+        is handled by one process. If None use all cores.
         
     Returns
     -----------
@@ -222,11 +439,13 @@ def createSubSpace(Pf=10 ** -12, clust='clust.pkl', minEvents=2, dtype='double',
     ----------
     Most of the parameters that define how to fetch seismic data, which events
     and stations to use in the analysis, filter parameters, etc. are already 
-    defined in the cluster (ClusterStream) instance.     
+    defined in the cluster (ClusterStream) instance. The waveforms stored 
+    in the cluster instance are used if it holds them (and dtype matches),
+    else they are loaded again.
     """
     # Read in cluster instance
     if isinstance(clust, string_types):  # if no cluster object passed read a pickled one
-        cl = detex.subspace.loadClusters(clust)
+        cl = detex.util.loadClusters(clust)
     elif isinstance(clust, detex.subspace.ClusterStream):
         cl = clust
     else:
@@ -247,8 +466,10 @@ def createSubSpace(Pf=10 ** -12, clust='clust.pkl', minEvents=2, dtype='double',
             cfetcher = efetcher
 
     # Load events into main dataframe to create subspaces
-    TRDF = _loadEvents(efetcher, cl.filt, cl.trim, stakey, temkey, cl.decimate,
-                       dtype)
+    TRDF = _getClusterTRDF(cl, dtype)
+    if TRDF is None:
+        TRDF = _loadEvents(efetcher, cl.filt, cl.trim, stakey, temkey,
+                           cl.decimate, dtype)
     for ind, row in TRDF.iterrows():  # Fill in cluster info from cluster object
         TRDF.loc[ind, 'Link'] = cl[row.Station].link
         TRDF.loc[ind, 'Clust'] = cl[row.Station].clusts
@@ -256,43 +477,27 @@ def createSubSpace(Pf=10 ** -12, clust='clust.pkl', minEvents=2, dtype='double',
         # Start subspace construction
     msg = 'Starting Subspace Construction'
     detex.log(__name__, msg, pri=True)
+    temInfo = _getTemInfo(temkey)
+    tasks = [(row, _getClustRow(cl, row.Station), temInfo, minEvents)
+             for num, row in TRDF.iterrows()]
+    if processes is None or processes > 1:  # each station in a process
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_makeStationSubSpaces, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_makeStationSubSpaces(x) for x in tasks]
     ssDict = {}  # dict to store subspaces in
-    for num, row in TRDF.iterrows():  # Loop through each station
-        staSS = _makeSSDF(row, minEvents)
-        if len(staSS) < 1:  # if no clusters form on current station
+    for (row, crow, _, _), staOut in zip(tasks, results):
+        if staOut is None:  # if no clusters form on current station
             msg = 'No events grouped into subspaces on %s' % row.Station
             detex.log(__name__, msg, level='warning', pri=True)
             continue
-        for sind, srow in staSS.iterrows():  # loop each cluster
-            eventList = srow.Events
-
-            # get correlation values from cl object
-            DFcc, DFlag = _getInfoFromClust(cl, srow)
-            staSS['Lags'][sind] = DFlag
-            staSS['CCs'][sind] = DFcc
-            cxdf = 1.0000001 - DFcc
-            cx = _flatNoNan(cxdf)
-            cx, cxdf = _ensureUnique(cx, cxdf)  # ensure cc value is unique
-            lags = _flatNoNan(DFlag)
-            link = linkage(cx)  # get cluster linkage
-            staSS.loc[sind, 'Link'] = link
-            # get lag times and align waveforms
-            CCtoLag = _makeCC2LagMap(cx, lags)  # a map from cc to lag times
-            delays, dflink = _getDelays(link, CCtoLag, cx, lags, cxdf)
-            delayNP = -1 * np.min(delays)
-            delayDF = pd.DataFrame(delays + delayNP, columns=['SampleDelays'])
-            delayDF['Events'] = [eventList[x] for x in delayDF.index]
-            staSS['AlignedTD'][sind] = _alignTD(delayDF, srow)
-            ustimes = _updateStartTimes(srow, delayDF, temkey)
-            staSS['Stats'][sind] = ustimes  # update Start Times
-            offsets = _getOffsetList(sind, srow, staSS)
-            offsetAr = [np.min(offsets), np.median(offsets), np.max(offsets)]
-            staSS['Offsets'][sind] = offsetAr
-        # Put output into subspaceDict
-        staOut = staSS.drop(['MPfd', 'MPtd', 'Link', 'Lags', 'CCs'], axis=1)
         ssDict[row.Station] = staOut
     # make a list of sngles to pass to subspace class
-    singDic = _makeSingleEventDict(cl, TRDF, temkey)
+    singDic = _makeSingleEventDict(cl, TRDF, temInfo)
 
     substream = detex.subspace.SubSpace(singDic, ssDict, cl, dtype, Pf,
                                         cfetcher)
@@ -301,13 +506,105 @@ def createSubSpace(Pf=10 ** -12, clust='clust.pkl', minEvents=2, dtype='double',
     return substream
 
 
-def _getInfoFromClust(cl, srow):
+def _makeStationSubSpaces(task):
     """
-    get the DFcc dataframe and lags dataframe from values already stored in
-    cluster object to avoid recalculating them
+    Create the subspaces of one station (align and update the start times
+    of the events in each cluster). task is a tuple of the station row of 
+    TRDF, the station row of the cluster trdf (see _getClustRow), the 
+    template key info dict and minEvents. Returns the subspace DataFrame 
+    or None if no subspaces form
+    """
+    row, crow, temInfo, minEvents = task
+    staSS = _makeSSDF(row, minEvents)
+    if len(staSS) < 1:
+        return None
+    for sind, srow in staSS.iterrows():  # loop each cluster
+        eventList = srow.Events
+
+        # get correlation values from cl object
+        DFcc, DFlag = _getInfoFromClust(crow, srow)
+        staSS['Lags'][sind] = DFlag
+        staSS['CCs'][sind] = DFcc
+        cxdf = 1.0000001 - DFcc
+        cx = _flatNoNan(cxdf)
+        lags = _flatNoNan(DFlag)
+        link = linkage(cx)  # get cluster linkage
+        staSS.loc[sind, 'Link'] = link
+        # get lag times and align waveforms
+        delays = _getDelays(link, cx, lags)
+        delayNP = -1 * np.min(delays)
+        delayDF = pd.DataFrame(delays + delayNP, columns=['SampleDelays'])
+        delayDF['Events'] = [eventList[x] for x in delayDF.index]
+        staSS['AlignedTD'][sind] = _alignTD(delayDF, srow)
+        ustimes = _updateStartTimes(srow, delayDF, temInfo)
+        staSS['Stats'][sind] = ustimes  # update Start Times
+        offsets = _getOffsetList(sind, srow, staSS)
+        offsetAr = [np.min(offsets), np.median(offsets), np.max(offsets)]
+        staSS['Offsets'][sind] = offsetAr
+    # Put output into subspaceDict
+    return staSS.drop(['MPfd', 'MPtd', 'Link', 'Lags', 'CCs'], axis=1)
+
+
+def _getClusterTRDF(cl, dtype):
+    """
+    Make the TRDF used to create subspaces from the waveforms stored in 
+    ClusterStream cl. Returns None if cl does not hold waveforms or they
+    are not of dtype
+    """
+    npdtype = np.float32 if dtype == 'single' else np.float64
+    if 'MPtd' not in cl.trdf.columns:
+        return None
+    if not all(isinstance(x, dict) and x and _getDtype(x) == npdtype
+               for x in cl.trdf.MPtd):
+        return None
+    columns = ['Events', 'MPtd', 'MPfd', 'Channels', 'Stats', 'Link', 'Clust',
+               'Lags', 'Subsamp', 'CCs', 'numEvents']
+    TRDF = pd.DataFrame(index=cl.trdf.index, columns=columns)
+    TRDF['Station'] = cl.trdf.Station
+    TRDF['Keep'] = True
+    TRDF = TRDF.astype(object)
+    for ind, row in cl.trdf.iterrows():
+        TRDF['Events'][ind] = list(row.Events)
+        TRDF['MPtd'][ind] = dict(row.MPtd)
+        TRDF['MPfd'][ind] = LazySpectra(TRDF['MPtd'][ind])
+        TRDF['Channels'][ind] = row.Channels
+        # copy stats, they are updated in subspace creation
+        TRDF['Stats'][ind] = {key: dict(val) if isinstance(val, dict) else val
+                              for key, val in row.Stats.items()}
+        TRDF['numEvents'][ind] = len(row.Events)
+    TRDF.sort_values(by='Station', inplace=True)
+    TRDF.reset_index(inplace=True, drop=True)
+    return TRDF
+
+
+def _getClustRow(cl, sta):
+    """
+    get the events, correlation and lag DataFrames of station sta from 
+    the trdf of ClusterStream cl
     """
-    sta = srow.Station
     cll = cl.trdf[cl.trdf.Station == sta].iloc[0]
+    return cll[['Events', 'CCs', 'Lags']]
+
+
+def _getTemInfo(temkey):
+    """
+    Make a dict of event name: (origin time stamp, magnitude) from the 
+    template key, the time stamps are calculated if temkey was not read 
+    with readKey
+    """
+    if 'STAMP' in temkey.columns:
+        stamps = temkey.STAMP
+    else:
+        stamps = detex.util._getTimeStamps(temkey.TIME)
+    return dict(zip(temkey.NAME, zip(stamps, temkey.MAG)))
+
+
+def _getInfoFromClust(cll, srow):
+    """
+    get the DFcc dataframe and lags dataframe from values already stored in
+    cluster object to avoid recalculating them, cll is the row of the 
+    cluster trdf for the station
+    """
     odi = _makeEventListKey(srow.Events, cll.Events)
     inds = odi[:-1]
     cols = odi[1:]
@@ -324,16 +621,8 @@ def _makeEventListKey(evelist1, evelist2):
     """
     Make index key to make evelist1 to evelist2 
     """
-    odi = [_fastWhere(x, evelist2) for num, x in enumerate(evelist1)]
-    return odi
-
-
-def _fastWhere(eve, objs):
-    """
-    like np.where but a bit faster because data checks are skipped
-    """
-    an = next(nu for nu, obj in enumerate(objs) if eve == obj)
-    return an
+    index = {eve: num for num, eve in enumerate(evelist2)}
+    return [index[x] for x in evelist1]
 
 
 def _getOffsetList(sind, srow, staSS):
@@ -343,25 +632,25 @@ def _getOffsetList(sind, srow, staSS):
     return [staSS.loc[sind, 'Stats'][x]['offset'] for x in srow.Stats.keys()]
 
 
-def _updateStartTimes(srow, delayDF, temkey):
+def _updateStartTimes(srow, delayDF, temInfo):
     """
-    Update the starttimes to reflect the values trimed in alignement
+    Update the starttimes to reflect the values trimed in alignement, 
+    temInfo is the dict made by _getTemInfo
     """
     statsdict = srow.Stats
     sdo = srow.Stats
+    delays = dict(zip(delayDF.Events, delayDF.SampleDelays))
     for key in sdo.keys():
-        temtemkey = temkey.loc[temkey.NAME == key].iloc[0]
-        delaysamps = delayDF[delayDF.Events == key].iloc[0].SampleDelays
+        otime, mag = temInfo[key]  # origin time stamp and magnitude
+        delaysamps = delays[key]
         Nc = sdo[key]['Nc']
         sr = sdo[key]['sampling_rate']
         stime = sdo[key]['starttime']
 
         stime_new = stime + delaysamps / (sr * Nc)  # updated starttime to trim
         statsdict[key]['starttime'] = stime_new
-        otime = obspy.UTCDateTime(temtemkey.TIME).timestamp  # starttime
-        statsdict[key]['starttime'] = stime + delaysamps / (sr * Nc)
         statsdict[key]['origintime'] = otime
-        statsdict[key]['magnitude'] = temtemkey.MAG
+        statsdict[key]['magnitude'] = mag
         statsdict[key]['offset'] = stime_new - otime  # predict offset time
     return statsdict
 
@@ -486,7 +775,7 @@ def fast_normcorr(t, s):
 def _alignTD(delayDF, srow):
     """
     loop through delay Df and apply offsets to create alligned 
-    arrays dictionary
+    arrays, returned as a detex.subspace.ArrayDict keyed by event
     """
     aligned = {}
     # find the required length for each aligned stream
@@ -501,7 +790,7 @@ def _alignTD(delayDF, srow):
                    try raising ccreq or widenning trim window' % srow.Station)
             msg2 = _idAlignProblems(delayDF)
             detex.log(__name__, msg + msg2, level='error')
-    return aligned
+    return detex.subspace.ArrayDict.fromDict(aligned)
 
 
 def _idAlignProblems(delayDF, m=7):
@@ -522,39 +811,40 @@ def _idAlignProblems(delayDF, m=7):
     return msg
 
 
-def _makeSingleEventDict(cl, TRDF, temkey):
+def _makeSingleEventDict(cl, TRDF, temInfo):
     """
-    Make dict of dataframes for singles on each station
+    Make dict of dataframes for singles on each station, temInfo is the 
+    dict made by _getTemInfo
     """
     singlesdict = {}
     cols = [x for x in TRDF.columns if not x in ['Clust', 'Link', 'Lags', 'CCs']]
     for num, row in TRDF.iterrows():
         singleslist = [0] * len(cl[row.Station].singles)  # init list
-        DF = pd.DataFrame(index=xrange(len(singleslist)), columns=cols)
+        DF = pd.DataFrame(index=range(len(singleslist)), columns=cols)
         if len(singleslist) < 1:  # if no singles on this channel
-            break
+            continue
         DF['Name'] = str
         DF['Offsets'] = list
         for sn, sing in enumerate(singleslist):
             # DF.Events[a[0]]=evlist\
             evelist = [cl[row.Station].singles[sn]]
-            temtemkey = temkey.loc[temkey.NAME == evelist[0]].iloc[0]
+            otime, mag = temInfo[evelist[0]]
             DF["Station"][sn] = row.Station
             DF["MPtd"][sn] = _trimDict(row, 'MPtd', evelist)
-            DF["MPfd"][sn] = _trimDict(row, 'MPfd', evelist)
+            DF["MPfd"][sn] = LazySpectra(DF["MPtd"][sn])
             DF["Stats"][sn] = _trimDict(row, 'Stats', evelist)
             DF["Channels"][sn] = _trimDict(row, 'Channels', evelist)
-            otime = obspy.UTCDateTime(temtemkey.TIME).timestamp
             stime = DF.Stats[sn][evelist[0]]['starttime']
             DF.Stats[sn][evelist[0]]['origintime'] = otime
 
             DF.Stats[sn][evelist[0]]['offset'] = stime - otime
-            DF.Stats[sn][evelist[0]]['magnitude'] = temtemkey.MAG
+            DF.Stats[sn][evelist[0]]['magnitude'] = mag
             DF.Events[sn] = DF.MPtd[sn].keys()
             DF.Name[sn] = 'SG%d' % sn
         DF['SampleTrims'] = [{} for x in range(len(DF))]
         DF['FAS'] = object
         DF['Threshold'] = object
+        DF['STALTAThreshold'] = np.nan
         singlesdict[row.Station] = DF
     return singlesdict
 
@@ -576,6 +866,7 @@ def _makeSSDF(row, minEvents):
     DF['SVDdefined'] = False
     DF['SampleTrims'] = [{} for x in range(len(DF))]
     DF['Threshold'] = np.float
+    DF['STALTAThreshold'] = np.nan
     DF['SigDimRep'] = object
     DF['FAS'] = object
     DF['NumBasis'] = int
@@ -592,7 +883,7 @@ def _makeSSDF(row, minEvents):
         DF['Events'][ind] = evelist
         DF['numEvents'][ind] = len(evelist)
         DF['MPtd'][ind] = _trimDict(row, 'MPtd', evelist)
-        DF['MPfd'][ind] = _trimDict(row, 'MPfd', evelist)
+        DF['MPfd'][ind] = LazySpectra(DF['MPtd'][ind])
         DF['Stats'][ind] = _trimDict(row, 'Stats', evelist)
         DF['Channels'][ind] = _trimDict(row, 'Channels', evelist)
     # only keep subspaces that meet min req, dont renumber
@@ -667,15 +958,112 @@ def _getTimeDomainWFs(TRDF, row, ind, sts, eves):
 
 
 def _getFreqDomain(TRDF, row, ind):
-    for key in row.Events:  # loop each event
-        mp = TRDF.loc[ind, 'MPtd'][key]
-        reqlen = 2 * len(mp)  # required length
-        reqlenbits = 2 ** reqlen.bit_length()  # required length fd
-        mpfd = scipy.fftpack.fft(mp, n=reqlenbits)
-        TRDF.loc[ind, 'MPfd'][key] = mpfd
+    """
+    Attach the (lazily computed) freq. domain reps of the multiplexed 
+    time domain arrays
+    """
+    TRDF['MPfd'][ind] = LazySpectra(TRDF['MPtd'][ind])
     return TRDF
 
 
+def _getSpectrum(mp):
+    """
+    Return the freq. domain rep. of the multiplexed array mp at the length
+    required for correlation (2 ** (2 * len(mp)).bit_length())
+    """
+    reqlen = 2 * len(mp)  # required length
+    reqlenbits = 2 ** reqlen.bit_length()  # required length fd
+    return scipy.fftpack.fft(mp, n=reqlenbits)
+
+
+class _SpectraCache(object):
+    """
+    Least recently used cache of spectra, the oldest spectra are dropped 
+    when the total size exceeds maxBytes
+    """
+
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.nbytes = 0
+        self._cache = collections.OrderedDict()
+
+    def get(self, key, func):
+        """
+        Return the array stored under key, if not stored call func to 
+        calculate it and store it
+        """
+        try:
+            value = self._cache.pop(key)
+        except KeyError:
+            value = func()
+            self.nbytes += value.nbytes
+        self._cache[key] = value  # most recently used go at the end
+        while self.nbytes > self.maxBytes and len(self._cache) > 1:
+            _, old = self._cache.popitem(last=False)
+            self.nbytes -= old.nbytes
+        return value
+
+    def clear(self):
+        self._cache.clear()
+        self.nbytes = 0
+
+
+# spectra shared by all LazySpectra, set spectraCache.maxBytes to change the
+# memory used by spectra during clustering
+spectraCache = _SpectraCache(maxBytes=1024 ** 3)
+_spectraTokens = itertools.count()
+_spectraVersions = itertools.count()
+
+
+class LazySpectra(Mapping):
+    """
+    Read-only mapping of event name to the freq. domain rep. of the
+    multiplexed time domain arrays in mptd (dict keyed by event). Spectra
+    are calculated on first use and kept in spectraCache, which is limited
+    to spectraCache.maxBytes, so they are recalculated if dropped. Arrays
+    replaced in mptd get a new version so their spectra are recalculated.
+    Only the reference to mptd is pickled.
+    """
+
+    def __init__(self, mptd):
+        self.mptd = mptd
+        self._token = next(_spectraTokens)
+        self._versions = {}  # key: (weak ref to array, version)
+
+    def _getVersion(self, key, mp):
+        """
+        Return the version of the array mp stored under key, a new version
+        is issued whenever the array stored under key is replaced
+        """
+        ref, version = self._versions.get(key, (None, None))
+        if ref is None or ref() is not mp:
+            version = next(_spectraVersions)
+            self._versions[key] = (weakref.ref(mp), version)
+        return version
+
+    def __getitem__(self, key):
+        mp = self.mptd[key]
+        ckey = (self._token, key, self._getVersion(key, mp))
+        return spectraCache.get(ckey, lambda: _getSpectrum(mp))
+
+    def __iter__(self):
+        return iter(self.mptd)
+
+    def __len__(self):
+        return len(self.mptd)
+
+    def __contains__(self, key):
+        return key in self.mptd
+
+    def __getstate__(self):
+        return {'mptd': self.mptd}
+
+    def __setstate__(self, state):
+        self.mptd = state['mptd']
+        self._token = next(_spectraTokens)
+        self._versions = {}
+
+
 def _testStreamLengths(TRDF, row, ind):
     lens = np.array([len(x) for x in row.MPtd.values()])
     # trim to smallest length if within 90% of median, else kill key
@@ -707,152 +1095,58 @@ def _flatNoNan(df):
     return ar[~np.isnan(ar)]
 
 
-def _getDelays(link, CCtoLag, cx, lags, cxdf):
-    N = len(link)  # Lumber of events
-    # append cluster numbers to link array
-    linkup = np.append(link, np.arange(N + 1, 2 * N + 1).reshape(N, 1), 1)
-    clustDict = _getClustDict(linkup, len(linkup))
-    cols = ['i1', 'i2', 'cc', 'num', 'clust']
-    dflink = pd.DataFrame(linkup, columns=cols).astype(object)
-    if len(dflink) > 0:
-        dflink['II'] = list
-    dflink['ev1'] = 0
-    dflink['ev2'] = 0
-    dflink = dflink.astype(object, copy=False)
-    for ind, row in dflink.iterrows():
-        ii1 = clustDict[int(row.i1)].tolist()
-        ii2 = clustDict[int(row.i2)].tolist()
-        dflink.loc[ind, 'II'] = ii1 + ii2
-        # get a dataframe with only index as ev1 and column as ev2
-        tempdf = cxdf[cxdf == row.cc].dropna(how='all').dropna(axis=1)
-        dflink.loc[ind, 'ev1'] = tempdf.index[0]
-        dflink.loc[ind, 'ev2'] = tempdf.columns[0]
-    lags = _traceEventDendro(dflink, cx, lags, CCtoLag, clustDict,
-                             clustDict.iloc[-1])
-    return lags, dflink
-    # return clusts,lagByClust
-
-
-def _traceEventDendro(dflink, x, lags, CCtoLag, clustDict, clus):
-    """
-    Function to follow ind1 through clustering linkage in linkup 
-    and return total offset time (used for alignment)
-    """
-    if len(dflink) < 1:  # if event is singleton return zero offset time
-        lagSeries = pd.Series([0], index=clus)
-    else:
-        allevents = dflink['II'][dflink.index.values.max()]
-        allevents.sort()
-        # total lags for each station
-        lagSeries = pd.Series([0] * (len(dflink) + 1), index=allevents)
-        for a in dflink.iterrows():
-            if a[1].ev1 in clustDict[int(a[1].i1)]:
-                cl22 = clustDict[int(a[1].i2)]
-            else:
-                cl22 = clustDict[int(a[1].i1)]
-            # reference cc to lag samps map, round and cast to sample int
-            currentLag = int(np.round(CCtoLag[a[1].cc]))
-
-            for b in cl22:  # record and update lags for second cluster
-                lagSeries[b] += currentLag
-                lags = _updateLags(b, lags, len(dflink), currentLag)
-            CCtoLag = _makeCC2LagMap(x, lags)
-    return lagSeries
-
-
-def _updateLags(evenum, lags, N, currentLag):
+def _getDelays(link, cx, lags):
     """
-    function to add current lag shifts to effected 
-    lag times (see Haris 2006 appendix B)
-    """
-    dow = _getDow(N, evenum)  # get the index to add to lags for columns
-    acr = _getAcr(N, evenum)
-    for a in acr:
-        lags[a] += currentLag
-    for a in dow:
-        lags[a] -= currentLag
-    return lags
-
-
-def _getDow(N, evenum):
-    dow = [0] * evenum
-    if len(dow) > 0:
-        for a in range(len(dow)):
-            dow[a] = _triangular(N - 1) - 1 + evenum - _triangular(N - 1 - a)
-    return dow
-
-
-def _getAcr(N, evenum):
-    acr = [0] * (N - evenum)
-    if len(acr) > 0:
-        acr[0] = _triangular(N) - _triangular(N - (evenum))
-        for a in range(1, len(acr)):
-            acr[a] = acr[a - 1] + 1
-    return acr
-
-
-def _triangular(n):
-    """
-    calculate sum of triangle with base N, 
-    see http://en.wikipedia.org/wiki/Triangular_number
-    """
-    return sum(range(n + 1))
-
-
-def _getClustDict(linkup, N):
-    """
-    get pd series that will define the base events in each cluster 
-    (including intermediate clusters)
-    """
-    inds = np.arange(0, N + 1)
-    content = [np.array([x]) for x in np.arange(0, N + 1)]
-    clusdict = pd.Series(content, index=inds)
-    for a in range(len(linkup)):
-        ind1 = int(linkup[a, 4])
-        ind2 = int(linkup[a, 0])
-        ind3 = int(linkup[a, 1])
-        clusdict[ind1] = np.append(clusdict[ind2], clusdict[ind3])
-    return clusdict
+    Get the sample delay of each event that aligns the events of a cluster
+    by following the merges of the (single) linkage. When two clusters 
+    merge the event pair that set the merge distance is found by index and
+    the cluster holding the later event of the pair is shifted by the lag
+    of the pair, accounting for the shifts already applied (see Harris 
+    2006 appendix B). Each event pair is examined at most once so this is 
+    O(N^2) and deterministic (ties go to the lowest event indices).
 
+    Parameters
+    ----------
+    link : np.array
+        The linkage array (scipy.cluster.hierarchy.linkage of cx)
+    cx : np.array
+        The condensed dissimilarity (1 - cc) array of the events
+    lags : np.array
+        The condensed array of sample lags of each event pair
 
-def _ensureUnique(cx, cxdf):
-    """
-    Make sure each coeficient is unique so it can be used as a key to 
-    reference time lags, if not unique perturb slightly
+    Returns
+    --------
+    A numpy array of the sample delays of each event
     """
-    se = pd.Series(cx)
-    dups = se[se.duplicated()]
-    count = 0
-    while len(dups) > 0:
-        msg = ('Duplicates found in correlation coefficients,'
-               'perturbing slightly to get unique values')
-        detex.log(__name__, msg, level='warning', pri=True)
-        for a in dups.iteritems():
-            se[a[0]] = a[1] - abs(.00001 * np.random.rand())
-        count += 1
-        dups = se[se.duplicated()]
-        if count > 10:
-            msg = 'cannot make Coeficients unique, killing program'
-            detex.log(__name__, msg, level='error')
-    if count > 1:  # if the cx has been perturbed update cxdf
-        for a in range(len(cxdf)):
-            sindex = sum(pd.isnull(a[1]))
-            tri1 = _triangular(len(cxdf))
-            tri2 = _triangular(len(cxdf) - a)
-            tri3 = _triangular(len(cxdf) - (a + 1))
-            cxdf.values[a, sindex:] = cx[tri1 - tri2, tri1 - tri3]
-    return se.values, cxdf
-
-
-def _makeCC2LagMap(x, lags):
-    LS = pd.Series(lags, index=x)
-    return LS
+    num = len(link) + 1  # number of events
+    dist = np.zeros((num, num))
+    lag = np.zeros((num, num))
+    upper = np.triu_indices(num, 1)
+    dist[upper] = cx
+    dist += dist.T
+    lag[upper] = lags
+    shifts = np.zeros(num, dtype=np.int64)
+    members = {x: [x] for x in range(num)}  # events in each cluster
+    for clnum, (i1, i2) in enumerate(link[:, :2].astype(int)):
+        clust1, clust2 = members.pop(i1), members.pop(i2)
+        block = dist[np.ix_(clust1, clust2)]
+        rows, cols = np.nonzero(block == block.min())
+        pairs = [tuple(sorted([clust1[x], clust2[y]]))
+                 for x, y in zip(rows, cols)]
+        ev1, ev2 = min(pairs)
+        # lag of the pair after the shifts already applied
+        currentLag = int(np.round(lag[ev1, ev2] + shifts[ev1] - shifts[ev2]))
+        moved = clust1 if ev2 in clust1 else clust2
+        shifts[moved] += currentLag
+        members[num + clnum] = clust1 + clust2
+    return shifts
 
 
 def _loadStream(fetcher, filt, trim, decimate, station, dtype,
-                temkey, stakey, enforceOrigin=False, phases=None):
+                temkey, stakey, enforceOrigin=False, phases=None, minEvents=2):
     """
-    loads all traces into stream object and applies filters and trims
+    loads all traces into stream object and applies filters and trims, 
+    returns Nones if less than minEvents events survive
     """
     StreamDict = {}  # Initialize dictionary for stream objects
     channelDict = {}
@@ -860,7 +1154,7 @@ def _loadStream(fetcher, filt, trim, decimate, station, dtype,
     STlens = {}
     trLen = []  # trace length
     allzeros = []  # empty list to stuff all zero keys to remove later
-    csta = stakey[stakey.STATION == station.split('.')[1]]
+    csta = stakey.getStation(station)
 
     # load waveforms
     for st, evename in fetcher.getTemData(temkey, csta, trim[0], trim[1],
@@ -869,12 +1163,12 @@ def _loadStream(fetcher, filt, trim, decimate, station, dtype,
         st = _applyFilter(st, filt, decimate, dtype)
         if st is None or len(st) < 1:
             continue  # skip if stream empty
-        tem = temkey[temkey.NAME == evename]
+        tem = temkey.getRows('NAME', evename)
         if len(tem) < 1:  # in theory this should never happen
             msg = '%s not in template key, skipping'
             detex.log(__name__, msg, pri=True)
             continue
-        originTime = obspy.UTCDateTime(tem.iloc[0].TIME)
+        originTime = obspy.UTCDateTime(tem.iloc[0].STAMP)
         Nc = len(set([x.stats.channel for x in st]))  # get number of channels
         if Nc != len(st) or len(st) == 0:
             msg = ('%s on %s is fractured or channels are missing, consider '
@@ -914,13 +1208,13 @@ def _loadStream(fetcher, filt, trim, decimate, station, dtype,
         channelDict.pop(key, None)
         stats.pop(key, None)
 
-    if len(StreamDict.keys()) < 2:
-        msg = ('Less than 2 events survived preprocessing for station'
-               '%s Check input parameters, especially trim' % station)
+    if len(StreamDict.keys()) < minEvents:
+        msg = ('Less than %d events survived preprocessing for station'
+               '%s Check input parameters, especially trim' % (minEvents,
+                                                               station))
         detex.log(__name__, msg, level='warning', pri=True)
         return None, None, None, None
-    evlist = StreamDict.keys()
-    evlist.sort()
+    evlist = sorted(StreamDict.keys())
     # if 'IMU' in station:
     return StreamDict, evlist, channelDict, stats
 
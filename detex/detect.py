@@ -24,7 +24,7 @@ class _SSDetex(object):
     Private class to run subspace detections or event classifications
     """
 
-    def __init__(self, TRDF, utcStart, utcEnd, cfetcher, clusters, subspaceDB,
+    def __init__(self, TRDF, utcStart, utcEnd, cfetcher, clusters, store,
                  trigCon, triggerLTATime, triggerSTATime, multiprocess,
                  calcHist, dtype, estimateMags, classifyEvents, eventCorFile,
                  utcSaves, fillZeros, issubspace=True):
@@ -46,7 +46,7 @@ class _SSDetex(object):
         self.stakey = clusters.stakey
         self.classifyEvents = classifyEvents
         self.trigCon = trigCon
-        self.subspaceDB = subspaceDB
+        self.store = store  # detex.util.DetectionStore of subspaceDB
 
         # set DataFetcher and read classifyEvents key, get data length
         if classifyEvents is not None:
@@ -114,12 +114,14 @@ class _SSDetex(object):
         """
         # get station key for current station
         skey = self.stakey
-        stakey = skey[skey.STATION == sta.split('.')[1]]
+        stakey = skey.getStation(sta)
 
         # get chans, sampling rates, and trims
         channels = _getChannels(DFsta)
         samplingRates = _getSampleRates(DFsta)
-        threshold = {x.Name: x.Threshold for num, x in DFsta.iterrows()}
+        # trigCon 1 triggers on the sta/lta of the DS so use its thresholds
+        thcol = 'Threshold' if self.trigCon == 0 else 'STALTAThreshold'
+        threshold = {x.Name: x[thcol] for num, x in DFsta.iterrows()}
         names = DFsta.Name.values
         names.sort()
 
@@ -142,7 +144,6 @@ class _SSDetex(object):
         # init various parameters
         numdets = 0  # counter for number of detections
         tableName = 'ss_df' if self.issubspace else 'sg_df'
-        DF = pd.DataFrame()  # DF for results, dumped to SQL database
         histdic = {na: [0.0] * (len(self.hist['Bins']) - 1) for na in names}
         nc = len(channels)
 
@@ -202,17 +203,13 @@ class _SSDetex(object):
                                 ' values above 1') % (utc1, st[0].stats.station))
                         detex.log(__name__, msg, level='warn', pri=True)
                         Sar = Sar[Sar.DS <= 1.05]
-                    if len(Sar) > 0:
-                        DF = DF.append(Sar, ignore_index=True)
-                    if len(DF) > 500:
-                        detex.util.saveSQLite(DF, self.subspaceDB, tableName)
-                        DF = pd.DataFrame()
-                        numdets += 500
-        if len(DF) > 0:
-            detex.util.saveSQLite(DF, self.subspaceDB, tableName)
+                    # buffered by the store, written in batches
+                    self.store.write(Sar, tableName)
+                    numdets += len(Sar)
+        self.store.flush(tableName)
         detType = 'Subspaces' if self.issubspace else 'Singletons'
         msg = (('%s on %s completed, %d potential detection(s) recorded') %
-               (detType, sta, len(DF) + numdets))
+               (detType, sta, numdets))
         detex.log(__name__, msg, pri=1)
         if self.calcHist:
             return histdic
@@ -281,7 +278,7 @@ class _SSDetex(object):
                 CorDF.MaxDS[ind] = ssd.max()
             if not self.fillZeros:  # dont calculate sta/lta if zerofill used
                 try:
-                    CorDF.STALTA[ind] = self._getStaLtaArray(
+                    CorDF.STALTA[ind] = _getStaLtaArray(
                         CorDF.SSdetect[ind],
                         self.triggerLTATime * CorDF.SampRate[0],
                         self.triggerSTATime * CorDF.SampRate[0])
@@ -340,19 +337,18 @@ class _SSDetex(object):
         dataLength = self.dataLength
 
         # get values and preform calcs
+        _stackRows = detex.subspace._stackRows
         for ind, row in DFsta.iterrows():
             events = row.Events
             if self.issubspace:
-                U = np.array([row.SVD[x] for x in row.UsedSVDKeys])
+                U = _stackRows(row.SVD, row.UsedSVDKeys)
                 dlen = np.shape(U)[1]
                 if 'Starttime' in row.SampleTrims.keys():
                     start = row.SampleTrims['Starttime']
                     end = row.SampleTrims['Endtime']
-                    WFl = [row.AlignedTD[x][start:end] for x in events]
-                    WFs = np.array(WFl)
+                    WFs = _stackRows(row.AlignedTD, events, start, end)
                 else:
-                    WFl = [row.AlignedTD[x] for x in events]
-                    WFs = np.array(WFl)
+                    WFs = _stackRows(row.AlignedTD, events)
             else:  # if single trim and normalize (already done for subspaces)
                 mptd = row.MPtd.values()[0]
                 if row.SampleTrims:  # if this is a non empty dict
@@ -498,31 +494,6 @@ class _SSDetex(object):
                 stdMags = mags[0] + np.log10(np.std(ConDat) / np.std(WFU[0]))
         return projectedEnergyMags, stdMags, SNR
 
-    def _getStaLtaArray(self, C, LTA, STA):
-        """
-        Function to calculate the sta/lta of the detection statistic 
-        """
-        if STA == 0:
-            STA = 1
-            STArray = np.abs(C)
-        else:
-            STArray = pd.rolling_mean(np.abs(C), STA, center=True)
-            STArray = self._replaceNanWithMean(STArray)
-        LTArray = pd.rolling_mean(np.abs(C), LTA, center=True)
-        LTArray = self._replaceNanWithMean(LTArray)
-        out = np.divide(STArray, LTArray)
-        return out
-
-    def _replaceNanWithMean(self, arg):
-        """
-        Function to replace any NaN values in sta/lta array with mean
-        """
-        ind = np.where(~np.isnan(arg))[0]
-        first, last = ind[0], ind[-1]
-        arg[:first] = arg[first + 1]
-        arg[last + 1:] = arg[last]
-        return arg
-
     def _evalTrigCon(self, Corrow, name, threshold, returnValue=False):
         """ 
         Evaluate if Trigger condition is met and return True or False.
@@ -534,7 +505,7 @@ class _SSDetex(object):
             if trig > threshold[name]:
                 Out = True
         elif self.trigCon == 1:
-            trig = Corrow.maxSTALTA
+            trig = Corrow.MaxSTALTA
             if trig > threshold[name]:
                 Out = True
         if returnValue:
@@ -634,6 +605,45 @@ def _getSampleRates(df):
     return list(srs)
 
 
+def _rollingMean(ar, win):
+    """
+    Centered moving average of ar computed from a cumulative sum (one pass, 
+    no pandas window objects). The edges, where a full window is not 
+    avaliable, take the value of the nearest complete window so the output
+    is the same length as ar
+    """
+    ar = np.asarray(ar, dtype=np.float64)
+    win = int(win)
+    if win <= 1:
+        return ar.copy()
+    if win >= len(ar):  # window longer than array, use global mean
+        return np.ones(len(ar)) * ar.mean()
+    csum = np.concatenate(([0.0], np.cumsum(ar)))
+    means = (csum[win:] - csum[:-win]) / win
+    lead = win // 2
+    trail = len(ar) - len(means) - lead
+    return np.concatenate((np.repeat(means[0], lead), means,
+                           np.repeat(means[-1], trail)))
+
+
+def _getStaLtaArray(C, LTA, STA):
+    """
+    Function to calculate the sta/lta of the detection statistic. LTA and 
+    STA are the window lengths in samples, if STA < 1 one sample is used. 
+    Samples where the lta is 0 get a sta/lta of 0.
+    """
+    absC = np.abs(C)
+    if STA < 1:
+        STArray = absC.astype(np.float64)
+    else:
+        STArray = _rollingMean(absC, STA)
+    LTArray = _rollingMean(absC, LTA)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        out = np.divide(STArray, LTArray)
+    out[~np.isfinite(out)] = 0.0
+    return out
+
+
 def _estPEMag(mags, proEn, eventCors, touse):
     """
     Function to estimate projected energy magnitude for subspaces. Squared 
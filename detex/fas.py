@@ -6,115 +6,408 @@ Created on Thu Oct 29 21:26:48 2015
 fas = false alarm stats
 """
 
-from itertools import chain  # from_iterable
+import json
+import multiprocessing
+import os
+import shutil
 
 import numpy as np
 import obspy
 import pandas as pd
 import scipy
+import scipy.optimize
+import scipy.special
 from obspy.signal.trigger import classic_sta_lta
 from scipy.fftpack import fft
+from six import string_types
 
 import detex
 
 
 ############## Subspace Detex and FAS #######################
 
-def _initFAS(TRDF, conDatNum, cluster, fetcher, LTATime=5,
+# state of each FAS worker (set by _initWorker), holds the fetcher, the
+# detectors on each station and the processing parameters
+_workerState = {}
+
+FINE_BINS = 2 ** 15  # bins of the histogram used to fit the beta dist.
+LOG_EPS = 1e-12  # DS values are clipped to [LOG_EPS, 1-LOG_EPS] for logs
+
+
+def _initFAS(detectors, conDatNum, cluster, fetcher, LTATime=5,
              STATime=0.5, numBins=401, dtype='double', staltalimit=7.5,
-             issubspace=True, utcstart=None, utcend=None):
+             utcstart=None, utcend=None, triggerLTATime=5, triggerSTATime=0,
+             processes=1, sampleCache=None):
     """ Function to randomly scan through continuous data and fit statistical 
     distributions in order to get a DS threshold for each subspace/station 
-    pair"""
+    pair. The sta/lta of the DS (using triggerLTATime and triggerSTATime) is 
+    also characterized so thresholds for trigCon=1 can be set.
 
-    results = [{}] * len(TRDF)
-    histBins = np.linspace(-.01, 1, num=numBins)  # create bins for histograms
-    conLen = fetcher.conDatDuration + fetcher.conBuff  # con. data length (secs)
-    TRDF.reset_index(drop=True, inplace=True)
-    # Loop through each station on the subspace or singles data frame
-    for ind, row in TRDF.iterrows():
-        results[ind] = {'bins': histBins}
-        # Load subspace (used left singular vectors or singles)
-        if issubspace:
-            ssArrayTD, ssArrayFD, reqlen, Nc = _loadMPSubSpace(row, conLen)
-        else:
-            ssArrayTD, ssArrayFD, reqlen, Nc = _loadMPSingles(row, conLen)
-        sta = row.Station.split('.')[1]
-        stakey = cluster.stakey[cluster.stakey.STATION == sta]
+    detectors is a dict of {station: list of (key, row, issubspace)} where 
+    row is a row of a subspace or singles DataFrame and key any hashable
+    used to identify it. Each random hour of continuous data is only fetched 
+    and filtered once and correlated with all the detectors on its station. 
+    Samples (of all stations) are processed in parallel if processes > 1 
+    (None uses all cores). If sampleCache is a path the accepted samples 
+    of each station are written there (one file per sample) as they are 
+    processed and reused by later calls until the data source, filter, 
+    decimation or sampling parameters change.
 
+    Only summary statistics and histograms of the detection statistic (DS)
+    are kept for each sample so memory use does not depend on conDatNum.
+
+    Returns a dict of {key: FAS results dict}"""
+    conLen = fetcher.conDatDuration + fetcher.conBuff  # con. data length (secs)
+    histBins = np.linspace(-.01, 1, num=numBins)  # create bins for histograms
+    stations = {}
+    for sta, rows in detectors.items():
+        dets = [_getDetector(key, row, conLen, issub)
+                for key, row, issub in rows]
+        stakey = cluster.stakey.getStation(sta)
         if utcstart is None:
-            utc1 = obspy.UTCDateTime(stakey.iloc[0].STARTTIME)
+            utc1 = obspy.UTCDateTime(stakey.iloc[0].STARTSTAMP)
         else:
             utc1 = obspy.UTCDateTime(utcstart)
         if utcend is None:
-            utc2 = obspy.UTCDateTime(stakey.iloc[0].ENDTIME)
+            utc2 = obspy.UTCDateTime(stakey.iloc[0].ENDSTAMP)
         else:
             utc2 = obspy.UTCDateTime(utcend)
-        # get processing params from cluster instance
-        filt = cluster.filt
-        deci = cluster.decimate
-        dsvec, count, scount = _getDSVect(fetcher, stakey, utc1, utc2,
-                                          filt, deci, dtype, conDatNum, Nc,
-                                          reqlen, STATime, LTATime,
-                                          ssArrayTD, ssArrayFD, staltalimit)
-        if count != conDatNum:
+        stations[sta] = {'stakey': stakey.iloc[0], 'detectors': dets,
+                         'Nc': dets[0]['Nc'], 'utc1': utc1, 'utc2': utc2}
+    params = {'filt': cluster.filt, 'deci': cluster.decimate, 'dtype': dtype,
+              'STATime': STATime, 'LTATime': LTATime, 'histBins': histBins,
+              'triggerSTATime': triggerSTATime,
+              'triggerLTATime': triggerLTATime}
+    for sta, info in stations.items():
+        info['cacheKey'] = _getSampleCacheKey(info, params, fetcher,
+                                              staltalimit)
+    dsstats = _sampleStations(stations, fetcher, params, conDatNum,
+                              staltalimit, processes, sampleCache)
+
+    results = {}
+    for sta, info in stations.items():
+        for det in info['detectors']:
+            stats = dsstats[det['key']]
+            if stats is None:
+                msg = 'No continuous data samples for %s on %s' % (
+                    det['key'], sta)
+                detex.log(__name__, msg, level='error')
+            res = {'bins': histBins, 'hist': stats['hist']}
+            betaparams = _fitBeta(stats)
+            res['betadist'] = betaparams
+            # calculate negative log likelihood for a "goodness of fit" measure
+            res['nnlf'] = _betaNNLF(betaparams, stats)
+            # characterize sta/lta of the DS for the trigCon=1 thresholds
+            res['staltadist'] = _fitSTALTA(stats)
+            res['staltawindows'] = (triggerSTATime, triggerLTATime)
+            results[det['key']] = res
+    return results
+
+
+def _sampleStations(stations, fetcher, params, conDatNum, staltalimit,
+                    processes, cacheDir=None):
+    """
+    Collect DS vectors from conDatNum random continuous data chunks (that 
+    pass the sta/lta requirement) for every detector on every station. 
+    Candidate chunks of all stations are processed in rounds, each round 
+    only asks for as many chunks as each station still needs. If cacheDir
+    is not None the accepted chunks (filtered, screened and multiplexed)
+    of each station are written there by the process that fetched them 
+    and reused by later calls with the same processing parameters. 
+    Returns a dict of {detector key: DS statistics (see _getDSStats) 
+    summed over all samples}
+    """
+    dsstats = {}
+    state = {}
+    for sta, info in stations.items():
+        for det in info['detectors']:
+            dsstats[det['key']] = None
+        cache = None
+        if cacheDir is not None:
+            cache = _readSampleCache(cacheDir, sta, info['cacheKey'])
+            if cache is None:  # remove samples of other parameters
+                _clearSampleCache(cacheDir, sta)
+        if cache is None:
+            cache = {'starts': [], 'files': []}
+        state[sta] = {'count': 0, 'scount': 0, 'limit': staltalimit,
+                      'starts': cache['starts'], 'files': cache['files'],
+                      'changed': False, 'cached': cache['files'][::-1],
+                      'cands': _getCandidates(fetcher, info, conDatNum,
+                                              exclude=cache['starts'])}
+    workerStations = {sta: {'stakey': info['stakey'], 'Nc': info['Nc'],
+                            'detectors': info['detectors'],
+                            'cacheDir': cacheDir}
+                      for sta, info in stations.items()}
+    pool = None
+    if processes is None or processes > 1:
+        pool = multiprocessing.Pool(processes, initializer=_initWorker,
+                                    initargs=(fetcher, workerStations, params))
+        mapper = pool.imap
+    else:
+        _initWorker(fetcher, workerStations, params)
+        mapper = lambda func, tasks: (func(x) for x in tasks)
+    try:
+        while True:
+            tasks = []
+            for sta in sorted(state):
+                sst = state[sta]
+                # if the sta/lta req is failing too often drop it
+                if not sst['cands'] and sst['scount'] < conDatNum:
+                    _dropSTALTA(sta, sst, fetcher, stations[sta], conDatNum,
+                                dsstats, cacheDir)
+                need = conDatNum - sst['scount']
+                while need > 0 and sst['cached']:  # cached samples first
+                    tasks.append((sta, sst['cached'].pop(), sst['limit']))
+                    need -= 1
+                while need > 0 and sst['cands']:
+                    tasks.append((sta, sst['cands'].pop(), sst['limit']))
+                    need -= 1
+            if not tasks:
+                break
+            keep = cacheDir is not None
+            # results are combined as they arrive so only the statistics of
+            # a few samples are held at a time
+            results = mapper(_processSample, [x + (keep,) for x in tasks])
+            for (sta, source, _), (dsdict, counted, fileName) in zip(tasks,
+                                                                     results):
+                sst = state[sta]
+                sst['count'] += counted
+                if dsdict is None or sst['scount'] >= conDatNum:
+                    if fileName is not None:  # sample not used
+                        os.remove(os.path.join(cacheDir, sta, fileName))
+                    continue
+                sst['scount'] += 1
+                if fileName is not None:
+                    sst['starts'].append(source.timestamp)
+                    sst['files'].append(fileName)
+                    sst['changed'] = True
+                for key, stats in dsdict.items():
+                    dsstats[key] = _addDSStats(dsstats[key], stats)
+            # record the samples written this round
+            for sta, sst in state.items():
+                if sst['changed']:
+                    _writeSampleCache(cacheDir, sta,
+                                      stations[sta]['cacheKey'],
+                                      sst['starts'], sst['files'])
+                    sst['changed'] = False
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        _workerState.clear()
+    for sta, sst in state.items():
+        if sst['count'] == 0:
+            msg = 'Could not get any data for %s' % sta
+            detex.log(__name__, msg, level='error')
+        if sst['scount'] != conDatNum:
             msg = '%d samps not avaliable, using all avaliable' % (conDatNum)
             detex.log(__name__, msg, level='warn')
-        sratio = float(scount) / count  # success ratio
-        if sratio <= .25:  # if failing sta/lta req
-            msg = ('sta lta req of %d failing on station %s, dropping sta/lta'
-                   ' requirement') % (staltalimit, stakey.STATION.iloc[0])
-            detex.log(__name__, msg, level='warn', pri=True)
-            dsvec, count, scount = _getDSVect(fetcher, stakey, utcstart,
-                                              utcend, filt, deci, dtype,
-                                              conDatNum, Nc, reqlen, STATime,
-                                              LTATime, ssArrayTD, ssArrayFD)
-        # flatten DS Vector
-        if dtype == 'double':
-            dss = np.fromiter(chain.from_iterable(dsvec), dtype=np.float64)
-        elif dtype == 'single':
-            dss = np.fromiter(chain.from_iterable(dsvec), dtype=np.float32)
-            # Bin up and clean up
-        results[ind]['bins'] = histBins
-        results[ind]['hist'] = np.histogram(dss, bins=histBins)[0]
-        # results[a[0]]['normdist']=scipy.stats.norm.fit(CCs)
-        betaparams = scipy.stats.beta.fit(dss, floc=0, fscale=1)
-        results[ind]['betadist'] = betaparams
-        # calculate negative log likelihood for a "goodness of fit" measure
-        results[ind]['nnlf'] = scipy.stats.beta.nnlf(betaparams, dss)
-        # results[a[0]]['histRev']=histRev+np.histogram(CCsrev,bins=histBins)[0]
-    return results
+    return dsstats
 
 
-def _getDSVect(fetcher, stakey, utc1, utc2, filt, deci, dtype,
-               conDatNum, Nc, reqlen, sta, lta, ssArrayTD, ssArrayFD,
-               limit=None, ):
-    # get a generator to return streams, ask for 4x more for rejects
-    stgen = fetcher.getConData(stakey, utcstart=utc1, utcend=utc2,
-                               randSamps=conDatNum * 4)
-    count = 0  # normal count
-    scount = 0  # success count
-    DSmat = []
-    for st in stgen:  # loop over random samps of continuous data
-        if st is None or len(st) < 1:
-            continue  # no need to log, fetcher will do it
-        count += 1
-        st = detex.construct._applyFilter(st, filt, deci, dtype)
-        if st is None or len(st) < 1:
-            continue  # no need to log, fetcher will do it
-        passSTALTA = _checkSTALTA(st, filt, sta, lta, limit)
-        if not passSTALTA:
-            continue
-        if scount >= conDatNum:  # if we have all we need
-            break
-        mpCon = detex.construct.multiplex(st, Nc)
-        dsVect = _MPXSSCorr(mpCon, reqlen, ssArrayTD, ssArrayFD, Nc)
-        DSmat.append(dsVect)
-        scount += 1
-    if count == 0:
-        msg = 'Could not get any data for %s' % (stakey.STATION.iloc[0])
-        detex.log(__name__, msg, level='error')
-    return DSmat, count, scount
+def _dropSTALTA(sta, sst, fetcher, info, conDatNum, dsstats, cacheDir=None):
+    """
+    If the candidates of a station are exhausted and more than 75% of the 
+    chunks failed the sta/lta requirement start over without it (any 
+    cached samples of the station are discarded). Returns True if the 
+    station was reset
+    """
+    if sst['limit'] is None or sst['count'] == 0:
+        return False
+    sratio = float(sst['scount']) / sst['count']  # success ratio
+    if sratio > .25:
+        return False
+    msg = ('sta lta req of %d failing on station %s, dropping sta/lta'
+           ' requirement') % (sst['limit'], sta)
+    detex.log(__name__, msg, level='warn', pri=True)
+    sst.update({'count': 0, 'scount': 0, 'limit': None, 'starts': [],
+                'files': [], 'changed': False, 'cached': [],
+                'cands': _getCandidates(fetcher, info, conDatNum)})
+    if cacheDir is not None:
+        _clearSampleCache(cacheDir, sta)
+    for det in info['detectors']:
+        dsstats[det['key']] = None
+    return True
+
+
+def _getCandidates(fetcher, info, conDatNum, exclude=[]):
+    """
+    get a list of random start times for continuous data chunks, ask for
+    4x more than needed for rejects. Start times (timestamps) in exclude 
+    are skipped
+    """
+    utcs = detex.getdata._divideIntoChunks(info['utc1'], info['utc2'],
+                                           fetcher.conDatDuration,
+                                           conDatNum * 4)
+    exclude = set(exclude)
+    utcs = [x for x in utcs if x.timestamp not in exclude]
+    return utcs[::-1]  # reversed so pop takes them in order
+
+
+def _getSampleCacheKey(info, params, fetcher, staltalimit):
+    """
+    Get the parameters that define the null space samples of a station,
+    if any of them change the cached samples are not used
+    """
+    key = {'filt': params['filt'], 'decimate': params['deci'],
+           'dtype': params['dtype'], 'STATime': params['STATime'],
+           'LTATime': params['LTATime'], 'staltalimit': staltalimit,
+           'conDatDuration': fetcher.conDatDuration,
+           'conBuff': fetcher.conBuff, 'channels': info['stakey'].CHANNELS,
+           'Nc': info['Nc'], 'utc1': info['utc1'].timestamp,
+           'utc2': info['utc2'].timestamp,
+           'source': _getDataSource(fetcher)}
+    # round trip through json so the key compares equal to a stored one
+    return json.loads(json.dumps(key, default=str))
+
+
+def _getDataSource(fetcher):
+    """
+    Describe where (and how) the continuous data of fetcher come from, the
+    fetcher method, directory or client and response removal
+    """
+    if fetcher.method == 'dir':
+        where = os.path.abspath(fetcher.directory)
+    else:
+        client = fetcher.client
+        where = getattr(client, 'base_url', None) or '%s.%s' % (
+            type(client).__module__, type(client).__name__)
+    return {'method': fetcher.method, 'where': where,
+            'removeResponse': fetcher.removeResponse,
+            'opType': fetcher.opType, 'prefilt': fetcher.prefilt}
+
+
+def _readSampleCache(cacheDir, sta, cacheKey):
+    """
+    Read the index of the null space samples of station sta in cacheDir, 
+    returns a dict with the start times and file names of the samples or 
+    None if they don't exist or were created with different parameters
+    """
+    path = os.path.join(cacheDir, sta)
+    try:
+        with open(os.path.join(path, 'samples.json')) as fi:
+            meta = json.load(fi)
+    except (IOError, OSError, ValueError):
+        return None
+    if meta.get('key') != cacheKey:
+        msg = ('processing parameters of %s changed, cached null space '
+               'samples will be replaced') % sta
+        detex.log(__name__, msg, level='info')
+        return None
+    return {'starts': meta['starts'], 'files': meta['files']}
+
+
+def _clearSampleCache(cacheDir, sta):
+    """
+    Remove the null space samples of station sta from cacheDir
+    """
+    path = os.path.join(cacheDir, sta)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+
+
+def _saveSample(cacheDir, sta, start, mpCon):
+    """
+    Write the multiplexed data of the sample starting at start (a 
+    UTCDateTime) to the cache of station sta, returns the file name
+    """
+    fileName = start.strftime('%Y%m%dT%H%M%S.%f') + '.npy'
+    fpath = os.path.join(cacheDir, sta, fileName)
+    # write to a temp file then move in place so a failed write is harmless
+    with open(fpath + '.tmp', 'wb') as fi:
+        np.save(fi, mpCon)
+    if os.path.exists(fpath):
+        os.remove(fpath)
+    os.rename(fpath + '.tmp', fpath)
+    return fileName
+
+
+def _loadSample(cacheDir, sta, fileName):
+    """
+    Load the multiplexed data of a cached sample
+    """
+    return np.load(os.path.join(cacheDir, sta, fileName))
+
+
+def _writeSampleCache(cacheDir, sta, cacheKey, starts, files):
+    """
+    Write the index of the null space samples of station sta (the cache 
+    key, start times and file names of the samples written by _saveSample)
+    """
+    fpath = os.path.join(cacheDir, sta, 'samples.json')
+    with open(fpath + '.tmp', 'w') as fi:
+        json.dump({'key': cacheKey, 'starts': starts, 'files': files}, fi)
+    if os.path.exists(fpath):
+        os.remove(fpath)
+    os.rename(fpath + '.tmp', fpath)
+
+
+def _initWorker(fetcher, stations, params):
+    """
+    Set the state used by _processSample (called once in each process)
+    """
+    _workerState.clear()
+    _workerState.update({'fetcher': fetcher, 'stations': stations,
+                         'params': params, 'fd': {}})
+
+
+def _processSample(task):
+    """
+    Get one multiplexed chunk of continuous data and correlate it with all 
+    detectors on its station. source is either the start time of a chunk 
+    to fetch, filter, screen (sta/lta) and multiplex or the file name of a 
+    cached sample. Returns a dict of {detector key: DS statistics} (None if
+    the chunk was not usable), 1 if data were found else 0, and the file 
+    name the chunk was written to if keep and the chunk was fetched, else 
+    None
+    """
+    sta, source, limit, keep = task
+    info = _workerState['stations'][sta]
+    fileName = None
+    if isinstance(source, string_types):  # sample is cached
+        mpCon = _loadSample(info['cacheDir'], sta, source)
+    else:
+        mpCon, counted = _fetchSample(info, source, limit)
+        if mpCon is None:
+            return None, counted, None
+        if keep:
+            fileName = _saveSample(info['cacheDir'], sta, source, mpCon)
+    out = {}
+    for det in info['detectors']:
+        if det['key'] not in _workerState['fd']:  # fd calculated once
+            _workerState['fd'][det['key']] = _getDetectorFD(det)
+        ssArrayFD = _workerState['fd'][det['key']]
+        ds = _MPXSSCorr(mpCon, det['reqlen'], det['td'], ssArrayFD,
+                        info['Nc'])
+        out[det['key']] = _getDSStats(ds, det['sr'], _workerState['params'])
+    return out, 1, fileName
+
+
+def _fetchSample(info, utc, limit):
+    """
+    Fetch, filter, screen (sta/lta) and multiplex one chunk of continuous 
+    data. Returns the multiplexed data (None if not usable) and 1 if data 
+    were found else 0
+    """
+    fetcher = _workerState['fetcher']
+    params = _workerState['params']
+    ser = info['stakey']
+    start = obspy.UTCDateTime(utc)
+    end = start + fetcher.conDatDuration + fetcher.conBuff
+    chans = ser.CHANNELS.split('-')
+    st = fetcher.getStream(start, end, ser.NETWORK, ser.STATION, chans, '*')
+    if st is None or len(st) < 1:
+        return None, 0  # no need to log, fetcher will do it
+    st = detex.construct._applyFilter(st, params['filt'], params['deci'],
+                                      params['dtype'])
+    if st is None or len(st) < 1:
+        return None, 1
+    passSTALTA = _checkSTALTA(st, params['filt'], params['STATime'],
+                              params['LTATime'], limit)
+    if not passSTALTA:
+        return None, 1
+    return detex.construct.multiplex(st, info['Nc']), 1
 
 
 def _MPXSSCorr(MPcon, reqlen, ssArrayTD, ssArrayFD, Nc):
@@ -134,42 +427,191 @@ def _MPXSSCorr(MPcon, reqlen, ssArrayTD, ssArrayFD, Nc):
     return result1[::Nc]
 
 
+def _getDetector(key, row, conLen, issubspace):
+    """
+    Get the time domain rep. (used basis vectors or normalized trimmed 
+    single waveform), required length, number of channels and sampling 
+    rate of a subspace or single
+    """
+    if issubspace:
+        ssArrayTD, reqlen, Nc = _loadMPSubSpace(row, conLen)
+    else:
+        ssArrayTD, reqlen, Nc = _loadMPSingles(row, conLen)
+    sr = list(row.Stats.values())[0]['sampling_rate']
+    return {'key': key, 'td': ssArrayTD, 'reqlen': reqlen, 'Nc': Nc,
+            'sr': sr}
+
+
+def _getDetectorFD(det):
+    """
+    Get freq domain rep. of a detector with required length
+    """
+    releb = 2 ** det['reqlen'].bit_length()
+    return np.array([fft(x[::-1], n=releb) for x in det['td']])
+
+
 def _loadMPSingles(row, conLen):
     """
     function to load trimed waveforms of singles
     """
-    Nc = row.Stats.values()[0]['Nc']  # num of channels
+    stats = list(row.Stats.values())[0]
+    Nc = stats['Nc']  # num of channels
     sts = row.SampleTrims['Starttime']
     ste = row.SampleTrims['Endtime']
     ssArrayTDp = np.array([row.MPtd[x][sts:ste] for x in row.MPtd.keys()])
     ssArrayTD = np.array([x / np.linalg.norm(x) for x in ssArrayTDp])  # normalize
-    sr = conLen * row.Stats.values()[0]['sampling_rate']  # samp rate
+    sr = conLen * stats['sampling_rate']  # samp rate
     rele = int(sr * Nc + np.max(np.shape(ssArrayTD)))
-    releb = 2 ** rele.bit_length()
-    ssArrayFD = np.array([fft(x[::-1], n=releb) for x in ssArrayTD])
-    return ssArrayTD, ssArrayFD, rele, Nc
+    return ssArrayTD, rele, Nc
 
 
 def _loadMPSubSpace(row, conLen):
     """
     function to load subspace representations
     """
-    if 'UsedSVDKeys' in row.index:  # test if input TRDF row is subspace
-        if not isinstance(row.UsedSVDKeys, list):
-            msg = ('SVD not defined, run SVD on subspace stream class before '
-                   'calling false alarm statistic class')
-            detex.log(__name__, msg, level='error')
-        if not all(x == row.Channels.values()[0] for x in row.Channels.values()):
-            msg = 'all stations in subspace do not have the same channels'
-            detex.log(__name__, msg, level='error')
-        Nc = len(row.Channels.values()[0])  # num of channels
-        ssArrayTD = np.array([row.SVD[x] for x in row.UsedSVDKeys])
-        sr = row.Stats.values()[0]['sampling_rate']  # samp rate
-        rele = int(conLen * sr * Nc + np.max(np.shape(ssArrayTD)))
-        releb = 2 ** rele.bit_length()
-        # Get freq domain rep. with required length
-        ssArrayFD = np.array([fft(x[::-1], n=releb) for x in ssArrayTD])
-    return ssArrayTD, ssArrayFD, rele, Nc
+    if not isinstance(row.UsedSVDKeys, list):
+        msg = ('SVD not defined, run SVD on subspace stream class before '
+               'calling false alarm statistic class')
+        detex.log(__name__, msg, level='error')
+    chans = list(row.Channels.values())
+    if not all(x == chans[0] for x in chans):
+        msg = 'all stations in subspace do not have the same channels'
+        detex.log(__name__, msg, level='error')
+    Nc = len(chans[0])  # num of channels
+    ssArrayTD = detex.subspace._stackRows(row.SVD, row.UsedSVDKeys)
+    sr = list(row.Stats.values())[0]['sampling_rate']  # samp rate
+    rele = int(conLen * sr * Nc + np.max(np.shape(ssArrayTD)))
+    return ssArrayTD, rele, Nc
+
+
+def _getDSStats(ds, sr, params):
+    """
+    Reduce a detection statistic vector to what is needed to fit the FAS 
+    distributions; the histogram used for plotting (params['histBins']), 
+    a fine histogram (FINE_BINS bins between 0 and 1) for the beta fit, 
+    sums of the DS, DS**2, log(DS) and log(1-DS) and sums of the sta/lta 
+    of the DS (number, sum, sum of squares). The statistics of several 
+    vectors can be combined with _addDSStats
+    """
+    ds = np.asarray(ds, dtype=np.float64)
+    fineInd = np.clip((ds * FINE_BINS).astype(np.int64), 0, FINE_BINS - 1)
+    clipped = np.clip(ds, LOG_EPS, 1 - LOG_EPS)
+    stalta = detex.detect._getStaLtaArray(ds, params['triggerLTATime'] * sr,
+                                          params['triggerSTATime'] * sr)
+    stats = {'hist': np.histogram(ds, bins=params['histBins'])[0],
+             'fine': np.bincount(fineInd, minlength=FINE_BINS),
+             'moments': np.array([len(ds), np.sum(ds), np.sum(ds ** 2),
+                                  np.sum(np.log(clipped)),
+                                  np.sum(np.log1p(-clipped))]),
+             'stalta': np.array([len(stalta), np.sum(stalta),
+                                 np.sum(np.square(stalta))])}
+    return stats
+
+
+def _addDSStats(stats1, stats2):
+    """
+    Combine the DS statistics of two sets of samples, stats1 may be None
+    """
+    if stats1 is None:
+        return stats2
+    return {key: stats1[key] + stats2[key] for key in stats1}
+
+
+def _fitBeta(stats):
+    """
+    Fit a beta distribution (loc=0, scale=1) to the DS statistics. A method
+    of moments estimate is used to seed a maximum likelihood fit to the 
+    fine histogram. Returns (a, b, 0, 1) like scipy.stats.beta.fit
+    """
+    num, tot, totsq = stats['moments'][:3]
+    mean = tot / num
+    var = totsq / num - mean ** 2
+    if 0 < mean < 1 and 0 < var < mean * (1 - mean):
+        com = mean * (1 - mean) / var - 1
+        seed = np.log([mean * com, (1 - mean) * com])
+    else:  # degenerate sample, start from uniform
+        seed = np.zeros(2)
+    counts = stats['fine']
+    use = np.nonzero(counts)[0]
+    edges = np.linspace(0, 1, len(counts) + 1)
+    lower, upper, counts = edges[use], edges[use + 1], counts[use]
+
+    def binnedNLL(logab):  # negative log likelihood of the binned DS
+        a, b = np.exp(logab)
+        prob = scipy.special.betainc(a, b, upper) - \
+            scipy.special.betainc(a, b, lower)
+        return -np.sum(counts * np.log(np.maximum(prob, 1e-300)))
+
+    logab = scipy.optimize.fmin(binnedNLL, seed, xtol=1e-6, ftol=1e-6,
+                                maxiter=2000, disp=False)
+    a, b = np.exp(logab)
+    return (a, b, 0, 1)
+
+
+def _betaNNLF(betaparams, stats):
+    """
+    Negative log likelihood of the DS samples given beta distribution 
+    betaparams, calculated from the sums of log(DS) and log(1-DS)
+    """
+    a, b = betaparams[:2]
+    num, logtot, log1mtot = stats['moments'][[0, 3, 4]]
+    return (num * scipy.special.betaln(a, b) - (a - 1) * logtot -
+            (b - 1) * log1mtot)
+
+
+def _fitSTALTA(stats):
+    """
+    Fit a gamma distribution (method of moments) to the sta/lta of the 
+    detection statistic from the sums accumulated by _getDSStats. Returns
+    the (shape, loc, scale) parameters or None if the fit fails
+    """
+    num, tot, totsq = stats['stalta']
+    if num < 2:
+        return None
+    mean = tot / num
+    var = totsq / num - mean ** 2
+    if mean <= 0 or var <= 0:
+        return None
+    return (mean ** 2 / var, 0, var / mean)
+
+
+def _getBetaThresholds(Pf, beta_a, beta_b, tol=1e-13, maxiter=200):
+    """
+    Vectorized inverse survival function of beta distributions (loc=0, 
+    scale=1). For every (beta_a, beta_b) pair find the detection statistic
+    where the survival function equals Pf using Newton iterations on the 
+    log of the survival function, safeguarded by bisection, so very small
+    Pf values are resolved (scipy.stats.beta.isf can fail for these, see
+    https://github.com/scipy/scipy/issues/4677). Returns an array of 
+    thresholds, NaN where the parameters are not valid
+    """
+    beta_a, beta_b, Pf = np.broadcast_arrays(np.asarray(beta_a, float),
+                                             np.asarray(beta_b, float),
+                                             np.asarray(Pf, float))
+    valid = (beta_a > 0) & (beta_b > 0) & (Pf > 0) & (Pf < 1)
+    a = np.where(valid, beta_a, 1.)
+    b = np.where(valid, beta_b, 1.)
+    logPf = np.log(np.where(valid, Pf, .5))
+    lnB = scipy.special.betaln(a, b)
+    lo, hi = np.zeros(a.shape), np.ones(a.shape)
+    x = a / (a + b)  # start at the mean
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        for _ in range(maxiter):
+            # sf(x; a, b) == betainc(b, a, 1 - x), which decreases with x
+            logsf = np.log(scipy.special.betainc(b, a, 1 - x))
+            resid = logsf - logPf
+            lo = np.where(resid > 0, x, lo)
+            hi = np.where(resid > 0, hi, x)
+            # d log(sf) / dx = -pdf / sf
+            logpdf = (a - 1) * np.log(x) + (b - 1) * np.log1p(-x) - lnB
+            xnew = x + resid / np.exp(logpdf - logsf)
+            bisect = ~np.isfinite(xnew) | (xnew <= lo) | (xnew >= hi)
+            xnew = np.where(bisect, (lo + hi) / 2., xnew)
+            done = (np.abs(xnew - x) <= tol) | (hi - lo <= tol)
+            x = xnew
+            if np.all(done):
+                break
+    return np.where(valid, x, np.nan)
 
 
 def _checkSTALTA(st, filt, STATime, LTATime, limit):
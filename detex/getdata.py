@@ -9,8 +9,10 @@ from __future__ import print_function, absolute_import, unicode_literals, divisi
 import glob
 import itertools
 import json
+import multiprocessing
 import os
 import random
+from sqlite3 import connect
 
 import numpy as np
 import obspy
@@ -415,10 +417,7 @@ class DataFetcher(object):
                 pfile = glob.glob(os.path.join(temDir, ser.NAME, netsta + '*'))
                 if len(pfile) > 0:
                     continue
-            if isinstance(ser.TIME, string_types) and 'T' in ser.TIME:
-                time = ser.TIME
-            else:
-                time = float(ser.TIME)
+            time = ser.STAMP
 
             net = ser.NETWORK
             sta = ser.STATION
@@ -426,17 +425,14 @@ class DataFetcher(object):
 
             # if phases option is used then find first phase and use it
             if phases is not None:
-                con1 = (phases.Event == ser.NAME)
-                con2 = (phases.Station == '%s.%s' % (net, sta))
-                curEve = phases[con1 & con2]
+                curEve = phases.getPhases(ser.NAME, netsta)
                 if len(curEve) < 1:  # if event station pair not in phases
                     msg = (('%s on %s was not in phase file, using origin')
                            % (ser.NAME, sta))
                     detex.log(__name__, msg, level='info')
                     t = obspy.UTCDateTime(time)
                 else:
-                    utcs = [obspy.UTCDateTime(x) for x in curEve.TimeStamp]
-                    t = min(utcs)
+                    t = obspy.UTCDateTime(curEve.STAMP.min())
             else:
                 t = obspy.UTCDateTime(time)
             start = t - tb4
@@ -499,11 +495,11 @@ class DataFetcher(object):
         for num, ser in stakey.iterrows():
             netsta = ser.NETWORK + '.' + ser.STATION
             if utcstart is None:
-                ts1 = obspy.UTCDateTime(ser.STARTTIME)
+                ts1 = obspy.UTCDateTime(ser.STARTSTAMP)
             else:
                 ts1 = utcstart
             if utcend is None:
-                ts2 = obspy.UTCDateTime(ser.ENDTIME)
+                ts2 = obspy.UTCDateTime(ser.ENDSTAMP)
             else:
                 ts2 = utcend
             utcs = _divideIntoChunks(ts1, ts2, duration, randSamps)
@@ -576,7 +572,13 @@ class DataFetcher(object):
 
         # fetch stream
         st = self._getStream(self, start, end, net, sta, chan, loc)
+        return self._finishStream(st, start, end, net, sta, chan, loc)
 
+    def _finishStream(self, st, start, end, net, sta, chan, loc):
+        """
+        Check, remove response, trim, merge and detrend a fetched stream as
+        getStream does
+        """
         # perform checks if required            
         if self.checkData:
             st = _dataCheck(st, start, end)
@@ -892,12 +894,122 @@ def _divideIntoChunks(utc1, utc2, duration, randSamps):
                 randSamps, len(utcList)))
             detex.log(__name__, msg, level='info')
             randSamps = len(utcList)
-        ranutc = random.sample(utcList, randSamps)
+        ranutc = random.sample(list(utcList), randSamps)
         rsamps = [obspy.UTCDateTime(x) for x in ranutc]
         for samp in rsamps:
             yield samp
 
 
+def extractWaveforms(fetcher, requests, waveFormat='mseed', processes=1):
+    """
+    Fetch and write waveforms for many time windows. The requests of each
+    station are handled by one process, for directory fetchers each 
+    continuous data file is read once for all the windows in it.
+
+    Parameters
+    ----------
+    fetcher : instance of DataFetcher
+        The fetcher to get the data from
+    requests : dict
+        keys are (network, station), values lists of (path, start, end, 
+        name) where path is the file to write, start and end are readable 
+        by obspy.UTCDateTime and name is used in messages
+    waveFormat : str
+        Format to save files, "mseed", "pickle", "sac", and "Q" supported
+    processes : int or None
+        Number of processes to use, if None use all cores
+
+    Returns
+    -------
+    A list of the paths written
+    """
+    tasks = [(fetcher, net, sta, reqs, waveFormat)
+             for (net, sta), reqs in sorted(requests.items())]
+    if processes is None or processes > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_writeStationWaveforms, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_writeStationWaveforms(x) for x in tasks]
+    return [path for paths in results for path in paths]
+
+
+def _writeStationWaveforms(task):
+    """
+    Fetch and write the requested waveforms of one station, task is 
+    (fetcher, net, sta, requests, waveFormat), see extractWaveforms. 
+    Returns the paths written
+    """
+    fetcher, net, sta, requests, waveFormat = task
+    if fetcher.method == 'dir':
+        streams = _iterDirectoryStreams(fetcher, net, sta, requests)
+    else:
+        streams = _iterFetchedStreams(fetcher, net, sta, requests)
+    written = []
+    for (path, start, end, name), st in streams:
+        try:
+            st.write(path, waveFormat)
+            written.append(path)
+        except Exception:
+            msg = 'Could not write and save %s for station %s' % (name, sta)
+            detex.log(__name__, msg, level='warning', pri=True)
+    return written
+
+
+def _iterFetchedStreams(fet, net, sta, requests):
+    """
+    Yield (request, stream) for requests (see extractWaveforms) of one 
+    station using fet.getStream, stream is None if fetching fails
+    """
+    for req in requests:
+        try:
+            st = fet.getStream(req[1], req[2], net, sta)
+        except Exception:
+            st = None
+        yield req, st
+
+
+def _iterDirectoryStreams(fet, net, sta, requests):
+    """
+    Yield (request, stream) for requests (see extractWaveforms) of one
+    station from a directory fetcher. Requests are handled in time order
+    and each data file is read once and kept until no later request can
+    use it
+    """
+    requests = sorted(requests, key=lambda x: obspy.UTCDateTime(x[1]))
+    t1 = obspy.UTCDateTime(requests[0][1]).timestamp
+    t2 = max([obspy.UTCDateTime(x[2]).timestamp for x in requests])
+    buf = 3 * fet.conDatDuration
+    dfind = _loadIndexDb(fet.directoryName, net + '.' + sta, t1 - buf,
+                         t2 + buf)
+    cache = {}  # path: (file end time, stream)
+    for req in requests:
+        start, end = obspy.UTCDateTime(req[1]), obspy.UTCDateTime(req[2])
+        if dfind is None:
+            yield req, None
+            continue
+        cache = {key: val for key, val in cache.items()
+                 if val[0] >= start.timestamp}
+        con = ((dfind.Starttime < end.timestamp) &
+               (dfind.Endtime > start.timestamp))
+        st = obspy.core.Stream()
+        for path, fname, fend in zip(dfind.Path[con], dfind.FileName[con],
+                                     dfind.Endtime[con]):
+            fil = os.path.join(path, fname)
+            if fil not in cache:
+                cache[fil] = (fend, read(fil))
+            if cache[fil][1] is not None:
+                # copy so processing does not change the cached stream
+                st += cache[fil][1].slice(start, end).copy()
+        if len(st) < 1:
+            yield req, None
+            continue
+        yield req, fet._finishStream(st, start, end, net, sta, ['???'], '??')
+
+
 def _makePathFile(conDir, netsta, utc):
     """
     Make the expected filename to see if continuous data chunk exists
@@ -960,7 +1072,7 @@ def indexDirectory(dirPath):
             pathInts = [pathList[num].index(x) for num,
                                                    x in enumerate(dirList)]
             df.loc[len(df), 'Path'] = json.dumps(pathInts)
-            for key, value in qualDict.iteritems():
+            for key, value in qualDict.items():
                 df.loc[len(df) - 1, key] = value
             df.loc[len(df) - 1, 'FileName'] = fname
             # Create path index key
@@ -972,6 +1084,58 @@ def indexDirectory(dirPath):
     detex.util.saveSQLite(dfInd, os.path.join(dirPath, '.index.db'), 'indkey')
 
 
+def updateIndex(dirPath, paths):
+    """
+    Add the waveform files in paths (files in dirPath) to the index of 
+    dirPath (.index.db) without reindexing the whole directory, files that
+    are already in the index are replaced. If dirPath is not indexed 
+    nothing is done, it will be indexed when first used
+
+    Parameters
+    ----------
+    dirPath : str
+        The path to the indexed directory
+    paths : list of str
+        The paths of the new (or rewritten) files
+    """
+    indexPath = os.path.join(dirPath, '.index.db')
+    if not os.path.exists(indexPath) or len(paths) < 1:
+        return
+    columns = ['Path', 'FileName', 'Starttime', 'Endtime', 'Gaps', 'Nc', 'Nt',
+               'Duration', 'Station']
+    dfin = detex.util.loadSQLite(indexPath, 'indkey', convertNumeric=False)
+    pathList = []  # strip padding but keep the empty root ('') of col_0
+    for num, row in dfin.iterrows():
+        vals = [x if isinstance(x, string_types) else '' for x in row.values]
+        filled = [num2 for num2, x in enumerate(vals) if x]
+        pathList.append(vals[:max(filled[-1] + 1 if filled else 0, 1)])
+    rows = []
+    for fullpath in paths:
+        dirList = os.path.abspath(os.path.dirname(fullpath)).split(os.path.sep)
+        while len(dirList) > len(pathList):
+            pathList.append([])
+        for ind, value in enumerate(dirList):
+            if value not in pathList[ind]:
+                pathList[ind].append(value)
+        qualDict = _checkQuality(fullpath)
+        if qualDict is None:  # If file is not obspy readable
+            msg = 'obspy failed to read %s , skipping' % fullpath
+            detex.log(__name__, msg, level='warning', pri=True)
+            continue
+        pathInts = [pathList[num].index(x) for num, x in enumerate(dirList)]
+        qualDict['Path'] = json.dumps(pathInts)
+        qualDict['FileName'] = os.path.basename(fullpath)
+        rows.append(qualDict)
+    df = pd.DataFrame(rows, columns=columns)
+    with connect(indexPath) as con:  # remove old rows of the files
+        con.executemany('DELETE FROM ind WHERE Path=? AND FileName=?',
+                        list(zip(df.Path, df.FileName)))
+        con.execute('DROP TABLE indkey')
+    if len(df):
+        detex.util.saveSQLite(df, indexPath, 'ind')
+    detex.util.saveSQLite(_createIndexDF(pathList), indexPath, 'indkey')
+
+
 def _createIndexDF(pathList):
     indLength = len(pathList)
     colLength = max([len(x) for x in pathList])
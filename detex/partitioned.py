@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+"""
+Time partitioned layout for detection databases
+
+With SubSpace.detex(partitioned=True) subspaceDB is a directory holding
+one sqlite database per station and month (of MSTAMPmin) for the
+detection tables (ss_df, sg_df) and a manifest database (manifest.db)
+holding the partitions table (table, station, month, file and time range
+of the detections of each partition) and the info, filter and histogram
+tables. Detection processes working on different stations write to
+different files, rerunning detections for some stations or times only
+replaces the detections of those stations and times, and detResults only
+opens the partitions of the stations and times requested.
+"""
+# python 2 and 3 compatibility imports
+from __future__ import print_function, absolute_import, unicode_literals
+from __future__ import with_statement, nested_scopes, generators, division
+
+import collections
+import os
+from sqlite3 import connect
+
+import numpy as np
+import pandas as pd
+from six import string_types
+
+import detex
+
+MANIFEST_DB = 'manifest.db'
+DETECTION_TABLES = ['ss_df', 'sg_df']  # partitioned by station and month
+STATION_TABLES = ['ss_info', 'sg_info', 'ss_hist', 'sg_hist']  # have Sta
+REPLACED_TABLES = ['filt_params']  # rows replaced by each write
+MAX_OPEN = 32  # partition databases kept open by PartitionedStore
+
+
+def isPartitioned(path):
+    """
+    Return True if path is a partitioned detection directory
+    """
+    return (isinstance(path, string_types) and os.path.isdir(path) and
+            os.path.exists(os.path.join(path, MANIFEST_DB)))
+
+
+def getManifestDB(path):
+    """
+    Return the path to the manifest database of partitioned directory path
+    """
+    return os.path.join(path, MANIFEST_DB)
+
+
+def _getMonths(stamps):
+    """
+    Return the months (YYYY-MM) of an array of time stamps
+    """
+    return pd.to_datetime(np.asarray(stamps, dtype=float),
+                          unit='s').strftime('%Y-%m')
+
+
+def _getMonthRange(month):
+    """
+    Return the time stamps of the start and end of month (YYYY-MM)
+    """
+    t1 = pd.Timestamp(month + '-01')
+    t2 = t1 + pd.DateOffset(months=1)
+    epoch = pd.Timestamp('1970-01-01')
+    return (t1 - epoch).total_seconds(), (t2 - epoch).total_seconds()
+
+
+def getPartitions(path, tableName=None, stations=None, starttime=None,
+                  endtime=None):
+    """
+    Return a DataFrame of the partitions (columns Tab, Sta, Month, File,
+    Tmin and Tmax) of partitioned directory path, sorted by station and
+    month. Only those of tableName (all if None), stations (all if None)
+    and with detections between starttime and endtime (time stamps, no
+    limit if None) are returned. File is the full path
+    """
+    manifest = getManifestDB(path)
+    cols = ['Tab', 'Sta', 'Month', 'File', 'Tmin', 'Tmax']
+    with connect(manifest) as con:
+        if not detex.util._hasTable(con, 'partitions'):
+            return pd.DataFrame(columns=cols)
+        df = pd.read_sql('SELECT %s FROM partitions' % ', '.join(cols), con)
+    if tableName is not None:
+        df = df[df.Tab == tableName]
+    if isinstance(stations, string_types):
+        stations = [stations]
+    if isinstance(stations, (list, tuple)):
+        df = df[df.Sta.isin(stations)]
+    if starttime is not None:
+        df = df[df.Tmax >= starttime]
+    if endtime is not None:
+        df = df[df.Tmin <= endtime]
+    df = df.sort_values(by=['Sta', 'Month'])
+    df['File'] = [os.path.join(path, x) for x in df.File]
+    return df.reset_index(drop=True)
+
+
+def getTimeRange(path, tableNames=DETECTION_TABLES):
+    """
+    Return the first and last MSTAMPmin of the detections in tableNames of
+    partitioned directory path, (None, None) if there are none
+    """
+    parts = getPartitions(path)
+    parts = parts[parts.Tab.isin(tableNames)]
+    if len(parts) < 1:
+        return None, None
+    return parts.Tmin.min(), parts.Tmax.max()
+
+
+def readTable(path, tableName):
+    """
+    Read table tableName of partitioned directory path, the detection
+    tables are read from all partitions. None if the table does not exist
+    """
+    if tableName not in DETECTION_TABLES:
+        return detex.util.loadSQLite(getManifestDB(path), tableName)
+    parts = getPartitions(path, tableName)
+    dfs = [detex.util.loadSQLite(x, tableName) for x in parts.File]
+    dfs = [x for x in dfs if x is not None]
+    if not dfs:
+        return None
+    return pd.concat(dfs, ignore_index=True)
+
+
+class PartitionedStore(object):
+    """
+    Writer with the interface of detex.util.DetectionStore for partitioned
+    directories. Rows of the detection tables are routed to the
+    DetectionStore of their station and month, the other tables and the
+    partitions table are written to the manifest database.
+
+    Parameters
+    ----------
+    path : str
+        Path to the directory (created if it does not exist)
+    batchSize : int
+        Passed to the DetectionStore of each database
+    timeout : float
+        Passed to the DetectionStore of each database
+    """
+
+    def __init__(self, path, batchSize=500, timeout=60.):
+        if os.path.exists(path) and not os.path.isdir(path):
+            msg = '%s exists and is not a directory' % path
+            detex.log(__name__, msg, level='error', e=IOError)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.path = path
+        self.batchSize = batchSize
+        self.timeout = timeout
+        self.manifest = detex.util.DetectionStore(getManifestDB(path),
+                                                  batchSize, timeout)
+        self.manifest.con.execute(
+            'CREATE TABLE IF NOT EXISTS partitions (Tab TEXT, Sta TEXT, '
+            'Month TEXT, File TEXT, Tmin REAL, Tmax REAL, '
+            'PRIMARY KEY (Tab, Sta, Month))')
+        self._stores = collections.OrderedDict()  # (sta, month): store
+        self._ranges = {}  # (table, sta, month): [tmin, tmax] not recorded
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _getFile(self, sta, month):
+        return os.path.join(sta, month + '.db')
+
+    def _getStore(self, sta, month):
+        """
+        Return the (open) DetectionStore of sta and month, the least
+        recently used store is closed if MAX_OPEN are open
+        """
+        key = (sta, month)
+        if key in self._stores:
+            store = self._stores.pop(key)
+        else:
+            if len(self._stores) >= MAX_OPEN:
+                oldKey, oldStore = self._stores.popitem(last=False)
+                oldStore.close()
+            fileName = os.path.join(self.path, self._getFile(sta, month))
+            if not os.path.exists(os.path.dirname(fileName)):
+                os.makedirs(os.path.dirname(fileName))
+            store = detex.util.DetectionStore(fileName, self.batchSize,
+                                              self.timeout)
+        self._stores[key] = store
+        return store
+
+    def write(self, df, tableName):
+        """
+        Append the rows of DataFrame df to table tableName, detection rows
+        go to the database of their station and month
+        """
+        if df is None or len(df) < 1:
+            return
+        if tableName in REPLACED_TABLES:
+            self._replace(df, tableName)
+            return
+        if tableName not in DETECTION_TABLES:
+            self.manifest.write(df, tableName)
+            return
+        stamps = df.MSTAMPmin.values.astype(float)
+        months = np.asarray(_getMonths(stamps))
+        for (sta, month), part in df.groupby([df.Sta.values, months]):
+            self._getStore(sta, month).write(part, tableName)
+            pstamps = part.MSTAMPmin.values.astype(float)
+            key = (tableName, sta, month)
+            tmin, tmax = self._ranges.get(key, [np.inf, -np.inf])
+            self._ranges[key] = [min(tmin, pstamps.min()),
+                                 max(tmax, pstamps.max())]
+
+    def _replace(self, df, tableName):
+        """
+        Replace the rows of manifest table tableName with those of df in
+        one transaction
+        """
+        store = self.manifest
+        cols, sql = store._prepare(df, tableName)
+        store.flush(tableName)
+        con = store.con
+        con.execute('BEGIN IMMEDIATE')
+        try:
+            con.execute('DELETE FROM %s' % tableName)
+            con.executemany(sql, detex.util._getSQLValues(df[cols]))
+        except Exception:
+            con.execute('ROLLBACK')
+            raise
+        con.execute('COMMIT')
+
+    def _recordRanges(self):
+        """
+        Add the partitions written since the last call to the partitions
+        table (merging time ranges with what other writers recorded)
+        """
+        if not self._ranges:
+            return
+        con = self.manifest.con
+        con.execute('BEGIN IMMEDIATE')
+        for (table, sta, month), (tmin, tmax) in self._ranges.items():
+            fileName = self._getFile(sta, month)
+            con.execute('INSERT OR IGNORE INTO partitions VALUES '
+                        '(?, ?, ?, ?, ?, ?)',
+                        (table, sta, month, fileName, tmin, tmax))
+            con.execute('UPDATE partitions SET Tmin=MIN(Tmin, ?), '
+                        'Tmax=MAX(Tmax, ?) WHERE Tab=? AND Sta=? AND Month=?',
+                        (tmin, tmax, table, sta, month))
+        con.execute('COMMIT')
+        self._ranges = {}
+
+    def flush(self, tableName=None):
+        """
+        Write the buffered rows of tableName (all tables if None)
+        """
+        for store in self._stores.values():
+            store.flush(tableName)
+        self.manifest.flush(tableName)
+        self._recordRanges()
+
+    def createIndexes(self, tableNames=('ss_df', 'sg_df')):
+        """
+        Flush and create the indexes used by detResults on the detection
+        tables of all partitions
+        """
+        self.flush()
+        parts = getPartitions(self.path)
+        for fileName in parts.File.unique():
+            with connect(fileName, timeout=self.timeout) as con:
+                for tableName in tableNames:
+                    detex.util._createDetectionIndexes(con, tableName)
+
+    def clear(self, stations, starttime=None, endtime=None):
+        """
+        Remove the detections of stations (list of net.sta) with MSTAMPmin
+        between starttime and endtime (time stamps, no limit if None),
+        partitions completely in the time range are deleted. The info and
+        histogram rows of stations are removed as they are rewritten by 
+        SubSpace.detex (which replaces the filter parameters when it writes
+        them, those of the stations not cleared are kept until then)
+        """
+        self.flush()
+        for key in list(self._stores.keys()):
+            self._stores.pop(key).close()
+        t1 = -np.inf if starttime is None else starttime
+        t2 = np.inf if endtime is None else endtime
+        con = self.manifest.con
+        parts = getPartitions(self.path, stations=list(stations))
+        for (sta, month, fileName), df in parts.groupby(['Sta', 'Month',
+                                                          'File']):
+            mstart, mend = _getMonthRange(month)
+            if t1 <= mstart and t2 >= mend:  # whole partition replaced
+                for ext in ['', '-wal', '-shm']:
+                    if os.path.exists(fileName + ext):
+                        os.remove(fileName + ext)
+                con.execute('DELETE FROM partitions WHERE Sta=? AND Month=?',
+                            (sta, month))
+                continue
+            if t2 < mstart or t1 >= mend:
+                continue
+            with connect(fileName, timeout=self.timeout) as pcon:
+                for table in df.Tab:
+                    pcon.execute('DELETE FROM %s WHERE MSTAMPmin>=? AND '
+                                 'MSTAMPmin<=?' % table, (t1, t2))
+                    tmin, tmax = pcon.execute(
+                        'SELECT MIN(MSTAMPmin), MAX(MSTAMPmin) FROM %s' %
+                        table).fetchone()
+                    if tmin is None:
+                        con.execute('DELETE FROM partitions WHERE Tab=? AND '
+                                    'Sta=? AND Month=?', (table, sta, month))
+                    else:
+                        con.execute('UPDATE partitions SET Tmin=?, Tmax=? '
+                                    'WHERE Tab=? AND Sta=? AND Month=?',
+                                    (tmin, tmax, table, sta, month))
+        stas = [str(x) for x in stations] + ['Bins']
+        for table in STATION_TABLES:
+            if detex.util._hasTable(con, table):
+                con.execute('DELETE FROM %s WHERE Sta IN (%s)' % (
+                    table, ', '.join(['?'] * len(stas))), stas)
+
+    def close(self):
+        """
+        Flush buffered rows and close all databases
+        """
+        if self.manifest.con is None:
+            return
+        self.flush()
+        for store in self._stores.values():
+            store.close()
+        self._stores = collections.OrderedDict()
+        self.manifest.close()
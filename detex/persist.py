@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Binary (directory based) storage for ClusterStream and SubSpace instances
+
+Numeric arrays are written as raw .npy files and loaded back with memory
+mapping, everything else is pickled. The frames of a SubSpace instance are
+written per station so a subset of stations can be loaded. Frequency
+domain spectra (MPfd) are not written as they can be recalculated.
+"""
+# python 2 and 3 compatibility imports
+from __future__ import print_function, absolute_import, unicode_literals
+from __future__ import with_statement, nested_scopes, generators, division
+
+import copy
+import json
+import os
+import pickle
+import shutil
+
+import numpy as np
+from six import string_types
+
+import detex
+
+FORMAT_NAME = 'detex-binary'
+FORMAT_VERSION = 1
+MANIFEST = 'manifest.json'
+MIN_ARRAY_SIZE = 256  # arrays with fewer elements stay in the pickles
+DROP_COLUMNS = ['MPfd']  # derivable columns that are not written
+
+
+class _ArrayPickler(pickle.Pickler):
+    """
+    Pickler that writes numeric arrays to arrayDir as npy files and only
+    stores their file names in the pickle
+    """
+
+    def __init__(self, fileobj, arrayDir):
+        pickle.Pickler.__init__(self, fileobj, 2)
+        self.arrayDir = arrayDir
+        self.saved = {}  # id of array: (file name, array)
+
+    def persistent_id(self, obj):
+        if not isinstance(obj, np.ndarray) or obj.size < MIN_ARRAY_SIZE:
+            return None
+        if obj.dtype.kind not in 'biufc':  # object, str, etc. get pickled
+            return None
+        if id(obj) not in self.saved:
+            name = 'a%d.npy' % len(self.saved)
+            np.save(os.path.join(self.arrayDir, name), obj)
+            self.saved[id(obj)] = (name, obj)  # keep ref so id stays unique
+        return str(self.saved[id(obj)][0])
+
+
+class _ArrayUnpickler(pickle.Unpickler):
+    """
+    Unpickler that loads the arrays written by _ArrayPickler, memory mapped
+    (copy on write) if mmap is True
+    """
+
+    def __init__(self, fileobj, arrayDir, mmap=True):
+        pickle.Unpickler.__init__(self, fileobj)
+        self.arrayDir = arrayDir
+        self.mmap_mode = 'c' if mmap else None
+
+    def persistent_load(self, pid):
+        path = os.path.join(self.arrayDir, pid)
+        return np.load(path, mmap_mode=self.mmap_mode)
+
+
+def _dump(obj, path):
+    """
+    pickle obj to path + '.pkl' with arrays written in directory path
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+    with open(path + '.pkl', 'wb') as fi:
+        _ArrayPickler(fi, path).dump(obj)
+
+
+def _load(path, mmap=True):
+    """
+    load an object written with _dump
+    """
+    with open(path + '.pkl', 'rb') as fi:
+        return _ArrayUnpickler(fi, path, mmap).load()
+
+
+def _dropDerivable(df):
+    """
+    return a copy of DataFrame df without the columns in DROP_COLUMNS
+    """
+    if df is None:
+        return None
+    return df.drop([x for x in DROP_COLUMNS if x in df.columns], axis=1)
+
+
+def writeBinary(obj, path):
+    """
+    Write a ClusterStream or SubSpace instance to directory path. The new
+    directory is written next to path and then moved in place so path is
+    never left half written.
+
+    Parameters
+    ----------
+    obj : instance of detex.subspace.ClusterStream or SubSpace
+        The instance to write
+    path : str
+        Path of the directory to create (overwritten if it exists)
+    """
+    isSubSpace = isinstance(obj, detex.subspace.SubSpace)
+    if not isSubSpace and not isinstance(obj, detex.subspace.ClusterStream):
+        msg = 'obj must be a ClusterStream or SubSpace instance'
+        detex.log(__name__, msg, level='error', e=TypeError)
+    tmp = path.rstrip(os.sep) + '.tmp'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    manifest = {'format': FORMAT_NAME, 'version': FORMAT_VERSION,
+                'class': obj.__class__.__name__, 'stations': []}
+    if isSubSpace:
+        # write the frames of each station separately, then the rest
+        stations = sorted(set(obj.subspaces.keys()) | set(obj.singles.keys()))
+        for sta in stations:
+            frames = {'subspaces': _dropDerivable(obj.subspaces.get(sta)),
+                      'singles': _dropDerivable(obj.singles.get(sta))}
+            _dump(frames, os.path.join(tmp, 'stations', sta))
+        manifest['stations'] = stations
+        obj = copy.copy(obj)
+        obj.subspaces, obj.singles, obj.singletons = {}, {}, {}
+    _dump(obj, os.path.join(tmp, 'object'))
+    with open(os.path.join(tmp, MANIFEST), 'w') as fi:
+        json.dump(manifest, fi, indent=2)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp, path)
+
+
+def readBinary(path, stations=None, mmap=True):
+    """
+    Read a ClusterStream or SubSpace instance written with writeBinary
+
+    Parameters
+    ----------
+    path : str
+        Path to the directory
+    stations : None or list of str
+        If a list of stations (net.sta or sta) only load the subspaces and
+        singletons of those stations (SubSpace instances only)
+    mmap : bool
+        If True memory map the arrays (copy on write) so data are only read
+        from disk when used
+
+    Returns
+    -------
+    An instance of detex.subspace.ClusterStream or SubSpace
+    """
+    manifest = readManifest(path)
+    obj = _load(os.path.join(path, 'object'), mmap)
+    if manifest['class'] != 'SubSpace':
+        return obj
+    stas = manifest['stations']
+    if stations is not None:
+        if isinstance(stations, string_types):
+            stations = [stations]
+        stas = [x for x in stas if x in stations or
+                x.split('.')[-1] in stations]
+        if not stas:
+            msg = 'none of %s found in %s' % (stations, path)
+            detex.log(__name__, msg, level='error', e=ValueError)
+    for sta in stas:
+        frames = _load(os.path.join(path, 'stations', sta), mmap)
+        if frames['subspaces'] is not None:
+            obj.subspaces[sta] = frames['subspaces']
+        if frames['singles'] is not None:
+            obj.singles[sta] = frames['singles']
+    obj.singletons = obj.singles
+    obj._setStations()
+    return obj
+
+
+def readManifest(path):
+    """
+    Read the manifest of a binary detex directory, raise if path is not
+    one
+    """
+    mpath = os.path.join(path, MANIFEST)
+    if not os.path.exists(mpath):
+        msg = '%s is not a detex binary directory' % path
+        detex.log(__name__, msg, level='error', e=IOError)
+    with open(mpath) as fi:
+        manifest = json.load(fi)
+    if manifest.get('format') != FORMAT_NAME:
+        msg = '%s is not a detex binary directory' % path
+        detex.log(__name__, msg, level='error', e=IOError)
+    if manifest.get('version', 0) > FORMAT_VERSION:
+        msg = ('%s was written with a newer version of detex (format '
+               'version %s)') % (path, manifest['version'])
+        detex.log(__name__, msg, level='error', e=IOError)
+    return manifest
+
+
+def isBinary(path):
+    """
+    Return True if path is a directory written by writeBinary
+    """
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, MANIFEST))
@@ -9,11 +9,11 @@ from __future__ import with_statement, nested_scopes, generators, division
 
 import numbers
 import os
+from sqlite3 import connect
 
 import numpy as np
 import obspy
 import pandas as pd
-import scipy
 from six import string_types
 
 import detex
@@ -25,7 +25,9 @@ def detResults(trigCon=0, trigParameter=0, associateReq=0,
                templateKey='TemplateKey.csv', stationKey='StationKey.csv',
                veriFile=None, includeAllVeriColumns=True, reduceDets=True,
                Pf=False, stations=None, starttime=None, endtime=None,
-               fetch='ContinuousWaveForms', exceptionalThreshold=None):
+               fetch='ContinuousWaveForms', exceptionalThreshold=None,
+               windowDuration=None, windowOverlap=None,
+               resultsDB='Results.db'):
     """
     Function to create an instance of the CorResults class. Used to associate 
     detections across multiple stations into coherent events. CorResults class 
@@ -65,7 +67,10 @@ def detResults(trigCon=0, trigParameter=0, associateReq=0,
         Same as associate buffer but for associating detections with events 
         in the verification file
     ssDB : str
-        Path the the database created by detex.xcorr.correlate function
+        Path the the database created by detex.xcorr.correlate function, 
+        a columnar directory written from it by 
+        detex.columnar.exportDetections or a partitioned directory (see
+        detex.partitioned)
     templateKey : str
         Path to the template key
     stationKey : str
@@ -109,6 +114,21 @@ def detResults(trigCon=0, trigParameter=0, associateReq=0,
         regardless of the number of stations. Can also be a dict where the 
         keys are the stations (net.station) and the values are the thresholds
         to consider exceptional for that station. 
+    windowDuration : None or real number
+        If not None, process the detections in time windows of 
+        windowDuration seconds so memory use does not depend on the size of
+        ssDB. The results of each window are appended to resultsDB and its
+        path is returned instead of an SSResults instance (see 
+        _windowedResults for the tables written). reduceDets must be True.
+    windowOverlap : None or real number
+        The detections within windowOverlap seconds of each window are also
+        loaded so events on the window edges are associated correctly, 
+        events are kept in the window their first detection falls in. If 
+        None the largest association buffer is used. Events whose 
+        detections span more than windowOverlap seconds may be split. 
+    resultsDB : str
+        Path of the database written when windowDuration is used, it is
+        overwritten if it exists
     """
     _checkExistence([ssDB, templateKey, stationKey])
     _checkInputs(trigCon, trigParameter, associateReq,
@@ -128,10 +148,22 @@ def detResults(trigCon=0, trigParameter=0, associateReq=0,
     # ss_hist = detex.util.loadSQLite(ssDB, 'ss_hist')
     # sg_hist = detex.util.loadSQLite(ssDB, 'sg_hist')
 
-    filt = detex.util.loadSQLite(ssDB, 'filt_params')  # load filter Parameters
+    filt = _loadTable(ssDB, 'filt_params')  # load filter Parameters
 
     ss_PfKey, sg_PfKey = _makePfKey(ss_info, sg_info, Pf)
 
+    if windowDuration is not None:  # out of core, windows written to DB
+        if not reduceDets:
+            msg = 'When using windowDuration reduceDets must be True'
+            detex.log(__name__, msg, level='error')
+        return _windowedResults(ssDB, resultsDB, windowDuration,
+                                windowOverlap, trigCon, trigParameter,
+                                associateReq, requiredNumStations,
+                                ss_associateBuffer, sg_associateBuffer,
+                                veriBuffer, veriFile, includeAllVeriColumns,
+                                ss_info, temkey, ss_PfKey, sg_PfKey, stations,
+                                starttime, endtime, exceptionalThreshold)
+
     # Parse each station results and delete detections that occur on multiple
     # subpspace, keeping only the subspace with highest detection stat
     if reduceDets:
@@ -145,8 +177,8 @@ def detResults(trigCon=0, trigParameter=0, associateReq=0,
         if Pf:
             msg = 'When using the Pf parameter reduceDets must be True'
             detex.log(__name__, msg, level='error')
-        ssdf = detex.util.loadSQLite(ssDB, 'ss_df')
-        sgdf = detex.util.loadSQLite(ssDB, 'sg_df')
+        ssdf = _loadTable(ssDB, 'ss_df')
+        sgdf = _loadTable(ssDB, 'sg_df')
     if ssdf is None and sgdf is None:
         msg = 'No detections found that meet given criteria'
         detex.log(__name__, msg, level='error')
@@ -169,134 +201,254 @@ def detResults(trigCon=0, trigParameter=0, associateReq=0,
     return ssres
 
 
+def _windowedResults(ssDB, resultsDB, windowDuration, windowOverlap, trigCon,
+                     trigParameter, associateReq, requiredNumStations,
+                     ss_associateBuffer, sg_associateBuffer, veriBuffer,
+                     veriFile, includeAllVeriColumns, ss_info, temkey,
+                     ss_PfKey, sg_PfKey, stations, starttime, endtime,
+                     exceptionalThreshold):
+    """
+    Associate the detections of ssDB one time window at a time and append
+    the results to resultsDB. The tables written are Dets, Autos and Vers
+    (as the SSResults attributes without the Dets column) and DetsStations,
+    AutosStations (the detections of each event on each station, with an
+    Event column). Returns resultsDB
+    """
+    if windowOverlap is None:
+        windowOverlap = max(ss_associateBuffer, sg_associateBuffer)
+    if windowDuration <= 0 or windowOverlap < 0:
+        msg = 'windowDuration must be positive and windowOverlap not negative'
+        detex.log(__name__, msg, level='error', e=ValueError)
+    utc1, utc2 = _getTimeRange(ssDB, starttime, endtime)
+    if os.path.exists(resultsDB):
+        os.remove(resultsDB)
+    vertem = _loadVeriFile(veriFile)
+    if vertem is not None:  # events of a window can start in the overlap
+        veriPad = windowOverlap + veriBuffer / 2.0
+        unverified = np.ones(len(vertem), dtype=bool)
+    numEvents = 0
+    for wstart in np.arange(utc1, utc2 + windowDuration, windowDuration):
+        wend = wstart + windowDuration
+        if wstart > utc2:
+            break
+        start, end = wstart - windowOverlap, wend + windowOverlap
+        ssdf = _deleteDetDups(ssDB, trigCon, trigParameter,
+                              ss_associateBuffer, start, end, stations,
+                              'ss_df', PfKey=ss_PfKey)
+        sgdf = _deleteDetDups(ssDB, trigCon, trigParameter,
+                              sg_associateBuffer, start, end, stations,
+                              'sg_df', PfKey=sg_PfKey)
+        if ssdf is None and sgdf is None:
+            continue
+        df = pd.concat([ssdf, sgdf], ignore_index=True)
+        Dets, Autos = _associateDetections(df, associateReq,
+                                           requiredNumStations,
+                                           ss_associateBuffer, ss_info, temkey,
+                                           exceptionalThreshold)
+        # keep events that start in this window
+        Dets = Dets[(Dets.MSTAMPmin >= wstart) &
+                    (Dets.MSTAMPmin < wend)].reset_index(drop=True)
+        Autos = Autos[(Autos.MSTAMPmin >= wstart) &
+                      (Autos.MSTAMPmin < wend)].reset_index(drop=True)
+        Vers = None
+        if vertem is not None:
+            # each catalog event verifies at most one event of all windows
+            use = (unverified & (vertem.STMP.values >= wstart - veriPad) &
+                   (vertem.STMP.values < wend + veriPad))
+            Vers = _verifyEvents(Dets, Autos, vertem[use], veriBuffer,
+                                 includeAllVeriColumns)
+            if isinstance(Vers, pd.DataFrame) and len(Vers):
+                unverified &= ~vertem.NAME.isin(Vers.VerName).values
+        _writeWindowResults(resultsDB, Dets, Autos, Vers)
+        numEvents += len(Dets) + len(Autos)
+    msg = '%d events written to %s' % (numEvents, resultsDB)
+    detex.log(__name__, msg, pri=True)
+    return resultsDB
+
+
+def _getTimeRange(ssDB, starttime, endtime):
+    """
+    Return the time stamps of starttime and endtime, the first and last 
+    detection times in ssDB are used where they are None
+    """
+    utc1 = obspy.UTCDateTime(starttime).timestamp if starttime else None
+    utc2 = obspy.UTCDateTime(endtime).timestamp if endtime else None
+    if utc1 is not None and utc2 is not None:
+        return utc1, utc2
+    if detex.columnar.isColumnar(ssDB):
+        tmin, tmax = detex.columnar.getTimeRange(ssDB)
+    elif detex.partitioned.isPartitioned(ssDB):
+        tmin, tmax = detex.partitioned.getTimeRange(ssDB)
+    else:
+        mins, maxs = [], []
+        with connect(ssDB) as con:
+            for tableName in ['ss_df', 'sg_df']:
+                if not detex.util._hasTable(con, tableName):
+                    continue
+                sql = 'SELECT MIN(MSTAMPmin), MAX(MSTAMPmin) FROM %s' % tableName
+                tmin, tmax = con.execute(sql).fetchone()
+                if tmin is not None:
+                    mins.append(tmin)
+                    maxs.append(tmax)
+        tmin = min(mins) if mins else None
+        tmax = max(maxs) if maxs else None
+    if tmin is None:
+        msg = 'No detections found in %s' % ssDB
+        detex.log(__name__, msg, level='error')
+    utc1 = tmin if utc1 is None else utc1
+    utc2 = tmax if utc2 is None else utc2
+    return utc1, utc2
+
+
+def _writeWindowResults(resultsDB, Dets, Autos, Vers):
+    """
+    Append the events of a window to resultsDB, the detections of each 
+    event (Dets column) go in a separate table
+    """
+    for name, table in [('Dets', Dets), ('Autos', Autos), ('Vers', Vers)]:
+        if not isinstance(table, pd.DataFrame) or len(table) < 1:
+            continue
+        detex.util.saveSQLite(table.drop('Dets', axis=1), resultsDB, name)
+        if name == 'Vers':
+            continue
+        stations = pd.concat([dets.assign(Event=event) for event, dets in
+                              zip(table.Event, table.Dets)], ignore_index=True)
+        detex.util.saveSQLite(stations, resultsDB, name + 'Stations')
+
+
 def _makePfKey(ss_info, sg_info, Pf):
     """
     Make simple df for defining DS values corresponing to Pf for each 
-    subspace station pair
+    subspace station pair, the thresholds of all rows are calculated at
+    once
     """
     if not Pf:  # if no Pf value passed simply return none
         return None, None
+    return _getPfDF(ss_info, Pf), _getPfDF(sg_info, Pf)
 
-    ss_df = pd.DataFrame(columns=['Sta', 'Name', 'DS', 'betadist'])
-    sg_df = pd.DataFrame(columns=['Sta', 'Name', 'DS', 'betadist'])
-    if isinstance(ss_info, pd.DataFrame):
-        for num, row in ss_info.iterrows():
-            TH = scipy.stats.beta.isf(Pf, row.beta1, row.beta2, 0, 1)
-            # if isf gives unrealistic pf, initiated forward grid serach
-            if TH > .94:
-                TH, Pftemp = _approximateThreshold(
-                    row.beta1, row.beta2, Pf, 1000, 3)
-            ss_df.loc[len(ss_df)] = [row.Sta, row.Name,
-                                     TH, [row.beta1, row.beta2, 0, 1]]
-        ss_df.reset_index(drop=True, inplace=True)
-    else:
-        ss_df = None
-    if isinstance(sg_info, pd.DataFrame):
-        for num, row in sg_info.iterrows():
-            TH = scipy.stats.beta.isf(Pf, row.beta1, row.beta2, 0, 1)
-            if TH > .94:
-                TH, Pftemp = _approximateThreshold(
-                    row.beta1, row.beta2, Pf, 1000, 3)
-            sg_df.loc[len(sg_df)] = [row.Sta, row.Name,
-                                     TH, [row.beta1, row.beta2, 0, 1]]
-        sg_df.reset_index(drop=True, inplace=True)
-    else:
-        sg_df = None
-    return ss_df, sg_df
 
-
-def _approximateThreshold(beta_a, beta_b, target, numintervals, numloops):
+def _getPfDF(info, Pf):
     """
-    Because scipy.stats.beta.isf can break, if it returns a value near 1 when 
-    this is obvious wrong initialize grid search algo to get close to desired
-    threshold using forward problem which seems to work where inverse fails
-    See this bug report: https://github.com/scipy/scipy/issues/4677
+    Make the Pf key of an info DataFrame, None if info is not a DataFrame
     """
-
-    startVal, stopVal = 0, 1
-    loops = 0
-    while loops < numloops:
-        Xs = np.linspace(startVal, stopVal, numintervals)
-        pfs = np.array([scipy.stats.beta.sf(x, beta_a, beta_b) for x in Xs])
-        resids = abs(pfs - target)
-        minind = resids.argmin()
-        bestPf = pfs[minind]
-        bestX = Xs[minind]
-        startVal, stopVal = Xs[minind - 1], Xs[minind + 1]
-        loops += 1
-        if minind == 0 or minind == numintervals - 1:
-            raise ValueError('Grind search failing, set threshold manually')
-    return bestX, bestPf
+    if not isinstance(info, pd.DataFrame):
+        return None
+    TH = detex.fas._getBetaThresholds(Pf, info.beta1.values,
+                                      info.beta2.values)
+    if np.any(np.isnan(TH)):
+        bad = info[np.isnan(TH)]
+        msg = 'Could not determine threshold for Pf=%e for %s, set it manually' % (
+            Pf, ', '.join(bad.Sta + ' ' + bad.Name))
+        detex.log(__name__, msg, level='error', e=ValueError)
+    df = pd.DataFrame({'Sta': info.Sta.values, 'Name': info.Name.values,
+                       'DS': TH}, columns=['Sta', 'Name', 'DS', 'betadist'])
+    df['betadist'] = [[b1, b2, 0, 1] for b1, b2 in
+                      zip(info.beta1.values, info.beta2.values)]
+    return df
 
 
-def _verifyEvents(Dets, Autos, veriFile, veriBuffer, includeAllVeriColumns):
+def _loadVeriFile(veriFile):
+    """
+    Load the verification file (see _readVeriFile) and add the origin time
+    stamps (STMP column), return None if veriFile is None or does not exist
+    """
     if veriFile is None:
-        return
+        return None
     if isinstance(veriFile, string_types):
         if not veriFile or not os.path.exists(veriFile):
             msg = 'No veriFile passed or it does not exist, skipping verification'
             detex.log(__name__, msg, pri=True, level='warn')
-            return
+            return None
     elif not isinstance(veriFile, pd.DataFrame):
         msg = 'verifile type not supported, must be string or df'
         detex.log(__name__, msg, level='warn', pri=True)
 
     vertem = _readVeriFile(veriFile)
-    tstmp = [obspy.UTCDateTime(x).timestamp for x in vertem['TIME']]
-    vertem['STMP'] = tstmp
-    verlist = []
+    vertem['STMP'] = detex.util._getTimeStamps(vertem['TIME'])
+    return vertem
+
+
+def _verifyEvents(Dets, Autos, veriFile, veriBuffer, includeAllVeriColumns):
+    vertem = _loadVeriFile(veriFile)
+    if vertem is None:
+        return
     cols = ['TIME', 'LAT', 'LON', 'MAG', 'ProEnMag', 'DEPTH', 'NAME']
-    additionalColumns = list(set(vertem.columns) - set(cols))
-
-    for vernum, verrow in vertem.iterrows():
-        con1 = Dets.MSTAMPmin - veriBuffer / 2.0 < verrow.STMP
-        con2 = Dets.MSTAMPmax + veriBuffer / 2.0 > verrow.STMP
-        con3 = [not x for x in Dets.Verified]
-        temDets = Dets[(con1) & (con2) & (con3)]
-        if len(temDets) > 0:  # TODO handle multiple verification situations
-            trudet = temDets[temDets.DSav == temDets.DSav.max()]
-            Dets.loc[trudet.index[0], 'Verified'] = True
-            if includeAllVeriColumns:
-                for col in additionalColumns:
-                    if not col in trudet.columns:
-                        trudet[col] = verrow[col]
-            trudet['VerMag'] = verrow.MAG
-            trudet['VerLat'] = verrow.LAT
-            trudet['VerLon'] = verrow.LON
-            trudet['VerDepth'] = verrow.DEPTH
-            trudet['VerName'] = verrow.NAME
-            verlist.append(trudet)
-        else:
-            con1 = Autos.MSTAMPmin - veriBuffer / 2.0 < verrow.STMP
-            con2 = Autos.MSTAMPmax + veriBuffer / 2.0 > verrow.STMP
-            con3 = [not x for x in Autos.Verified]
-            temAutos = Autos[(con1) & (con2) & (con3)]
-            if len(temAutos) > 0:  # TODO same as above
-                trudet = temAutos[temAutos.DSav == temAutos.DSav.max()]
-                Autos.loc[trudet.index[0], 'Verified'] = True
-                if includeAllVeriColumns:
-                    for col in additionalColumns:
-                        if not col in trudet.columns:
-                            trudet[col] = verrow[col]
-                trudet['VerMag'] = verrow.MAG
-                trudet['VerLat'] = verrow.LAT
-                trudet['VerLon'] = verrow.LON
-                trudet['VerDepth'] = verrow.DEPTH
-                trudet['VerName'] = verrow.NAME
-                verlist.append(trudet)
+    additionalColumns = [x for x in vertem.columns if x not in cols]
+
+    # verify detections first, autodetections for the remaining events
+    stamps = vertem.STMP.values
+    detMatch = _matchVerified(Dets, stamps, veriBuffer,
+                              np.ones(len(stamps), dtype=bool))
+    autoMatch = _matchVerified(Autos, stamps, veriBuffer, detMatch < 0)
+    verlist = []
+    for table, match in [(Dets, detMatch), (Autos, autoMatch)]:
+        isver = match >= 0
+        if not isver.any():
+            continue
+        table.iloc[match[isver], table.columns.get_loc('Verified')] = True
+        verrows = vertem[isver]
+        trudet = table.iloc[match[isver]].copy()
+        trudet.index = verrows.index  # keep verification file order
+        if includeAllVeriColumns:
+            for col in additionalColumns:
+                if not col in trudet.columns:
+                    trudet[col] = verrows[col].values
+        trudet['VerMag'] = verrows.MAG.values
+        trudet['VerLat'] = verrows.LAT.values
+        trudet['VerLon'] = verrows.LON.values
+        trudet['VerDepth'] = verrows.DEPTH.values
+        trudet['VerName'] = verrows.NAME.values
+        verlist.append(trudet)
     if len(verlist) > 0:
-        verifs = pd.concat(verlist, ignore_index=True)
-        # sort and drop duplicates so each verify event is verified only
-        # once
-        verifs.sort_values(by=['Event', 'DSav'])
-        verifs.drop_duplicates(subset='Event')
+        verifs = pd.concat(verlist).sort_index()
+        verifs.reset_index(drop=True, inplace=True)
         verifs.drop('Verified', axis=1, inplace=True)
     else:
         verifs = pd.DataFrame()
     return verifs
 
 
+def _matchVerified(table, stamps, veriBuffer, use):
+    """
+    Match verification origin times (stamps, where use is True) to the 
+    unverified rows of table (Dets or Autos) whose MSTAMPmin to MSTAMPmax 
+    window, extended by veriBuffer / 2, contains them. The candidate pairs 
+    are found with searchsorted on the sorted MSTAMPmin, each origin time 
+    (in order) takes the unmatched candidate with the highest DSav. Returns
+    an array of the matched table row positions, -1 if not matched
+    """
+    match = -np.ones(len(stamps), dtype=np.int64)
+    if not isinstance(table, pd.DataFrame) or len(table) < 1 or not use.any():
+        return match
+    half = veriBuffer / 2.0
+    order = np.argsort(table.MSTAMPmin.values, kind='mergesort')
+    mins = table.MSTAMPmin.values[order].astype(np.float64)
+    maxs = table.MSTAMPmax.values[order].astype(np.float64)
+    dsav = table.DSav.values[order].astype(np.float64)
+    maxDur = np.max(maxs - mins)
+    vind = np.where(use)[0]
+    # windows that can contain stamp start less than maxDur + half before it
+    lo = np.searchsorted(mins, stamps[vind] - half - maxDur, side='left')
+    hi = np.searchsorted(mins, stamps[vind] + half, side='left')
+    counts = np.maximum(hi - lo, 0)
+    vrep = np.repeat(vind, counts)
+    starts = np.repeat(np.cumsum(counts) - counts, counts)
+    cand = np.repeat(lo, counts) + np.arange(counts.sum()) - starts
+    inWindow = maxs[cand] + half > stamps[vrep]
+    vrep, cand = vrep[inWindow], cand[inWindow]
+    # for each origin time best DSav first, ties go to the first row
+    sortind = np.lexsort((order[cand], -dsav[cand], vrep))
+    verified = table.Verified.values[order].astype(bool)
+    for ver, can in zip(vrep[sortind], cand[sortind]):
+        if match[ver] < 0 and not verified[can]:
+            match[ver] = order[can]
+            verified[can] = True
+    return match
+
+
 def _readVeriFile(veriFile):
+    if isinstance(veriFile, pd.DataFrame):
+        return veriFile.copy()
     try:
         df = pd.read_csv(veriFile)
     except Exception:
@@ -317,201 +469,275 @@ def _readVeriFile(veriFile):
     return df
 
 
-def _buildSQL(PfKey, trigCon, trigParameter, stations,
-              starttime, endtime, tableName):
-    """Function to build a list of SQL commands for loading the database 
-    with desired parameters
+def _buildSQL(con, PfKey, trigCon, trigParameter, stations, starttime,
+              endtime, tableName):
+    """
+    Build the parameterized SQL query (and its parameters) that loads the 
+    detections of tableName meeting the requirements, ordered by station 
+    and time. The Pf thresholds (or stations) are written to temporary 
+    tables of sqlite connection con and joined in the query
     """
-    SQL = []  # init. blank list
-    if not starttime or not endtime:
-        starttime = 0.0
-        endtime = 4500 * 3600 * 24 * 365.25
+    start = obspy.UTCDateTime(starttime).timestamp if starttime else 0.0
+    end = (obspy.UTCDateTime(endtime).timestamp if endtime else
+           4500 * 3600 * 24 * 365.25)
+    if isinstance(stations, string_types):
+        stations = [stations]
+    if isinstance(PfKey, pd.DataFrame):
+        if isinstance(stations, (list, tuple)):
+            PfKey = PfKey[PfKey.Sta.isin(stations)]
+        con.execute('DROP TABLE IF EXISTS temp.pf_thresholds')
+        con.execute('CREATE TEMP TABLE pf_thresholds '
+                    '(Sta TEXT, Name TEXT, DS REAL)')
+        rows = [(str(x), str(y), float(z)) for x, y, z in
+                zip(PfKey.Sta, PfKey.Name, PfKey.DS)]
+        con.executemany('INSERT INTO pf_thresholds VALUES (?, ?, ?)', rows)
+        sql = ('SELECT d.* FROM %s AS d JOIN pf_thresholds AS p ON '
+               'd.Sta = p.Sta AND d.Name = p.Name WHERE d.DS >= p.DS AND '
+               'd.MSTAMPmin > ? AND d.MSTAMPmin < ? '
+               'ORDER BY d.Sta, d.MSTAMPmin') % tableName
+        return sql, [start, end]
+    cond = 'DS' if trigCon == 0 else 'DS_STALTA'
+    params = [trigParameter, start, end]
+    if isinstance(stations, (list, tuple)):
+        con.execute('DROP TABLE IF EXISTS temp.sta_select')
+        con.execute('CREATE TEMP TABLE sta_select (Sta TEXT)')
+        con.executemany('INSERT INTO sta_select VALUES (?)',
+                        [(str(x),) for x in stations])
+        sql = ('SELECT d.* FROM %s AS d JOIN sta_select AS s ON d.Sta = s.Sta'
+               ' WHERE d.%s >= ? AND d.MSTAMPmin >= ? AND d.MSTAMPmin <= ? '
+               'ORDER BY d.Sta, d.MSTAMPmin') % (tableName, cond)
     else:
-        starttime = obspy.UTCDateTime(starttime).timestamp
-        endtime = obspy.UTCDateTime(endtime).timestamp
+        sql = ('SELECT * FROM %s WHERE %s >= ? AND MSTAMPmin >= ? AND '
+               'MSTAMPmin <= ? ORDER BY Sta, MSTAMPmin') % (tableName, cond)
+    return sql, params
 
-    # define stations
-    if isinstance(stations, (list, tuple)):
-        if isinstance(PfKey, pd.DataFrame):
-            PfKey = PfKey[PfKey.Sta.isin(stations)]
+
+def _deleteDetDups(ssDB, trigCon, trigParameter, associateBuffer, starttime,
+                   endtime, stations, tableName, PfKey=None, chunksize=100000):
+    """
+    delete dections of same event, keep only detection with highest 
+    detection statistic. The filtered detections are read from the 
+    database in chunks (ordered by station and time) and reduced as they 
+    are read. Columnar directories (see detex.columnar) are read at once, 
+    only the needed partitions of partitioned directories (see
+    detex.partitioned) are read
+    """
+    if detex.columnar.isColumnar(ssDB):
+        df = _loadColumnarDets(ssDB, PfKey, trigCon, trigParameter, stations,
+                               starttime, endtime, tableName)
+        if df is None:
+            return None
+        return _reduceDups(df, _getDupGroups(df, associateBuffer))
+    if detex.partitioned.isPartitioned(ssDB):
+        start = obspy.UTCDateTime(starttime).timestamp if starttime else None
+        end = obspy.UTCDateTime(endtime).timestamp if endtime else None
+        parts = detex.partitioned.getPartitions(ssDB, tableName, stations,
+                                                start, end)
+        dbs = list(parts.File)  # sorted by station and month
     else:
-        if isinstance(PfKey, pd.DataFrame):
-            stations = PfKey.Sta.values
-        else:
-            stations = ['*']  # no stations definition use all
+        dbs = [ssDB]
+    reduced = []
+    carry = None  # last group of previous chunk, it may continue
+    numGroups = 0
+    for chunk in _iterDetChunks(dbs, trigCon, trigParameter, stations,
+                                starttime, endtime, tableName, PfKey,
+                                chunksize):
+        if carry is not None:
+            chunk = pd.concat([carry, chunk], ignore_index=True)
+        gnum = _getDupGroups(chunk, associateBuffer)
+        last = gnum == gnum[-1]
+        if not last.all():
+            reduced.append(_reduceDups(chunk[~last], gnum[~last] + numGroups))
+        numGroups += gnum[-1] - 1
+        carry = chunk[last].reset_index(drop=True)
+    if carry is not None:
+        reduced.append(_reduceDups(carry, np.ones(len(carry), dtype=int) +
+                                   numGroups))
+    if len(reduced) < 1:  # if no events found
+        return None
+    ssdf = pd.concat(reduced, ignore_index=True)
+    return ssdf
 
+
+def _iterDetChunks(dbs, trigCon, trigParameter, stations, starttime, endtime,
+                   tableName, PfKey, chunksize):
+    """
+    Yield the detections of tableName in the databases dbs (in order)
+    meeting the requirements (see _buildSQL) in chunks of chunksize rows.
+    The databases are only read, the query uses the indexes created by 
+    SubSpace.detex if they exist
+    """
+    for db in dbs:
+        with connect(db) as con:
+            if not detex.util._hasTable(con, tableName):
+                continue
+            sql, params = _buildSQL(con, PfKey, trigCon, trigParameter,
+                                    stations, starttime, endtime, tableName)
+            for chunk in pd.read_sql(sql, con, params=params,
+                                     chunksize=chunksize):
+                if len(chunk) > 0:
+                    yield detex.util._applySchema(chunk, tableName)
+
+
+def _loadColumnarDets(path, PfKey, trigCon, trigParameter, stations,
+                      starttime, endtime, tableName):
+    """
+    Load the detections of tableName from columnar directory path meeting 
+    the same requirements as the query of _buildSQL, sorted by station and
+    time. None if there are none
+    """
+    start = obspy.UTCDateTime(starttime).timestamp if starttime else None
+    end = obspy.UTCDateTime(endtime).timestamp if endtime else None
+    if isinstance(stations, string_types):
+        stations = [stations]
+    if not isinstance(stations, (list, tuple)):
+        stations = None
+    minDS, minSTALTA = None, None
     if isinstance(PfKey, pd.DataFrame):
-        for num, row in PfKey.iterrows():
-            # make sure appropraite table is used for either subspace or
-            # singleton
-            table = 'sg_df' if 'SG' in row.Name else 'ss_df'
-            sqstr = ('SELECT %s FROM %s WHERE Sta="%s" AND Name="%s" AND  '
-                     'DS>=%f AND MSTAMPmin>%f AND MSTAMPmin<%f') % ('*', table,
-                                                                    row.Sta, row.Name, row.DS, starttime, endtime)
-            SQL.append(sqstr)
+        if stations is not None:
+            PfKey = PfKey[PfKey.Sta.isin(stations)]
+        stations = list(PfKey.Sta.unique())
+        minDS = PfKey.DS.min() if len(PfKey) else None
+    elif trigCon == 0:
+        minDS = trigParameter
     else:
-        if trigCon == 0:
-            cond = 'DS'
-        elif trigCon == 1:
-            cond = 'DS_STALTA'
-        for sta in stations:
-            if sta == '*':
-                sqstr = ('SELECT %s FROM %s WHERE %s >= %s AND MSTAMPmin>=%f '
-                         'AND MSTAMPmin<=%f') % ('*', tableName, cond,
-                                                 trigParameter, starttime, endtime)
-                SQL.append(sqstr)
-            else:
-                sqstr = ('SELECT %s FROM %s WHERE %s="%s" AND %s >= %s AND '
-                         'MSTAMPmin>=%f AND MSTAMPmin<=%f') % ('*', tableName,
-                                                               'Sta', sta, cond, trigParameter, starttime, endtime)
-                SQL.append(sqstr)
-    return SQL
+        minSTALTA = trigParameter
+    df = detex.columnar.readDetections(path, tableName, stations, start, end,
+                                       minDS, minSTALTA)
+    if df is None:
+        return None
+    if isinstance(PfKey, pd.DataFrame):  # per subspace thresholds
+        th = pd.merge(df[['Sta', 'Name']], PfKey[['Sta', 'Name', 'DS']],
+                      how='left', on=['Sta', 'Name']).DS.values
+        df = df[df.DS.values >= th]
+    if len(df) < 1:
+        return None
+    df = df.sort_values(by=['Sta', 'MSTAMPmin'], kind='mergesort')
+    return df.reset_index(drop=True)
 
 
-def _deleteDetDups(ssDB, trigCon, trigParameter, associateBuffer, starttime,
-                   endtime, stations, tableName, PfKey=None):
+def _getDupGroups(df, associateBuffer):
     """
-    delete dections of same event, keep only detection with highest 
-    detection statistic
+    Return group numbers (starting at 1) of detections in df (sorted by 
+    station and time) that are within associateBuffer of the previous 
+    detection on the same station
     """
-    sslist = []
-    SQLstr = _buildSQL(PfKey, trigCon, trigParameter,
-                       starttime, stations, endtime, tableName)
-    for sql in SQLstr:
-        loadedRes = detex.util.loadSQLite(ssDB, tableName, sql=sql)
-        if isinstance(loadedRes, pd.DataFrame):
-            sslist.append(loadedRes)
-    if len(sslist) < 1:  # if no events found
-        return None
-    try:
-        ssdf = pd.concat(sslist, ignore_index=True)
-    except ValueError:
-        msg = 'Cant create detResults instance, no detections meet all reqs'
-        detex.log(__name__, msg, level='error')
-    ssdf.reset_index(drop=True, inplace=True)
-    ssdf.sort_values(by=['Sta', 'MSTAMPmin'], inplace=True)
-    con1 = ((ssdf.MSTAMPmin - associateBuffer) > ssdf.MSTAMPmax.shift())
-    con2 = ssdf.Sta != ssdf.Sta.shift()
-    ssdf['Gnum'] = (con1 | con2).cumsum()
-    ssdf.sort_values(by=['Gnum', 'DS'], inplace=True)
-    ssdf.drop_duplicates(subset='Gnum', keep='last', inplace=True)
-    ssdf.reset_index(inplace=True, drop=True)
+    con1 = ((df.MSTAMPmin - associateBuffer) > df.MSTAMPmax.shift())
+    con2 = df.Sta != df.Sta.shift()
+    return (con1 | con2).cumsum().values
 
-    return ssdf
+
+def _reduceDups(df, gnum):
+    """
+    Keep only the detection with the highest DS in each group (gnum)
+    """
+    df = df.copy()
+    df['Gnum'] = gnum
+    df.sort_values(by=['Gnum', 'DS'], inplace=True, kind='mergesort')
+    df.drop_duplicates(subset='Gnum', keep='last', inplace=True)
+    return df
 
 
 def _associateDetections(ssdf, associateReq, requiredNumStations,
                          associateBuffer, ss_info, temkey, exceptionalThreshold):
     """
-    Associate detections together using pandas groupby return dataframe of 
-    detections and autocorrelations
+    Associate detections together, return dataframe of detections and 
+    autocorrelations. Detections are grouped when they overlap (within 
+    associateBuffer) the previous detection in time, groups that meet the
+    station requirements are matched against the sorted template origin 
+    times to find autocorrelations and summarized with groupby aggregations
     """
-    ssdf.sort_values(by='MSTAMPmin', inplace=True)
-    ssdf.reset_index(drop=True, inplace=True)
     cols = ['Event', 'DSav', 'DSmax', 'NumStations', 'DS_STALTA', 'MSTAMPmin',
             'MSTAMPmax', 'Mag', 'ProEnMag', 'Verified', 'Dets', ]
+    ssdf = ssdf.sort_values(by='MSTAMPmin')
+    ssdf.reset_index(drop=True, inplace=True)
     if isinstance(ss_info, pd.DataFrame) and associateReq > 0:
         ssdf = pd.merge(ssdf, ss_info, how='inner', on=['Sta', 'Name'])
+    if len(ssdf) < 1:
+        return [pd.DataFrame(columns=cols), pd.DataFrame(columns=cols)]
     gs = (ssdf.MSTAMPmin - associateBuffer > ssdf.MSTAMPmax.shift()).cumsum()
-    groups = ssdf.groupby(gs)
-    autolist = [pd.DataFrame(columns=cols)]
-    detlist = [pd.DataFrame(columns=cols)]
-    temkey['STMP'] = np.array([obspy.core.UTCDateTime(x).timestamp for x in temkey.TIME])
-    temcop = temkey.copy()
-
-    # if there is a required number of shared events
-    if isinstance(ss_info, pd.DataFrame) and associateReq > 0:
-        for num, g in groups:
-            g = _checkSharedEvents(g)
-            # Make sure detections occur on the required number of stations
-            if len(set(g.Sta)) >= requiredNumStations:
-                isauto, autoDF = _createAutoTable(g, temcop, cols)
-                if isauto:
-                    autolist.append(autoDF)
-                else:
-                    detdf = _createDetTable(g, cols)
-                    detlist.append(detdf)
-    else:
-        for num, g in groups:
-            # Make sure detections occur on the required number of stations
-            con1 = len(set(g.Sta)) >= requiredNumStations
-            if not con1 and isinstance(exceptionalThreshold, float):
-                con2 = g.DS.max() >= exceptionalThreshold
-                con1 = con1 or con2
-            elif not con1 and isinstance(exceptionalThreshold, dict):
-                con2 = _check_if_exceptional(g, exceptionalThreshold)
-                con1 = con1 or con2
-            if con1:
-                # If there is more than one single or subpspace representing a
-                # station on each event only keep the one with highest DS
-                if len(set(g.Sta)) < len(g.Sta):
-                    g = g.sort_values(by='DS').drop_duplicates(
-                        subset='Sta', keep='last').sort_values('MSTAMPmin')
-                isauto, autoDF = _createAutoTable(g, temcop, cols, associateBuffer)
-                if isauto:
-                    autolist.append(autoDF)
-                    # temcop=temcop[temcop.NAME!=autoDF.iloc[0].Event]
-                else:
-                    detdf = _createDetTable(g, cols)
-                    detlist.append(detdf)
-    detTable = pd.concat(detlist, ignore_index=True)
-
-    autoTable = pd.concat(autolist, ignore_index=True)
+    gs = gs.values
+    keep = _getAssociatedGroups(ssdf, gs, requiredNumStations,
+                                exceptionalThreshold)
+    df = _keepBestPerStation(ssdf[keep], gs[keep])
+    gs = gs[df.index.values]
+
+    # summarize each group
+    grouped = df.groupby(gs)
+    summary = pd.DataFrame(index=grouped.size().index, columns=cols)
+    summary['DSav'] = grouped.DS.mean()
+    summary['DSmax'] = grouped.DS.max()
+    summary['NumStations'] = grouped.size()
+    summary['DS_STALTA'] = grouped.DS_STALTA.mean()
+    summary['MSTAMPmin'] = grouped.MSTAMPmin.min()
+    summary['MSTAMPmax'] = grouped.MSTAMPmax.max()
+    summary['Mag'] = grouped.Mag.median()  # nan if all mags are nan
+    summary['ProEnMag'] = grouped.ProEnMag.median()
+    summary['Verified'] = False
+    starts = np.searchsorted(gs, summary.index.values, side='left')
+    ends = np.searchsorted(gs, summary.index.values, side='right')
+    summary['Dets'] = [df.iloc[x:y] for x, y in zip(starts, ends)]
+
+    # detections within associateBuffer of a template origin time are autos
+    autoEvents = _getAutoEvents(df, gs, temkey, associateBuffer)
+    isauto = summary.index.isin(autoEvents.index)
+    mid = (grouped.MSTAMPmin.mean() + grouped.MSTAMPmax.mean()) / 2.
+    names = pd.to_datetime(mid, unit='s').dt.strftime('%Y-%m-%dT%H-%M-%S')
+    summary['Event'] = np.where(isauto, autoEvents.reindex(summary.index),
+                                names)
+    detTable = summary[~isauto].reset_index(drop=True)
+    autoTable = summary[isauto].reset_index(drop=True)
     return [detTable, autoTable]
 
 
-def _check_if_exceptional(g, exth):
-    gg = g.copy()
-    gg['exceptional'] = [exth.get(x.Sta, 100) for _, x in gg.iterrows()]
-    #    if any((gg['DS'] >= gg['exceptional']) & (gg['DS'] <= 1.01)) :
-    return any((gg['DS'] >= gg['exceptional']) & (gg['DS'] <= 1.01))
-
-
-# Look at the union of the events and delete those that do not meet the
-# requirements
-def _checkSharedEvents(g):
-    pass  # TODO figure out how to incorporate an association requirement
-
-
-def _createDetTable(g, cols):
-    mag, proEnMag = _getMagnitudes(g)
-    utc = obspy.UTCDateTime(np.mean([g.MSTAMPmin.mean(), g.MSTAMPmax.mean()]))
-    event = str(utc).replace(':', '-').split('.')[0]
-    data = [event, g.DS.mean(), g.DS.max(), len(g), g.DS_STALTA.mean(),
-            g.MSTAMPmin.min(), g.MSTAMPmax.max(), mag, proEnMag, False, g]
-    detDF = pd.DataFrame([data], columns=cols)
-    return detDF
-
-
-def _createAutoTable(g, temkey, cols, associateBuffer):
-    isauto = False
-    for num, row in g.iterrows():  # find out if this is an auto detection
-        con1 = temkey.STMP + associateBuffer > row.MSTAMPmin
-        con2 = temkey.STMP - associateBuffer < row.MSTAMPmax
-        temtemkey = temkey[con1 & con2]
-        if len(temtemkey) > 0:
-            isauto = True
-            event = temtemkey.iloc[0].NAME
-    if isauto:
-        mag, proEnMag = _getMagnitudes(g)
-        data = [event, g.DS.mean(), g.DS.max(), len(g), g.DS_STALTA.mean(),
-                g.MSTAMPmin.min(), g.MSTAMPmax.max(), mag, proEnMag, False, g]
-        autoDF = pd.DataFrame([data], columns=cols)
-        return isauto, autoDF
-    else:
-        return isauto, pd.DataFrame()
+def _getAssociatedGroups(df, gs, requiredNumStations, exceptionalThreshold):
+    """
+    Return a boolean array, True for detections in groups (gs) that occur 
+    on at least requiredNumStations stations or have an exceptional 
+    detection statistic
+    """
+    numStations = df.groupby(gs).Sta.nunique()
+    groupKeep = numStations >= requiredNumStations
+    if isinstance(exceptionalThreshold, float):
+        groupKeep |= df.groupby(gs).DS.max() >= exceptionalThreshold
+    elif isinstance(exceptionalThreshold, dict):
+        thresh = df.Sta.map(exceptionalThreshold).fillna(100).values
+        exceptional = (df.DS.values >= thresh) & (df.DS.values <= 1.01)
+        groupKeep |= pd.Series(exceptional).groupby(gs).any()
+    return groupKeep.reindex(gs).values
+
+
+def _keepBestPerStation(df, gs):
+    """
+    If there is more than one single or subspace representing a station in
+    a group (gs) only keep the one with highest DS, df must be sorted by 
+    MSTAMPmin and have a sorted index
+    """
+    key = pd.DataFrame({'Gnum': gs, 'Sta': df.Sta.values, 'DS': df.DS.values},
+                       index=df.index)
+    key = key.sort_values(by='DS', kind='mergesort')
+    best = key[~key.duplicated(subset=['Gnum', 'Sta'], keep='last')].index
+    return df.loc[np.sort(best.values)]
 
 
-def _getMagnitudes(g):
-    if any([not np.isnan(x) for x in g.Mag]):
-        mag = np.nanmedian(g.Mag)
-    else:
-        mag = np.NaN
-    if any([not np.isnan(x) for x in g.ProEnMag]):
-        PEmag = np.nanmedian(g.ProEnMag)
+def _getAutoEvents(df, gs, temkey, associateBuffer):
+    """
+    Return a Series of template names indexed by the groups (gs) that have
+    a template origin time within associateBuffer of a detection. The 
+    sorted origin times of a DetexKey are only built once
+    """
+    if isinstance(temkey, detex.util.DetexKey):
+        stamps, names = temkey.getOriginTimes()
     else:
-        PEmag = np.NaN
-    return mag, PEmag
+        stamps, names = detex.util._sortOriginTimes(temkey)
+    # templates with MSTAMPmin - buffer < STAMP < MSTAMPmax + buffer
+    lo = np.searchsorted(stamps, df.MSTAMPmin.values - associateBuffer,
+                         side='right')
+    hi = np.searchsorted(stamps, df.MSTAMPmax.values + associateBuffer,
+                         side='left')
+    match = lo < hi
+    events = pd.Series(names[lo[match]], index=gs[match])
+    return events.groupby(level=0).last()
 
 
 def _loadSSdb(ssDB, trigCon, trigParameter, sta=None):
@@ -575,16 +801,27 @@ def _checkExistence(existList):
 
 
 def _loadInfoDataFrames(ssDB):
-    ss_info = detex.util.loadSQLite(ssDB, 'ss_info')  # load subspace info
+    ss_info = _loadTable(ssDB, 'ss_info')  # load subspace info
     if isinstance(ss_info, pd.DataFrame):
         ss_info['NumEvents'] = [len(row.Events.split(','))
                                 for num, row in ss_info.iterrows()]
-    sg_info = detex.util.loadSQLite(ssDB, 'sg_info')
+    sg_info = _loadTable(ssDB, 'sg_info')
     if isinstance(sg_info, pd.DataFrame):
         sg_info['NumEvents'] = 1
     return ss_info, sg_info
 
 
+def _loadTable(ssDB, tableName):
+    """
+    Load tableName from ssDB, an sqlite database or a columnar directory
+    """
+    if detex.columnar.isColumnar(ssDB):
+        return detex.columnar.readTable(ssDB, tableName)
+    if detex.partitioned.isPartitioned(ssDB):
+        return detex.partitioned.readTable(ssDB, tableName)
+    return detex.util.loadSQLite(ssDB, tableName)
+
+
 class SSResults(object):
     def __init__(self, Dets, Autos, Vers, ss_info, ss_filt,
                  temkey, stakey, templateKey, fetcher):
@@ -603,7 +840,8 @@ class SSResults(object):
     def writeDetections(self, onlyVerified=None, minDS=None, minMag=None,
                         eventDir='EventWaveForms', updateTemKey=True,
                         temkeyPath=None, timeBeforeOrigin=1 * 60,
-                        timeAfterOrigin=4 * 60, waveFormat="mseed"):
+                        timeAfterOrigin=4 * 60, waveFormat="mseed",
+                        processes=1):
         """
         Function to make all of the eligable new detections templates. New 
         event directories will be added to eventDir and the template key 
@@ -637,6 +875,10 @@ class SSResults(object):
             Seconds after predicted origin to get
         waveFormat = str
             Format to save files, "mseed", "pickle", "sac", and "Q" supported
+        processes : int or None
+            The number of processes used to fetch and write waveforms, the
+            detections on each station are handled by one process. If None
+            use all cores
         """
         dets = self.Dets.copy()
         if onlyVerified:
@@ -652,8 +894,9 @@ class SSResults(object):
         temkey = self.TemplateKey.copy()
 
         detTem = pd.DataFrame(index=range(len(dets)), columns=temkey.columns)
+        requests = {}  # (net, sta): list of (path, start, stop, event)
 
-        for num, row in dets.iterrows():  # loop through detections and save
+        for num, row in dets.iterrows():  # loop through detections
             origin = obspy.UTCDateTime(np.mean([row.MSTAMPmax, row.MSTAMPmin]))
             Evename = row.Event
             eveDirName = 'd' + Evename
@@ -661,12 +904,8 @@ class SSResults(object):
             # if the directory doesnt exists create it
             if not os.path.exists(os.path.join(eventDir, eveDirName)):
                 os.makedirs(os.path.join(eventDir, eveDirName))
-            else:  # else delete its index so it will be reindexed
-                index_path = os.path.join(eventDir, 'index.db')
-                if os.path.exists(index_path):
-                    os.remove(index_path)
 
-            # loop through each station and load stream, then save
+            # add the waveform of each station to the requests
             for stanum, starow in self.StationKey.iterrows():
                 net, sta = starow.NETWORK, starow.STATION
                 start = origin - timeBeforeOrigin
@@ -674,21 +913,25 @@ class SSResults(object):
                 ext = detex.getdata.formatKey[waveFormat]
                 fname = '.'.join([net, sta, Evename, ext])
                 path = os.path.join(eventDir, eveDirName, fname)
-                try:
-                    st = self.fetcher.getStream(start, stop, net, sta)
-                    st.write(path, waveFormat)
-                except Exception:
-                    msg = ('Could not write and save %s for station %s' % (
-                        Evename, sta))
-                    detex.log(__name__, msg, level='warning', pri=True)
+                requests.setdefault((net, sta), []).append((path, start, stop,
+                                                            Evename))
 
             detTem.loc[num, 'NAME'] = eveDirName
             time = str(obspy.UTCDateTime(origin.timestamp))
             detTem.loc[num, 'TIME'] = time.replace(':', '-').replace('Z', '')
             detTem.loc[num, 'MAG'] = row.Mag
 
+        # fetch and save waveforms, then add them to the index
+        written = detex.getdata.extractWaveforms(self.fetcher, requests,
+                                                 waveFormat, processes)
+        detex.getdata.updateIndex(eventDir, written)
+
         temkeyNew = pd.concat([temkey, detTem], ignore_index=True)
         temkeyNew.reset_index(inplace=True, drop=True)
+        # drop the time stamp columns added by readKey, they are derived
+        stampCols = detex.util.time_columns['template'].values()
+        temkeyNew.drop([x for x in stampCols if x in temkeyNew.columns],
+                       axis=1, inplace=True)
         temkeyNew.to_csv(temkeyPath, index=False)
 
     def __repr__(self):
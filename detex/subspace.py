@@ -36,6 +36,11 @@ import sys
 from scipy.cluster.hierarchy import dendrogram, fcluster
 from detex.detect import _SSDetex
 
+try:  # python 2/3 compat
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
 pd.options.mode.chained_assignment = None  # mute setting copy warning
 
 # warnings.filterwarnings('error') #uncomment this to make all warnings errors
@@ -258,13 +263,27 @@ class ClusterStream(object):
         for cl in self.clusters:
             cl.plotEvents(projection, plotSingles, **kwargs)
 
-    def write(self):  # uses pickle to write class to disk
-        """
-        Write instance to file (name is the filename attribute)
+    def write(self, filename=None, binary=False):
         """
-        msg = 'writing ClusterStream instance as %s' % self.filename
+        Write instance to disk
+
+        Parameters
+        ----------
+        filename : None or str
+            Path of the file (or directory if binary) to create, if None
+            the filename attribute is used
+        binary : bool
+            If True write a directory with arrays stored as raw binary files
+            (see detex.persist) which loads much faster than a pickle for 
+            large instances, else pickle the instance
+        """
+        filename = self.filename if filename is None else filename
+        msg = 'writing ClusterStream instance as %s' % filename
         detex.log(__name__, msg, level='info', pri=True)
-        cPickle.dump(self, open(self.filename, 'wb'))
+        if binary:
+            detex.persist.writeBinary(self, filename)
+        else:
+            cPickle.dump(self, open(filename, 'wb'))
 
     def __getitem__(self, key):  # allows indexing of children Cluster objects
         if isinstance(key, int):
@@ -726,8 +745,15 @@ class SubSpace(object):
         self.singletons = singlesDict
         self.dtype = dtype
         self.Pf = Pf
-        self.ssStations = self.subspaces.keys()
-        self.singStations = self.singles.keys()
+        self._setStations()
+
+    def _setStations(self):
+        """
+        Set the station lists and lookup dicts from the subspace and singles
+        dicts
+        """
+        self.ssStations = list(self.subspaces.keys())
+        self.singStations = list(self.singles.keys())
         self.Stations = list(set(self.ssStations) | set(self.singStations))
         self.Stations.sort()
         self._stakey2 = {x: x for x in self.ssStations}
@@ -735,12 +761,19 @@ class SubSpace(object):
 
     ################################ Validate Cluster functions
 
-    def validateClusters(self):
+    def validateClusters(self, maxLag=0):
         """
         Method to check for misaligned waveforms and discard those that no 
         longer meet the required correlation coeficient for each cluster. 
         See Issue 25 (www.github.com/d-chambers/detex) for why this might 
         be useful.
+
+        Parameters
+        ----------
+        maxLag : int
+            The maximum lag (in samples of each channel) at which the 
+            trimmed aligned waveforms are compared, 0 only uses the zero 
+            lag correlation coefficient
         """
         msg = 'Validating aligned (and trimmed) waveforms in each cluster'
         detex.log(__name__, msg, level='info', pri=True)
@@ -757,14 +790,17 @@ class SubSpace(object):
                 else:
                     start = 0
                     stop = -1
-                for ev1num, ev1 in enumerate(row.Events[:-1]):
-                    ccs = []  # blank list for storing ccs of aligned WFs
-                    for ev2 in row.Events[ev1num + 1:]:
-                        t = row.AlignedTD[ev1][start: stop]
-                        s = row.AlignedTD[ev2][start: stop]
-                        maxcc = detex.construct.fast_normcorr(t, s)
-                        ccs.append(maxcc)
-                    if len(ccs) > 0 and max(ccs) < ccreq:
+                events = list(row.Events)
+                if len(events) < 2:
+                    continue
+                trimed = _stackRows(row.AlignedTD, events, start, stop)
+                Nc = list(row.Stats.values())[0]['Nc']
+                ccs = _pairwiseCC(trimed, maxLag, Nc)
+                # each event is compared to the events after it
+                ccs[np.tril_indices(len(events))] = -np.inf
+                best = ccs.max(axis=1)
+                for ev1, cc in zip(events[:-1], best[:-1]):
+                    if cc < ccreq:
                         msg = (('%s fails validation check or is ill-aligned '
                                 'on station %s, removing') % (ev1, row.Station))
                         detex.log(__name__, msg, pri=True)
@@ -785,7 +821,8 @@ class SubSpace(object):
 
     def SVD(self, selectCriteria=2, selectValue=0.9, conDatNum=100,
             threshold=None, normalize=False, useSingles=True,
-            validateWaveforms=True, backupThreshold=None, **kwargs):
+            validateWaveforms=True, backupThreshold=None, svdMethod='full',
+            **kwargs):
         """
         Function to perform SVD on the alligned waveforms and select which 
         of the SVD basis are to be used in event detection. Also assigns 
@@ -864,17 +901,33 @@ class SubSpace(object):
             A backup threshold to use if approximation fails. Typically,
             using the default detex settings, a reasonable value would be
             0.25
+        svdMethod : str
+            'full' to calculate the complete SVD of each subspace or 
+            'randomized' to only calculate the leading singular vectors 
+            with a randomized (truncated) SVD. The rank is increased until
+            the basis vectors needed by selectCriteria are found (the 
+            average fractional energy reaches selectValue for 
+            selectCriteria 2 and 3), so only those are stored. Useful for 
+            subspaces with many events.
             
         kwargs are passed to the getFAS call (if used)
         """
 
         # make sure user defined options are kosher
         self._checkSelection(selectCriteria, selectValue, threshold)
+        if svdMethod not in ['full', 'randomized']:
+            msg = "svdMethod must be 'full' or 'randomized'"
+            detex.log(__name__, msg, level='error', e=ValueError)
+        # kept so addEvents can select basis vectors and thresholds the same
+        self.selectCriteria = selectCriteria
+        self.selectValue = selectValue
+        self.svdThreshold = threshold
+        self.normalize = normalize
+        self.svdMethod = svdMethod
         # Iterate through all subspaces defined by stations
         for station in self.ssStations:
             for ind, row in self.subspaces[station].iterrows():
                 self.subspaces[station].UsedSVDKeys[ind] = []
-                svdDict = {}  # initialize dict to put SVD vectors in
                 keys = sorted(row.Events)
                 arr, basisLength = self._trimGroups(ind, row, keys, station)
                 if basisLength == 0:
@@ -887,13 +940,16 @@ class SubSpace(object):
                     arr = np.array([x / np.linalg.norm(x) for x in arr])
                 tparr = np.transpose(arr)
                 # perform SVD
-                U, s, Vh = scipy.linalg.svd(tparr, full_matrices=False)
-                # make dict with sing. value as key and sing. vector as value
-                for einum, eival in enumerate(s):
-                    svdDict[eival] = U[:, einum]
+                if svdMethod == 'full':
+                    U, s, Vh = scipy.linalg.svd(tparr, full_matrices=False)
+                    fracEnergy = self._getFracEnergy(ind, row, None, U)
+                else:
+                    U, s, fracEnergy = self._truncatedSVD(
+                        ind, row, tparr, selectCriteria, selectValue)
+                # sing. values as keys and sing. vectors as rows
+                svdDict = ArrayDict(s, np.transpose(U))
                 # asign Parameters back to subspace dataframes
                 self.subspaces[station].SVD[ind] = svdDict  # assign SVD
-                fracEnergy = self._getFracEnergy(ind, row, svdDict, U)
 
                 usedBasis = self._getUsedBasis(ind, row, svdDict, fracEnergy,
                                                selectCriteria, selectValue)
@@ -924,22 +980,20 @@ class SubSpace(object):
         return an array of the aligned waveforms for the SVD to act on
         """
         stkeys = row.SampleTrims.keys()
-        aliTD = row.AlignedTD
         if 'Starttime' in stkeys and 'Endtime' in stkeys:
             stim = row.SampleTrims['Starttime']
             etim = row.SampleTrims['Endtime']
             if stim < 0:  # make sure stim is not less than 0
                 stim = 0
-            Arr = np.vstack([aliTD[x][stim:etim] -
-                             np.mean(aliTD[x][stim:etim]) for x in keys])
-            basisLength = Arr.shape[1]
+            Arr = _stackRows(row.AlignedTD, keys, stim, etim)
         else:
             msg = ('No trim times for %s and station %s, try running '
                    'pickTimes or attachPickTimes' % (row.Name, station))
 
             detex.log(__name__, msg, level='warn', pri=True)
-            Arr = np.vstack([aliTD[x] - np.mean(aliTD[x]) for x in keys])
-            basisLength = Arr.shape[1]
+            Arr = _stackRows(row.AlignedTD, keys)
+        Arr = Arr - np.mean(Arr, axis=1)[:, np.newaxis]
+        basisLength = Arr.shape[1]
         return Arr, basisLength
 
     def _checkSelection(self, selectCriteria, selectValue, threshold):
@@ -965,35 +1019,49 @@ class SubSpace(object):
                 msg = 'Unsupported type for threshold, must be None or float'
                 detex.log(__name__, msg, level='error', e=ValueError)
 
+    def _truncatedSVD(self, ind, row, tparr, selectCriteria, selectValue):
+        """
+        Calculate the leading left singular vectors and singular values of 
+        tparr with a randomized SVD, doubling the rank until enough basis 
+        vectors for selectCriteria are found. Returns U, s and the 
+        fractional energy dict
+        """
+        numEvents = tparr.shape[1]
+        if selectCriteria == 4:
+            rank = min(selectValue + 1, numEvents)
+        else:
+            rank = min(8, numEvents)
+        while True:
+            U, s = _randomizedSVD(tparr, rank)
+            fracEnergy = self._getFracEnergy(ind, row, None, U)
+            if (rank >= numEvents or selectCriteria == 4 or
+                    fracEnergy['Average'][-1] >= selectValue):
+                return U, s, fracEnergy
+            rank = min(2 * rank, numEvents)
+
     def _getFracEnergy(self, ind, row, svdDict, U):
         """
         calculates the % energy capture for each stubspace for each possible
         dimension of rep. (up to # of events that go into the subspace)
         """
-        fracDict = {}
         keys = row.Events
-        svales = svdDict.keys()
-        svales.sort(reverse=True)
         stkeys = row.SampleTrims.keys()  # dict defining sample trims
-        for key in keys:
-            aliTD = row.AlignedTD[key]  # aligned waveform for event key
-            if 'Starttime' in stkeys and 'Endtime' in stkeys:
-                start = row.SampleTrims['Starttime']  # start of trim in samps
-                end = row.SampleTrims['Endtime']  # end of trim in samps
-                aliwf = aliTD[start: end]
-            else:
-                aliwf = aliTD
-            Ut = np.transpose(U)  # transpose of basis vects
-            # normalized dot product (mat. mult.) 
-            normUtAliwf = scipy.dot(Ut, aliwf) / scipy.linalg.norm(aliwf)
-            # add 0% energy capture for dim of 0
-            repvect = np.insert(np.square(normUtAliwf), 0, 0)
-            # cumul. energy captured for increasing dim. reps
-            cumrepvect = [np.sum(repvect[:x + 1]) for x in range(len(repvect))]
-            fracDict[key] = cumrepvect  # add cumul. to keys
+        if 'Starttime' in stkeys and 'Endtime' in stkeys:
+            start = row.SampleTrims['Starttime']  # start of trim in samps
+            end = row.SampleTrims['Endtime']  # end of trim in samps
+        else:
+            start, end = None, None
+        aliwfs = _stackRows(row.AlignedTD, keys, start, end)
+        # normalized projections of every event onto every basis vector
+        norms = np.linalg.norm(aliwfs, axis=1)[:, np.newaxis]
+        normUtAliwf = np.dot(aliwfs, U) / norms
+        # cumul. energy captured for increasing dim. reps (0 for dim of 0)
+        cumrep = np.cumsum(np.square(normUtAliwf), axis=1)
+        cumrep = np.hstack([np.zeros((len(keys), 1)), cumrep])
+        fracDict = {key: cumrep[num] for num, key in enumerate(keys)}
         # get average and min energy capture, append value to dict
-        fracDict['Average'] = np.average([fracDict[x] for x in keys], axis=0)
-        fracDict['Minimum'] = np.min([fracDict[x] for x in keys], axis=0)
+        fracDict['Average'] = np.average(cumrep, axis=0)
+        fracDict['Minimum'] = np.min(cumrep, axis=0)
         return (fracDict)
 
     def _getUsedBasis(self, ind, row, svdDict, cumFracEnergy,
@@ -1004,20 +1072,209 @@ class SubSpace(object):
         keys = svdDict.keys()
         keys.sort(reverse=True)
         if selectCriteria in [1, 2, 3]:
-            # make sure last element is exactly 1
-            cumFracEnergy['Average'][-1] = 1.00
-            ndim = np.argmax(cumFracEnergy['Average'] >= selectValue)
+            average = cumFracEnergy['Average']
+            # a full rank basis captures all the energy, make sure last
+            # element is exactly 1 (a truncated one keeps its real value)
+            rank = min(len(row.Events), len(svdDict[keys[0]]))
+            if len(average) == rank + 1:
+                average[-1] = 1.00
+            if average[-1] < selectValue:
+                msg = (('the %d basis vectors of %s only capture %.3f of the '
+                        'average energy (selectValue is %s), using all of '
+                        'them') % (len(keys), row.Name, average[-1],
+                                   selectValue))
+                detex.log(__name__, msg, level='warn', pri=True)
+                ndim = len(average) - 1
+            else:
+                ndim = np.argmax(average >= selectValue)
             selKeys = keys[:ndim]  # selected keys
         if selectCriteria == 4:
             selKeys = keys[:selectValue + 1]
         return selKeys
 
+    def addEvents(self, clust, conDatNum=100, threshold=None,
+                  backupThreshold=None, normalize=None, **kwargs):
+        """
+        Add the events that joined the clusters of existing subspaces in an
+        updated ClusterStream instance (see detex.construct.updateCluster)
+        without rebuilding the subspaces. Each new event is aligned by 
+        correlating it with the mean of the aligned waveforms of the 
+        subspace and, if the SVD has been performed, the basis vectors are 
+        updated with a low rank update of the SVD (recalculated with the 
+        randomized SVD if svdMethod was 'randomized' as the stored basis is
+        truncated). The basis vectors used and the thresholds of the 
+        updated subspaces (only) are selected again with the selectCriteria
+        and selectValue of the SVD call.
+
+        Parameters
+        ----------
+        clust : instance of detex.subspace.ClusterStream
+            The updated cluster instance, the waveforms of the new events
+            are loaded if it does not hold them
+        conDatNum : int
+            The number of continuous data chunks used to estimate the null
+            space of the updated subspaces (see getFAS)
+        threshold : None or float
+            If a float use it as the threshold of updated subspaces rather
+            than fitting the null space, if None the threshold passed to
+            the SVD call (if any) is used
+        backupThreshold : None or float
+            A backup threshold to use if approximation fails
+        normalize : None or bool
+            If None use the value used in the SVD call
+
+        kwargs are passed to the getFAS call
+
+        Note
+        ----------
+        Clusters that do not contain an existing subspace or that merge 
+        several subspaces are not handled (a warning is logged), call 
+        createSubSpace to rebuild all subspaces if these are needed. 
+        Singles that join a subspace are removed from the singles.
+        """
+        if normalize is None:
+            normalize = getattr(self, 'normalize', False)
+        selectCriteria = getattr(self, 'selectCriteria', 2)
+        selectValue = getattr(self, 'selectValue', 0.9)
+        svdMethod = getattr(self, 'svdMethod', 'full')
+        updated = {}  # station: indexes of the updated subspaces
+        for sta in self.ssStations:
+            crow = clust.trdf[clust.trdf.Station == sta]
+            if len(crow) < 1:
+                msg = '%s not in clust, skipping' % sta
+                detex.log(__name__, msg, level='warn', pri=True)
+                continue
+            crow = crow.iloc[0]
+            clusts = clust[sta].clusts
+            oldEvents = set(self.clusters[sta].key)
+            singles = set()
+            if sta in self.singles:
+                singles = set(y for x in self.singles[sta].Events for y in x)
+            subs = self.subspaces[sta]
+            member = {eve: ind for ind, row in subs.iterrows()
+                      for eve in row.Events}
+            for ind, row in subs.iterrows():
+                events = set(row.Events)
+                clus = [x for x in clusts if events.issubset(x)]
+                if not clus:
+                    continue
+                # events that were not clustered before (new or singles)
+                add = sorted(x for x in set(clus[0]) - events
+                             if x not in oldEvents or x in singles)
+                if any(x in member for x in clus[0] if x not in events):
+                    msg = (('%s on %s now merges with other subspaces, call '
+                            'createSubSpace to rebuild it') % (row.Name, sta))
+                    detex.log(__name__, msg, level='warn', pri=True)
+                    continue
+                if not add:
+                    continue
+                msg = 'adding %s to %s on %s' % (add, row.Name, sta)
+                detex.log(__name__, msg, level='info')
+                mptd, chans = detex.construct._getEventWFs(clust, crow, add,
+                                                           self.dtype)
+                added = self._addToSubSpace(sta, ind, add, mptd, chans,
+                                            crow.Stats, clust.temkey,
+                                            normalize, selectCriteria,
+                                            selectValue, svdMethod)
+                if added and self.subspaces[sta].SVDdefined[ind]:
+                    updated.setdefault(sta, []).append(ind)
+            if sta in self.singles:  # drop singles now in a subspace
+                inSubs = set(y for x in self.subspaces[sta].Events for y in x)
+                sing = self.singles[sta]
+                keep = [not set(x) & inSubs for x in sing.Events]
+                self.singles[sta] = sing[keep].reset_index(drop=True)
+        self.clusters = clust
+        self._setStations()
+        if updated:
+            if threshold is None:
+                threshold = getattr(self, 'svdThreshold', None)
+            self._setThresholds(selectCriteria, selectValue, conDatNum,
+                                threshold, None, backupThreshold, kwargs,
+                                subspaces=updated)
+
+    def _addToSubSpace(self, sta, ind, add, mptd, chans, cstats, temkey,
+                       normalize, selectCriteria, selectValue, svdMethod):
+        """
+        Align the events in add (using their waveforms and channels in the
+        dicts mptd and chans and the stats of the cluster, cstats) to 
+        subspace ind on station sta and update its SVD if defined (a low 
+        rank update of a full SVD, a new randomized SVD of all events if 
+        svdMethod is 'randomized'). Returns the events added
+        """
+        row = self.subspaces[sta].loc[ind]
+        aligned = row.AlignedTD
+        ref = np.mean([x / np.linalg.norm(x) for x in aligned.values()],
+                      axis=0)
+        stats = row.Stats
+        Nc = list(stats.values())[0]['Nc']
+        added = []
+        for eve in add:
+            mp = mptd.get(eve)
+            if mp is None or len(mp) < len(ref):
+                msg = (('could not load waveforms of %s on %s matching the '
+                        'subspace, skipping') % (eve, sta))
+                detex.log(__name__, msg, level='warn', pri=True)
+                continue
+            cc = detex.construct.fast_normcorr(ref, mp)[::Nc]
+            delay = int(np.nanargmax(cc)) * Nc  # keep channel order
+            aligned[eve] = mp[delay:delay + len(ref)]
+            stat = dict(cstats[eve])
+            tem = temkey.getEvent(eve)
+            stat['starttime'] += delay / (stat['sampling_rate'] * Nc)
+            stat['origintime'] = tem.STAMP
+            stat['magnitude'] = tem.MAG
+            stat['offset'] = stat['starttime'] - stat['origintime']
+            stats[eve] = stat
+            row.Channels[eve] = chans[eve]
+            added.append(eve)
+        if not added:
+            return added
+        add = added
+        events = sorted(list(row.Events) + add)
+        self.subspaces[sta].Events[ind] = events
+        self.subspaces[sta].numEvents[ind] = len(events)
+        offsets = [stats[x]['offset'] for x in events]
+        offsetAr = [np.min(offsets), np.median(offsets), np.max(offsets)]
+        self.subspaces[sta].Offsets[ind] = offsetAr
+        if not row.SVDdefined:
+            return add
+        row = self.subspaces[sta].loc[ind]
+        # the truncated basis of a randomized SVD lost the discarded energy
+        newEvents = events if svdMethod == 'randomized' else add
+        arr, basisLength = self._trimGroups(ind, row, newEvents, sta)
+        if normalize:
+            arr = np.array([x / np.linalg.norm(x) for x in arr])
+        if svdMethod == 'randomized':
+            U, s, fracEnergy = self._truncatedSVD(
+                ind, row, np.transpose(arr), selectCriteria, selectValue)
+        else:
+            keys = sorted(row.SVD.keys(), reverse=True)
+            U = np.transpose(_stackRows(row.SVD, keys))
+            U, s = _updateSVD(U, np.array(keys), np.transpose(arr))
+            fracEnergy = self._getFracEnergy(ind, row, None, U)
+        svdDict = ArrayDict(s, np.transpose(U))
+        self.subspaces[sta].SVD[ind] = svdDict
+        self.subspaces[sta].FracEnergy[ind] = fracEnergy
+        usedKeys = self._getUsedBasis(ind, row, svdDict, fracEnergy,
+                                      selectCriteria, selectValue)
+        self.subspaces[sta].UsedSVDKeys[ind] = usedKeys
+        self.subspaces[sta].NumBasis[ind] = len(usedKeys)
+        self.subspaces[sta].FAS[ind] = None  # null space must be resampled
+        return add
+
     def _setThresholds(self, selectCriteria, selectValue, conDatNum,
-                       threshold, basisLength, backupThreshold, kwargs={}):
-        if threshold > 0:
-            for station in self.ssStations:
-                subspa = self.subspaces[station]
-                for ind, row in subspa.iterrows():
+                       threshold, basisLength, backupThreshold, kwargs={},
+                       subspaces=None):
+        """
+        Set the thresholds of the subspaces in subspaces, a dict of 
+        {station: list of indexes} (all subspaces if None)
+        """
+        if subspaces is None:
+            subspaces = {sta: list(self.subspaces[sta].index)
+                         for sta in self.ssStations}
+        if threshold is not None and threshold > 0:
+            for station, inds in subspaces.items():
+                for ind in inds:
                     self.subspaces[station].Threshold[ind] = threshold
 
         elif selectCriteria == 1:
@@ -1025,31 +1282,24 @@ class SubSpace(object):
             detex.log(__name__, msg, level='error', e=ValueError)
 
         elif selectCriteria in [2, 4]:
-            # call getFAS to estimate null space dist.
+            # call getFAS to estimate null space dist. (only calculated for
+            # subspaces without one)
             self.getFAS(conDatNum, **kwargs)
-            for station in self.ssStations:
-                subspa = self.subspaces[station]
-                for ind, row in subspa.iterrows():
-                    beta_a, beta_b = row.FAS['betadist'][0:2]
-                    # get threshold from beta dist. 
-                    # TODO consider implementing other dist. options as well
-                    th = scipy.stats.beta.isf(self.Pf, beta_a, beta_b, 0, 1)
-                    if th > .9:
-                        th, Pftemp = self._approxThld(beta_a, beta_b, station,
-                                                      row, self.Pf, 1000, 3,
-                                                      backupThreshold)
-
-                        msg = ('Scipy.stats.beta.isf failed with pf=%e, '
-                               'approximated threshold to %f with a Pf of %e '
-                               'for station %s %s using forward grid search' %
-                               (self.Pf, th, Pftemp, station, row.Name))
-                        detex.log(__name__, msg, level='warning')
-                    self.subspaces[station].Threshold[ind] = th
+            # get thresholds from beta dist.
+            # TODO consider implementing other dist. options as well
+            frames = {sta: self.subspaces[sta].loc[inds]
+                      for sta, inds in subspaces.items()}
+            self._setBetaThresholds(frames, False, backupThreshold)
+            for sta, df in frames.items():
+                for col in ['Threshold', 'STALTAThreshold']:
+                    for ind in df.index:
+                        self.subspaces[sta][col][ind] = df[col][ind]
 
         elif selectCriteria == 3:
-            for station in self.ssStations:
+            for station, inds in subspaces.items():
                 subspa = self.subspaces[station]
-                for ind, row in subspa.iterrows():
+                for ind in inds:
+                    row = subspa.loc[ind]
                     th = row.FracEnergy['Minimum'][row.NumBasis] * selectValue
                     self.subspaces[station].Threshold[ind] = th
 
@@ -1087,57 +1337,63 @@ class SubSpace(object):
             # get empirical dist unless manual threshold is passed
             self.getFAS(conDatNum, useSingles=True,
                         useSubSpaces=False, **kwargs)
-        for sta in self.singStations:
-            for ind, row in self.singles[sta].iterrows():
-                if len(row.SampleTrims.keys()) < 1:  # skip singles with no pick times
-                    continue
-                if threshold:
-                    th = threshold
+        frames = {sta: self.singles[sta] for sta in self.singStations}
+        if threshold:
+            for sta, df in frames.items():
+                for ind, row in df.iterrows():
+                    if len(row.SampleTrims.keys()) < 1:  # skip singles with no pick times
+                        continue
+                    df['Threshold'][ind] = threshold
+        else:
+            self._setBetaThresholds(frames, True, backupThreshold)
+
+    def _setBetaThresholds(self, frames, isSingles, backupThreshold):
+        """
+        Set the Threshold (from the beta distribution fit in getFAS) and 
+        STALTAThreshold columns of every row in frames (a dict of station 
+        keys and subspace or singles DataFrames). The thresholds of all 
+        rows are solved in one vectorized call. If a threshold can't be 
+        found use backupThreshold, raise if it is None
+        """
+        rows = []  # station, index and FAS dict of each row
+        for sta, df in frames.items():
+            for ind, row in df.iterrows():
+                if isSingles:
+                    if len(row.SampleTrims.keys()) < 1:  # skip singles with no pick times
+                        continue
+                    rows.append((sta, ind, row.FAS[0]))
                 else:
-                    beta_a, beta_b = row.FAS[0]['betadist'][0:2]
-                    th = scipy.stats.beta.isf(self.Pf, beta_a, beta_b, 0, 1)
-                    if th > .9:
-                        th, Pftemp = self._approxThld(beta_a, beta_b, sta,
-                                                      row, self.Pf, 1000, 3,
-                                                      backupThreshold)
-                        msg = ('Scipy.stats.beta.isf failed with pf=%e, '
-                               'approximated threshold to %f with a Pf of %e '
-                               'for station %s %s using forward grid search' %
-                               (self.Pf, th, Pftemp, sta, row.Name))
-                        detex.log(__name__, msg, level='warning')
-                self.singles[sta]['Threshold'][ind] = th
-
-    def _approxThld(self, beta_a, beta_b, sta, row, target, numint, numloops,
-                    backupThreshold):
-        """
-        Because scipy.stats.beta.isf can break, if it returns a value near 1 
-        when this is obviously wrong initialize grid search algorithm to get 
-        close to desired threshold using forward problem which seems to work
-        where inverse fails See this bug report: 
-        https://github.com/scipy/scipy/issues/4677        
-        """
-        startVal, stopVal = 0, 1
-        loops = 0
-        while loops < numloops:
-            Xs = np.linspace(startVal, stopVal, numint)
-            pfs = np.array([scipy.stats.beta.sf(x, beta_a, beta_b) for x in Xs])
-            resids = abs(pfs - target)
-            minind = resids.argmin()
-            if minind == 0 or minind == numint - 1:
-                msg1 = (('Grid search for threshold failing for %s on %s, '
-                         'set it manually or use default') % (sta, row.name))
-                msg2 = (('Grid search for threshold failing for %s on %s, '
-                         'using backup %.2f') % (sta, row.name, backupThreshold))
+                    rows.append((sta, ind, row.FAS))
+        if not rows:
+            return
+        betas = np.array([fas['betadist'][0:2] for sta, ind, fas in rows])
+        ths = detex.fas._getBetaThresholds(self.Pf, betas[:, 0], betas[:, 1])
+        for (sta, ind, fas), th in zip(rows, ths):
+            if not np.isfinite(th):
+                name = frames[sta].Name[ind]
                 if backupThreshold is None:
-                    detex.log(__name__, msg1, level='error', e=ValueError)
-                else:
-                    detex.log(__name__, msg2, level='warn', pri=True)
-                    return backupThreshold, target
-            bestPf = pfs[minind]
-            bestX = Xs[minind]
-            startVal, stopVal = Xs[minind - 1], Xs[minind + 1]
-            loops += 1
-        return bestX, bestPf
+                    msg = (('Could not determine threshold for %s on %s, '
+                            'set it manually or use backupThreshold') %
+                           (name, sta))
+                    detex.log(__name__, msg, level='error', e=ValueError)
+                msg = (('Could not determine threshold for %s on %s, using '
+                        'backup %.2f') % (name, sta, backupThreshold))
+                detex.log(__name__, msg, level='warn', pri=True)
+                th = backupThreshold
+            frames[sta]['Threshold'][ind] = th
+            sth = self._getSTALTAThreshold(fas)
+            frames[sta]['STALTAThreshold'][ind] = sth
+
+    def _getSTALTAThreshold(self, fas):
+        """
+        Get the threshold on the sta/lta of the DS (used when trigCon == 1)
+        that gives the Pf of the instance, using the gamma distribution fit
+        to the sta/lta of the null space in getFAS. Returns NaN if the 
+        distribution is not defined
+        """
+        if not isinstance(fas, dict) or fas.get('staltadist') is None:
+            return np.nan
+        return scipy.stats.gamma.isf(self.Pf, *fas['staltadist'])
 
     ########################### Visualization Methods
 
@@ -1303,14 +1559,13 @@ class SubSpace(object):
                 ranmax = np.zeros(numEvs)
                 orsamps = np.zeros(numEvs)
                 for evenum, eve in enumerate(row.Events):
-                    tem = self.clusters.temkey[
-                        self.clusters.temkey.NAME == eve].iloc[0]
+                    tem = self.clusters.temkey.getEvent(eve)
                     condat = row.AlignedTD[
                                  eve] / max(2 * abs(row.AlignedTD[eve])) + evenum + 1
                     Nc, Sr = row.Stats[eve]['Nc'], row.Stats[
                         eve]['sampling_rate']
                     starTime = row.Stats[eve]['starttime']
-                    ortime = obspy.core.UTCDateTime(tem.TIME).timestamp
+                    ortime = tem.STAMP
                     orsamps[evenum] = row.SampleTrims[
                                           'Starttime'] - (starTime - ortime) * Nc * Sr
                     plt.plot(condat, 'k')
@@ -1659,6 +1914,10 @@ class SubSpace(object):
             useSingles=False,
             numBins=401,
             recalc=False,
+            triggerLTATime=5,
+            triggerSTATime=0,
+            processes=1,
+            sampleCache=None,
             **kwargs):
         """
         Function to initialize a FAS (false alarm statistic) instance, used
@@ -1690,57 +1949,89 @@ class SubSpace(object):
         numBins : int
             Number of bins for binning distributions (so distribution can be 
             loaded and plotted later)
+        recalc : bool
+            If True recalculate the FAS even if it has already been done
+        triggerLTATime : number
+            The long term average time window in seconds of the sta/lta of
+            the detection statistic, should match the value passed to the 
+            detex method when trigCon == 1
+        triggerSTATime : number
+            The short term average time window in seconds of the sta/lta of
+            the detection statistic, if 0 one sample is used
+        processes : int or None
+            The number of processes used to fetch, filter and correlate the
+            continuous data samples. Each sample is only loaded once and 
+            correlated with all subspaces and singles on its station. If 
+            None use all cores. The DataFetcher must be picklable to use
+            more than one process.
+        sampleCache : str or None
+            Path to a directory (eg NullSpaceSamples in the project 
+            directory) where the accepted continuous data samples of each 
+            station (filtered, screened and multiplexed) are written, one 
+            file per sample, as they are processed. Later calls (for 
+            example from SVD, setSinglesThresholds or getFAS with 
+            recalc=True) reuse these samples rather than fetching new ones
+            as long as the data source, filter, decimation, sta/lta and 
+            continuous data parameters don't change. If None (default) 
+            samples are not cached.
         
         Note
         ---------
         The results are stored in a DataFrame for each subspace/singleton
-        under the "FAS" column of the main DataFrame
+        under the "FAS" column of the main DataFrame. A gamma distribution
+        fit to the sta/lta of the detection statistic is also stored (key 
+        staltadist) which is used to set the STALTAThreshold column
         """
+        detectors = {}  # subspaces/singles that need FAS on each station
         if useSubSpaces:
             self._updateOffsets()  # make sure offset times are up to date
             for sta in self.subspaces.keys():
-                # check if FAS already calculated, only recalc if recalc
-                fas1 = self.subspaces[sta]['FAS'][0]
-                if isinstance(fas1, dict) and not recalc:
-                    msg = ('FAS for station %s already calculated, to '
-                           'recalculate pass True to the parameter recalc' %
-                           sta)
-                    detex.log(__name__, msg, pri=True)
-                else:
-                    self.subspaces[sta]['FAS'] = detex.fas._initFAS(
-                        self.subspaces[sta],
-                        conDatNum,
-                        self.clusters,
-                        self.cfetcher,
-                        LTATime=LTATime,
-                        STATime=STATime,
-                        staltalimit=staltalimit,
-                        numBins=numBins,
-                        dtype=self.dtype)
+                for ind, row in self.subspaces[sta].iterrows():
+                    # check if FAS already calculated, only recalc if recalc
+                    if isinstance(row.FAS, dict) and not recalc:
+                        msg = (('FAS for %s on station %s already '
+                                'calculated, to recalculate pass True to '
+                                'the parameter recalc') % (row.Name, sta))
+                        detex.log(__name__, msg, pri=True)
+                    else:
+                        rows = [(('ss', sta, ind), row, True)]
+                        detectors.setdefault(sta, []).extend(rows)
         if useSingles:
             for sta in self.singles.keys():
-                for a in range(len(self.singles[sta])):
-                    fas1 = self.singles[sta]['FAS'][a]
+                for a, row in self.singles[sta].iterrows():
+                    fas1 = row.FAS[0] if isinstance(row.FAS, list) else None
                     if isinstance(fas1, dict) and not recalc:
                         msg = (('FAS for singleton %d already calculated on '
                                 'station %s, to recalculate pass True to the '
                                 'parameter recalc') % (a, sta))
                         detex.log(__name__, msg, pri=True)
                     # skip any events that have not been trimmed
-                    elif len(self.singles[sta]['SampleTrims'][a].keys()) < 1:
+                    elif len(row.SampleTrims.keys()) < 1:
                         continue
                     else:
-                        self.singles[sta]['FAS'][a] = detex.fas._initFAS(
-                            self.singles[sta][a:a + 1],
-                            conDatNum,
-                            self.clusters,
-                            self.cfetcher,
-                            LTATime=LTATime,
-                            STATime=STATime,
-                            staltalimit=staltalimit,
-                            numBins=numBins,
-                            dtype=self.dtype,
-                            issubspace=False)
+                        rows = [(('sg', sta, a), row, False)]
+                        detectors.setdefault(sta, []).extend(rows)
+        if not detectors:
+            return
+        results = detex.fas._initFAS(
+            detectors,
+            conDatNum,
+            self.clusters,
+            self.cfetcher,
+            LTATime=LTATime,
+            STATime=STATime,
+            staltalimit=staltalimit,
+            numBins=numBins,
+            dtype=self.dtype,
+            triggerLTATime=triggerLTATime,
+            triggerSTATime=triggerSTATime,
+            processes=processes,
+            sampleCache=sampleCache)
+        for (kind, sta, ind), fas in results.items():
+            if kind == 'ss':
+                self.subspaces[sta]['FAS'][ind] = fas
+            else:  # singles FAS are stored in a list
+                self.singles[sta]['FAS'][ind] = [fas]
 
     def detex(self,
               utcStart=None,
@@ -1758,7 +2049,9 @@ class SubSpace(object):
               classifyEvents=None,
               eventCorFile='EventCors',
               utcSaves=None,
-              fillZeros=False):
+              fillZeros=False,
+              triggerThreshold=None,
+              partitioned=False):
         """
         function to run subspace detection over continuous data and store 
         results in SQL database subspaceDB
@@ -1775,11 +2068,13 @@ class SubSpace(object):
             Path to the SQLite database to store detections in. If it already 
             exists delOldCorrs parameters governs if it will be deleted before
             running new detections, or appended to. 
-        trigCon is the condition for which detections should trigger. 
-            Once the condition is set the variable minCoef is used:
-                0 is based on the detection statistic threshold
-                1 is based on the STA/LTA of the detection statistic threshold
-                (Only 0 is currently supported)
+        trigCon : int
+            The condition for which detections should trigger:
+                0 is based on the detection statistic threshold (Threshold
+                column)
+                1 is based on the STA/LTA of the detection statistic 
+                threshold (STALTAThreshold column, set by SVD and 
+                setSinglesThresholds from the FAS or by triggerThreshold)
         triggerLTATime : number
             The long term average for the STA/LTA calculations in seconds.
         triggerSTATime : number
@@ -1790,7 +2085,9 @@ class SubSpace(object):
             for potential speed ups. Currently not implemented. 
         delOldCorrs : bool
             Determines if subspaceDB should be deleted before performing 
-            detections. If False old database is appended to. 
+            detections. If False old database is appended to. If 
+            partitioned only the detections of the stations and time range
+            (utcStart to utcEnd) being run are deleted.
         calcHist : boolean
             If True calculates the histagram for every point of the detection 
             statistic vectors (all hours, stations and subspaces) by keeping a
@@ -1834,36 +2131,94 @@ class SubSpace(object):
             If true fill the gaps in continuous data with 0s. If True 
             STA/LTA of detection statistic cannot be calculated in order to 
             avoid dividing by 0.
+        triggerThreshold : None or float
+            If a number, and trigCon == 1, use it as the STA/LTA threshold for
+            all subspaces and singletons rather than the values calibrated
+            from the FAS
+        partitioned : bool
+            If True subspaceDB is a directory with one database per station
+            and month of detections and a manifest (see detex.partitioned),
+            so reruns for some stations or months replace only those 
+            detections and several processes (running different stations)
+            can write at once. Used if subspaceDB is already a partitioned
+            directory. detResults reads it like a database.
         Notes
         ----------
         The same filter and decimation parameters that were used in the
         ClusterStream instance will be applied.
         """
         # make sure no parameters that dont work yet are selected
-        if multiprocess or trigCon != 0:
-            msg = 'multiprocessing and trigcon other than 0 not supported'
+        if multiprocess:
+            msg = 'multiprocessing is not supported'
             detex.log(__name__, msg, level='error')
-
-        if os.path.exists(subspaceDB):
+        if trigCon not in [0, 1]:
+            msg = 'trigCon must be 0 or 1, not %s' % trigCon
+            detex.log(__name__, msg, level='error', e=ValueError)
+        if trigCon == 1:
+            if fillZeros:
+                msg = 'trigCon == 1 cannot be used when fillZeros is True'
+                detex.log(__name__, msg, level='error', e=ValueError)
+            if useSubSpaces:
+                self._setSTALTAThresholds(self.subspaces, triggerThreshold,
+                                          triggerLTATime, triggerSTATime)
+
+        if detex.partitioned.isPartitioned(subspaceDB):
+            partitioned = True
+        if partitioned:
+            store = detex.partitioned.PartitionedStore(subspaceDB)
+            if delOldCorrs:  # only the stations and times being run
+                stas = set()
+                if useSubSpaces:
+                    stas |= set(self.subspaces.keys())
+                if useSingles:
+                    stas |= set(self.singles.keys())
+                t1, t2 = [obspy.UTCDateTime(x).timestamp if x else None
+                          for x in [utcStart, utcEnd]]
+                store.clear(sorted(stas), t1, t2)
+                msg = 'Deleting old detections of %s in %s' % (
+                    sorted(stas), subspaceDB)
+                detex.log(__name__, msg, pri=True)
+        elif os.path.exists(subspaceDB):
             if delOldCorrs:
                 os.remove(subspaceDB)
+                for ext in ['-wal', '-shm']:  # WAL files of DetectionStore
+                    if os.path.exists(subspaceDB + ext):
+                        os.remove(subspaceDB + ext)
                 msg = 'Deleting old subspace database %s' % subspaceDB
                 detex.log(__name__, msg, pri=True)
             else:
                 msg = 'Not deleting old subspace database %s' % subspaceDB
                 detex.log(__name__, msg, pri=True)
 
-        if useSubSpaces:  # run subspaces
-            TRDF = self.subspaces
-            # determine if subspaces are defined (ie SVD has been called)
+        if useSubSpaces:  # make sure SVD has been called
             stas = self.subspaces.keys()
-            sv = [all(TRDF[sta].SVDdefined) for sta in stas]
+            sv = [all(self.subspaces[sta].SVDdefined) for sta in stas]
             if not all(sv):
                 msg = 'call SVD before running subspace detectors'
                 detex.log(__name__, msg, level='error')
 
+        # one store writes all detections and info tables
+        if not partitioned:
+            store = detex.util.DetectionStore(subspaceDB)
+        with store:
+            self._runDetex(store, utcStart, utcEnd, trigCon, triggerLTATime,
+                           triggerSTATime, multiprocess, calcHist,
+                           useSubSpaces, useSingles, estimateMags,
+                           classifyEvents, eventCorFile, utcSaves, fillZeros,
+                           triggerThreshold)
+
+    def _runDetex(self, store, utcStart, utcEnd, trigCon, triggerLTATime,
+                  triggerSTATime, multiprocess, calcHist, useSubSpaces,
+                  useSingles, estimateMags, classifyEvents, eventCorFile,
+                  utcSaves, fillZeros, triggerThreshold):
+        """
+        Run the detectors and write the detections, info and histogram
+        tables with store (instance of detex.util.DetectionStore)
+        """
+        if useSubSpaces:  # run subspaces
+            TRDF = self.subspaces
             Det = _SSDetex(TRDF, utcStart, utcEnd, self.cfetcher, self.clusters,
-                           subspaceDB, trigCon, triggerLTATime, triggerSTATime,
+                           store, trigCon, triggerLTATime, triggerSTATime,
                            multiprocess, calcHist, self.dtype, estimateMags,
                            classifyEvents, eventCorFile, utcSaves, fillZeros)
             self.histSubSpaces = Det.hist
@@ -1871,9 +2226,12 @@ class SubSpace(object):
         if useSingles:  # run singletons
             # make sure thresholds are calcualted
             self.setSinglesThresholds()
+            if trigCon == 1:
+                self._setSTALTAThresholds(self.singles, triggerThreshold,
+                                          triggerLTATime, triggerSTATime)
             TRDF = self.singles
             Det = _SSDetex(TRDF, utcStart, utcEnd, self.cfetcher, self.clusters,
-                           subspaceDB, trigCon, triggerLTATime, triggerSTATime,
+                           store, trigCon, triggerLTATime, triggerSTATime,
                            multiprocess, calcHist, self.dtype, estimateMags,
                            classifyEvents, eventCorFile, utcSaves, fillZeros,
                            issubspace=False)
@@ -1883,23 +2241,52 @@ class SubSpace(object):
         if useSubSpaces or useSingles:
             cols = ['FREQMIN', 'FREQMAX', 'CORNERS', 'ZEROPHASE']
             dffil = pd.DataFrame([self.clusters.filt], columns=cols, index=[0])
-            detex.util.saveSQLite(dffil, subspaceDB, 'filt_params')
+            store.write(dffil, 'filt_params')
 
             # get general info on each singleton/subspace and save
             ssinfo, sginfo = self._getInfoDF()
             sshists, sghists = self._getHistograms(useSubSpaces, useSingles)
             if useSubSpaces and ssinfo is not None:
                 # save subspace info
-                detex.util.saveSQLite(ssinfo, subspaceDB, 'ss_info')
+                store.write(ssinfo, 'ss_info')
             if useSingles and sginfo is not None:
                 # save singles info
-                detex.util.saveSQLite(sginfo, subspaceDB, 'sg_info')
+                store.write(sginfo, 'sg_info')
             if useSubSpaces and sshists is not None:
                 # save subspace histograms
-                detex.util.saveSQLite(sshists, subspaceDB, 'ss_hist')
+                store.write(sshists, 'ss_hist')
             if useSingles and sghists is not None:
                 # save singles histograms
-                detex.util.saveSQLite(sghists, subspaceDB, 'sg_hist')
+                store.write(sghists, 'sg_hist')
+            # index detection tables for detResults
+            store.createIndexes(['ss_df', 'sg_df'])
+
+    def _setSTALTAThresholds(self, frames, triggerThreshold, triggerLTATime,
+                             triggerSTATime):
+        """
+        Make sure each subspace/singleton in frames (dict of DataFrames) has
+        a usable STA/LTA threshold before running with trigCon == 1
+        """
+        for sta, df in frames.items():
+            if triggerThreshold is not None:
+                df['STALTAThreshold'] = float(triggerThreshold)
+                continue
+            if 'STALTAThreshold' not in df.columns:
+                df['STALTAThreshold'] = np.nan
+            if df.STALTAThreshold.isnull().any():
+                msg = (('STA/LTA thresholds not defined on %s, call getFAS '
+                        'with recalc=True then SVD (or setSinglesThresholds) '
+                        'or pass triggerThreshold') % sta)
+                detex.log(__name__, msg, level='error', e=ValueError)
+            for ind, row in df.iterrows():
+                fas = row.FAS[0] if isinstance(row.FAS, list) else row.FAS
+                win = fas.get('staltawindows') if isinstance(fas, dict) else None
+                if win is not None and win != (triggerSTATime, triggerLTATime):
+                    msg = (('STA/LTA threshold of %s on %s was calibrated with'
+                            ' sta/lta windows of %s, not %s') %
+                           (row.Name, sta, win,
+                            (triggerSTATime, triggerLTATime)))
+                    detex.log(__name__, msg, level='warn', pri=True)
 
     def _getInfoDF(self):
         """
@@ -1918,13 +2305,15 @@ class SubSpace(object):
                 events = ','.join(ss.Events)
                 numbasis = ss.NumBasis
                 thresh = ss.Threshold
+                slthresh = ss.get('STALTAThreshold', np.nan)
                 if isinstance(ss.FAS, dict) and len(ss.FAS.keys()) > 1:
                     b1, b2 = ss.FAS['betadist'][0], ss.FAS['betadist'][1]
                 else:
                     b1, b2 = np.nan, np.nan
                 cols = ['Name', 'Sta', 'Events', 'Threshold', 'NumBasisUsed',
-                        'beta1', 'beta2']
-                dat = [[name, station, events, thresh, numbasis, b1, b2]]
+                        'beta1', 'beta2', 'STALTAThreshold']
+                dat = [[name, station, events, thresh, numbasis, b1, b2,
+                        slthresh]]
                 sslist.append(pd.DataFrame(dat, columns=cols))
         for sta in self.Stations:
             if sta not in self.singStations:
@@ -1936,12 +2325,14 @@ class SubSpace(object):
                 station = ss.Station
                 events = ','.join(ss.Events)
                 thresh = ss.Threshold
+                slthresh = ss.get('STALTAThreshold', np.nan)
                 if isinstance(ss.FAS, list) and len(ss.FAS[0].keys()) > 1:
                     b1, b2 = ss.FAS[0]['betadist'][0], ss.FAS[0]['betadist'][1]
                 else:
                     b1, b2 = np.nan, np.nan
-                cols = ['Name', 'Sta', 'Events', 'Threshold', 'beta1', 'beta2']
-                dat = [[name, station, events, thresh, b1, b2]]
+                cols = ['Name', 'Sta', 'Events', 'Threshold', 'beta1', 'beta2',
+                        'STALTAThreshold']
+                dat = [[name, station, events, thresh, b1, b2, slthresh]]
                 sglist.append(pd.DataFrame(dat, columns=cols))
         if len(sslist) > 0:
             ssinfo = pd.concat(sslist, ignore_index=True)
@@ -2015,15 +2406,24 @@ class SubSpace(object):
         return len(self.subspaces)
 
     ############ MISC 
-    def write(self, filename='subspace.pkl'):
+    def write(self, filename='subspace.pkl', binary=False):
         """
         pickle the subspace class
         Parameters
         -------------
         filename : str
-            Path of the file to be created
-        """
-        cPickle.dump(self, open(filename, 'wb'))
+            Path of the file (or directory if binary) to be created
+        binary : bool
+            If True write a directory with arrays stored as raw binary files,
+            and each station stored separately, instead of a pickle (see 
+            detex.persist). Loads much faster and allows loading only some
+            stations with detex.loadSubSpace. Frequency domain spectra are
+            not written.
+        """
+        if binary:
+            detex.persist.writeBinary(self, filename)
+        else:
+            cPickle.dump(self, open(filename, 'wb'))
 
     def printOffsets(self):
         """
@@ -2035,3 +2435,187 @@ class SubSpace(object):
                 print('%s, %s, min=%3f, max=%3f, range=%3f' %
                       (row.Station, row.Name, row.Offsets[0], row.Offsets[2],
                        row.Offsets[2] - row.Offsets[0]))
+
+
+############ Array containers
+
+class ArrayDict(MutableMapping):
+    """
+    Dict-like container that stores equal length 1D arrays as the rows of a 
+    single contiguous 2D array. Used for the aligned waveforms (AlignedTD, 
+    keyed by event name) and the basis vectors (SVD, keyed by singular 
+    value) of each subspace so they can be stacked (see matrix method) 
+    without copying each array and pickled as a single buffer. Looking up a 
+    key returns a view of the row.
+
+    Parameters
+    ----------
+    keys : list
+        The keys, one for each row of data
+    data : 2D numpy array
+        Array with one row per key
+    """
+    __slots__ = ('_keys', '_index', 'data')
+
+    def __init__(self, keys=None, data=None):
+        self._setState(list(keys) if keys is not None else [], data)
+
+    @classmethod
+    def fromDict(cls, dic, keys=None):
+        """
+        Create an ArrayDict from a dict of equal length arrays, if keys is 
+        None the sorted keys of dic are used
+        """
+        keys = sorted(dic.keys()) if keys is None else list(keys)
+        if not len(keys):
+            return cls()
+        return cls(keys, np.vstack([dic[x] for x in keys]))
+
+    def _setState(self, keys, data):
+        if data is None:
+            data = np.zeros((len(keys), 0))
+        data = np.asarray(data)
+        if data.ndim != 2 or data.shape[0] != len(keys):
+            msg = 'data must be a 2D array with one row for each key'
+            detex.log(__name__, msg, level='error', e=ValueError)
+        self._keys = keys
+        self._index = {x: num for num, x in enumerate(keys)}
+        self.data = data
+
+    def matrix(self, keys=None):
+        """
+        Return the rows for keys (in order) as a 2D array, or all rows if 
+        keys is None
+        """
+        if keys is None:
+            return self.data
+        return self.data[[self._index[x] for x in keys]]
+
+    def __getitem__(self, key):
+        return self.data[self._index[key]]
+
+    def __setitem__(self, key, value):
+        value = np.asarray(value)
+        if len(self._keys) and value.shape != self.data.shape[1:]:
+            msg = 'all arrays in an ArrayDict must be the same length'
+            detex.log(__name__, msg, level='error', e=ValueError)
+        if key in self._index:
+            self.data[self._index[key]] = value
+        elif len(self._keys):
+            self._setState(self._keys + [key],
+                           np.vstack([self.data, value]))
+        else:
+            self._setState([key], value[np.newaxis, :])
+
+    def __delitem__(self, key):
+        ind = self._index[key]
+        keys = self._keys[:ind] + self._keys[ind + 1:]
+        self._setState(keys, np.delete(self.data, ind, axis=0))
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def keys(self):  # lists, as in python 2 dicts, so keys can be sorted
+        return list(self._keys)
+
+    def values(self):
+        return [self.data[x] for x in range(len(self._keys))]
+
+    def items(self):
+        return list(zip(self._keys, self.values()))
+
+    def copy(self):
+        return ArrayDict(self._keys, self.data.copy())
+
+    def __getstate__(self):
+        return (self._keys, self.data)
+
+    def __setstate__(self, state):
+        self._setState(*state)
+
+    def __repr__(self):
+        return 'ArrayDict(%d keys, length %d)' % self.data.shape
+
+
+def _randomizedSVD(arr, rank, oversample=10, powerIter=2, seed=0):
+    """
+    Randomized truncated SVD (Halko et al. 2011) of arr, returns the first
+    rank left singular vectors (as columns) and singular values. Falls back
+    to the full SVD if rank + oversample is not smaller than the number of
+    columns of arr
+    """
+    numCols = arr.shape[1]
+    if rank + oversample >= min(arr.shape):
+        U, s, Vh = scipy.linalg.svd(arr, full_matrices=False)
+        return U[:, :rank], s[:rank]
+    rand = np.random.RandomState(seed)
+    # orthonormal basis for the range of arr, refined with power iterations
+    Q = np.linalg.qr(np.dot(arr, rand.randn(numCols, rank + oversample)))[0]
+    for _ in range(powerIter):
+        Q = np.linalg.qr(np.dot(arr.T, Q))[0]
+        Q = np.linalg.qr(np.dot(arr, Q))[0]
+    Ub, s, Vh = scipy.linalg.svd(np.dot(Q.T, arr), full_matrices=False)
+    return np.dot(Q, Ub[:, :rank]), s[:rank]
+
+
+def _pairwiseCC(arr, maxLag=0, Nc=1):
+    """
+    Correlation coefficients of all pairs of rows in arr. The rows are 
+    normalized once and the zero lag coefficients calculated with one 
+    matrix product. If maxLag > 0 the maximum over lags between -maxLag 
+    and maxLag (in samples of each channel, so multiples of Nc samples of 
+    multiplexed rows) is returned, calculated with batched FFTs. Returns 
+    an (N, N) array
+    """
+    arr = arr - np.mean(arr, axis=1)[:, np.newaxis]
+    norms = np.linalg.norm(arr, axis=1)
+    norms[norms == 0] = 1.  # all zero rows have 0 cc
+    arr = arr / norms[:, np.newaxis]
+    if maxLag < 1:
+        return np.dot(arr, arr.T)
+    maxShift = int(maxLag) * Nc
+    nfft = 2 ** (arr.shape[1] + maxShift).bit_length()
+    fd = np.fft.rfft(arr, n=nfft, axis=1)
+    lags = np.arange(-maxShift, maxShift + 1, Nc) % nfft
+    ccs = np.empty((len(arr), len(arr)))
+    for num in range(len(arr)):  # correlate row with all rows at once
+        xc = np.fft.irfft(fd[num] * np.conj(fd), n=nfft, axis=1)
+        ccs[num] = np.max(xc[:, lags], axis=1)
+    return ccs
+
+
+def _updateSVD(U, s, cols):
+    """
+    Low rank update of a thin SVD (Brand 2006). Given the left singular 
+    vectors U (as columns) and singular values s of a matrix return those
+    of the matrix with the columns in cols appended. Singular values that
+    are numerically zero are dropped
+    """
+    proj = np.dot(U.T, cols)  # component in the current subspace
+    Q, R = np.linalg.qr(cols - np.dot(U, proj))  # orthogonal component
+    k, m = len(s), cols.shape[1]
+    K = np.zeros((k + m, k + m))
+    K[:k, :k] = np.diag(s)
+    K[:k, k:] = proj
+    K[k:, k:] = R
+    Uk, sk, Vh = scipy.linalg.svd(K)
+    keep = sk > sk[0] * 1e-10
+    return np.dot(np.hstack([U, Q]), Uk[:, keep]), sk[keep]
+
+
+def _stackRows(dic, keys, start=None, stop=None):
+    """
+    Return the arrays in dic (an ArrayDict or dict of arrays) for keys 
+    as the rows of a 2D array, sliced from start to stop (in samples)
+    """
+    if isinstance(dic, ArrayDict):
+        arr = dic.matrix(keys)
+    else:
+        arr = np.vstack([dic[x] for x in keys])
+    return arr[:, start:stop]
@@ -8,10 +8,12 @@ Created on Thu May 29 16:41:48 2014
 from __future__ import print_function, absolute_import, unicode_literals
 from __future__ import with_statement, nested_scopes, generators, division
 
+import numbers
 import os
+import re
 import sys
 import time
-from sqlite3 import PARSE_DECLTYPES, connect
+from sqlite3 import PARSE_DECLTYPES, OperationalError, connect
 
 import PyQt4
 import numpy as np
@@ -246,7 +248,7 @@ def writeHypoDDEventInput(temkey, fileName='event.dat'):
     reqZeros = int(np.ceil(np.log10(len(temkey))))
     fomatstr = '{:0' + "{:d}".format(reqZeros) + 'd}'
     for num, row in temkey.iterrows():
-        utc = obspy.UTCDateTime(row.TIME)
+        utc = obspy.UTCDateTime(row.STAMP)
         DATE = '%04d%02d%02d' % (
             int(utc.year), int(utc.month), int(utc.day))
         TIME = '%02d%02d%04d' % (int(utc.hour), int(
@@ -298,11 +300,11 @@ def makeHypoInversePhaseFile(phases, evekey, outname, fix=0, usePhases=['P'],
     with open(outname, 'wb') as phafil:
         phafil.write('\n')
         for eveind, everow in evekey.iterrows():  # Loop events
-            phas = phases[phases.Event == everow.NAME]
+            phas = phases.getPhases(everow.NAME)
             if len(phas) < 1:  # go to next event if no phase info
                 continue
             for phaind, pha in phas.iterrows():
-                stmp = obspy.UTCDateTime(pha.TimeStamp)
+                stmp = obspy.UTCDateTime(pha.STAMP)
                 phase = pha.Phase.upper()
                 net = pha.Station.split('.')[0]
                 sta = pha.Station.split('.')[1]
@@ -569,6 +571,125 @@ req_stakey = set(['NETWORK', 'STATION', 'STARTTIME', 'ENDTIME', 'LAT',
 req_phases = set(['TimeStamp', 'Event', 'Station', 'Phase'])
 req_columns = {'template': req_temkey, 'station': req_stakey,
                'phases': req_phases}
+# time columns parsed on load to float time stamps (new columns)
+time_columns = {'template': {'TIME': 'STAMP'},
+                'station': {'STARTTIME': 'STARTSTAMP', 'ENDTIME': 'ENDSTAMP'},
+                'phases': {'TimeStamp': 'STAMP'}}
+_timeDashes = re.compile(r'T(\d\d)-(\d\d)-')  # eg 2010-01-01T00-00-00
+# keys read from files, (path, key_type): (modification time, DetexKey)
+_keyCache = {}
+# columns (or NET.STA) hashed by the indexes of DetexKey
+key_indexes = {'NAME': ['NAME'], 'NETSTA': ['NETWORK', 'STATION'],
+               'EVENT': ['Event'], 'EVENTSTATION': ['Event', 'Station']}
+
+
+class DetexKey(pd.DataFrame):
+    """
+    DataFrame returned by readKey. Besides the normal DataFrame methods rows
+    can be looked up by hash indexes (built on first use) rather than 
+    boolean scans:
+    
+    getEvent(name) - the template key row of event name
+    getStation(netsta) - the station key rows of network.station
+    getPhases(event, station=None) - the phase rows of event (and station)
+    getOriginTimes() - template origin times (STAMP) and names sorted by
+        time, for searchsorted lookups
+    
+    The indexes are rebuilt if rows are added or the index changes but not
+    if the indexed columns are modified in place.
+    """
+    _metadata = ['keyType']
+    keyType = None
+
+    @property
+    def _constructor(self):
+        return DetexKey
+
+    def _getIndex(self, name):
+        """
+        return a dict of key: positions of rows for index name (see 
+        key_indexes), or the sorted origin times if name is ORIGINTIMES
+        """
+        # keep the indexed Index itself, the id of a freed one is reused
+        cache = self.__dict__.get('_keyIndexes')
+        if (cache is None or cache[0] != len(self) or
+                cache[1] is not self.index):
+            cache = (len(self), self.index, {})
+            self.__dict__['_keyIndexes'] = cache
+        if name == 'ORIGINTIMES' and name not in cache[2]:
+            cache[2][name] = _sortOriginTimes(self)
+        if name not in cache[2]:
+            cols = key_indexes[name]
+            if name == 'NETSTA':
+                keys = (self.NETWORK.astype(str) + '.' +
+                        self.STATION.astype(str)).values
+            elif len(cols) == 1:
+                keys = self[cols[0]].values
+            else:
+                keys = [self[x].values for x in cols]
+            pos = pd.Series(np.arange(len(self)))
+            cache[2][name] = pos.groupby(keys).indices
+        return cache[2][name]
+
+    def getRows(self, index, key):
+        """
+        Return a DataFrame (DetexKey) of the rows whose key in index (NAME,
+        NETSTA, EVENT or EVENTSTATION) is key, empty if there are none
+        """
+        if index not in key_indexes:
+            msg = 'index must be one of %s' % list(key_indexes.keys())
+            detex.log(__name__, msg, level='error', e=ValueError)
+        if not set(key_indexes[index]).issubset(self.columns):
+            msg = '%s index requires columns %s' % (index, key_indexes[index])
+            detex.log(__name__, msg, level='error', e=ValueError)
+        pos = self._getIndex(index).get(key, [])
+        return self.iloc[pos]
+
+    def getEvent(self, name):
+        """
+        Return the template key row (Series) of event name
+        """
+        rows = self.getRows('NAME', name)
+        if len(rows) < 1:
+            msg = '%s not in template key' % name
+            detex.log(__name__, msg, level='error', e=KeyError)
+        return rows.iloc[0]
+
+    def getStation(self, netsta):
+        """
+        Return the station key rows of netsta (network.station)
+        """
+        return self.getRows('NETSTA', netsta)
+
+    def getPhases(self, event, station=None):
+        """
+        Return the phase rows of event, if station (network.station) is 
+        not None only those of event on station
+        """
+        if station is None:
+            return self.getRows('EVENT', event)
+        return self.getRows('EVENTSTATION', (event, station))
+
+    def getOriginTimes(self):
+        """
+        Return arrays of the origin time stamps (sorted) and the names of
+        the events of a template key, built once and cached like the
+        other indexes
+        """
+        if not set(['STAMP', 'NAME']).issubset(self.columns):
+            msg = 'origin times require STAMP and NAME columns'
+            detex.log(__name__, msg, level='error', e=ValueError)
+        return self._getIndex('ORIGINTIMES')
+
+
+def _sortOriginTimes(temkey):
+    """
+    Return the STAMP (sorted, nulls dropped) and NAME arrays of temkey
+    """
+    stamps = temkey.STAMP.values.astype(float)
+    order = np.argsort(stamps, kind='mergesort')
+    order = order[~np.isnan(stamps[order])]
+    return stamps[order], temkey.NAME.values[order]
 
 
 def readKey(dfkey, key_type='template'):
@@ -582,7 +703,11 @@ def readKey(dfkey, key_type='template'):
         "template" for template key or "station" for station key
     Returns
     --------
-    A pandas DataFrame if required columns exist, else raise Exception
+    A DetexKey (pandas DataFrame with hash indexes for looking up events,
+    stations and phases) if required columns exist, else raise Exception.
+    The time columns are parsed to float time stamps in new columns (see 
+    time_columns, eg STAMP for TIME in template keys). Keys read from a 
+    path are cached until the file is modified, a copy is returned.
 
     """
     # key types and required columns
@@ -597,14 +722,27 @@ def readKey(dfkey, key_type='template'):
         if not os.path.exists(dfkey):
             msg = '%s does not exists, check path' % dfkey
             detex.log(__name__, msg, level='error')
-        else:
-            df = pd.read_csv(dfkey)
+        cacheKey = (os.path.abspath(dfkey), key_type)
+        mtime = os.path.getmtime(dfkey)
+        if cacheKey in _keyCache and _keyCache[cacheKey][0] == mtime:
+            return _keyCache[cacheKey][1].copy()
+        df = _checkKey(pd.read_csv(dfkey), key_type)
+        _keyCache[cacheKey] = (mtime, df)
+        return df.copy()
+    elif isinstance(dfkey, DetexKey) and dfkey.keyType == key_type:
+        return dfkey.copy()  # already checked
     elif isinstance(dfkey, pd.DataFrame):
-        df = dfkey
+        return _checkKey(dfkey, key_type)
     else:
         msg = 'Data type of dfkey not understood'
         detex.log(__name__, msg, level='error')
 
+
+def _checkKey(df, key_type):
+    """
+    Check the required columns of key DataFrame df, drop rows with empty 
+    required values, sort, add time stamp columns and return a DetexKey
+    """
     # Check required columns
     if not req_columns[key_type].issubset(df.columns):
         msg = ('Required columns not in %s, required columns for %s key are %s'
@@ -612,9 +750,8 @@ def readKey(dfkey, key_type='template'):
         detex.log(__name__, msg, level='error')
 
     tdf = df.loc[:, list(req_columns[key_type])]
-    condition = [all([x != '' for item, x in row.iteritems()])
-                 for num, row in tdf.iterrows()]
-    df = df[condition]
+    condition = ~(tdf.astype(str) == '').any(axis=1).values
+    df = df[condition].copy()
 
     # TODO if column TIME is utcDateTime object sorting fails, fix this
     df.sort_values(by=list(req_columns[key_type]), inplace=True)
@@ -622,11 +759,56 @@ def readKey(dfkey, key_type='template'):
 
     # specific operations for various key types
     if key_type == 'station':
-        df['STATION'] = [str(x) for x in df['STATION']]
-        df['NETWORK'] = [str(x) for x in df['NETWORK']]
+        df['STATION'] = df['STATION'].astype(str)
+        df['NETWORK'] = df['NETWORK'].astype(str)
+    for col, stampCol in time_columns[key_type].items():
+        df[stampCol] = _getTimeStamps(df[col])
+    df = DetexKey(df)
+    df.keyType = key_type
     return df
 
 
+def _getTimeStamps(ser):
+    """
+    Convert a Series of times (time stamps or strings obspy.UTCDateTime 
+    understands, eg 2010-01-01T00-00-00.5) to an array of float time stamps
+    """
+    if not len(ser):
+        return np.array([], dtype=np.float64)
+    stamps = np.array(pd.to_numeric(ser, errors='coerce'), dtype=np.float64)
+    isStr = np.isnan(stamps)
+    if not isStr.any():
+        return stamps
+    # times with - between hour, minute and second
+    strs = ser[isStr].astype(str).map(lambda x: _timeDashes.sub(r'T\1:\2:', x))
+    times = pd.to_datetime(strs, utc=True, errors='coerce')
+    epoch = pd.Timestamp('1970-01-01', tz='UTC')
+    parsed = np.array((times - epoch).dt.total_seconds(), dtype=np.float64)
+    # anything pandas could not parse goes through obspy (once per value)
+    missed = np.isnan(parsed)
+    if missed.any():
+        utcs = {x: obspy.UTCDateTime(x).timestamp
+                for x in set(ser[isStr][missed])}
+        parsed[missed] = [utcs[x] for x in ser[isStr][missed]]
+    stamps[isStr] = parsed
+    return stamps
+
+
+def _upgradeKeys(cl):
+    """
+    Make the template and station keys of ClusterStream cl (and its 
+    clusters) DetexKey instances, for instances pickled by older versions
+    """
+    for attr in ['temkey', 'stakey']:
+        key = getattr(cl, attr, None)
+        if isinstance(key, pd.DataFrame) and not isinstance(key, DetexKey):
+            keyType = 'template' if attr == 'temkey' else 'station'
+            setattr(cl, attr, readKey(key, keyType))
+    for clus in cl.clusters:
+        if hasattr(clus, 'temkey'):
+            clus.temkey = cl.temkey
+
+
 def inventory2StationKey(inv, starttime, endtime, fileName=None):
     """
     Function to create a station key from an obspy station inventory
@@ -751,7 +933,7 @@ def _getPicks(row, picks):
     phases = []
     if picks is None:
         return phases
-    phs = picks[picks.Event == row.NAME]
+    phs = picks.getPhases(row.NAME)
     for phind, ph in phs.iterrows():
         phases.append(_getPick(row, ph))
     return phases
@@ -759,7 +941,7 @@ def _getPicks(row, picks):
 
 def _getPick(row, ph):
     pick = obspy.core.event.Pick()
-    pick.time = obspy.UTCDateTime(ph.TimeStamp)
+    pick.time = obspy.UTCDateTime(ph.STAMP)
     pick.phase_hint = ph.Phase
     return pick
 
@@ -883,7 +1065,9 @@ def saveSQLite(DF, CorDB, Tablename, silent=True):
     """
 
     with connect(CorDB, detect_types=PARSE_DECLTYPES) as conn:
-
+        # tables in table_schemas are created with their declared types
+        if Tablename in table_schemas and not _hasTable(conn, Tablename):
+            conn.execute(_getCreateSQL(DF, Tablename))
         if os.path.exists(CorDB):
             detex.pandas_dbms.write_frame(
                 DF, Tablename, con=conn, flavor='sqlite', if_exists='append')
@@ -905,6 +1089,10 @@ def loadSQLite(corDB, tableName, sql=None, readExcpetion=False, silent=True,
         Table to load from sqlite database
     sql : str
         sql arguments to pass directly to database query
+    convertNumeric : bool
+        If True convert columns that are all numbers to numeric dtypes. 
+        The columns of tables in table_schemas are always cast to their
+        declared types, this only applies to undeclared columns
 
     Returns
     -------
@@ -920,20 +1108,288 @@ def loadSQLite(corDB, tableName, sql=None, readExcpetion=False, silent=True,
             msg = "read_sql returned the following error: %s" % (str(e))
             detex.log(__name__, msg, level='warning', pri=True)
             return None
-        if convertNumeric:
-            for item, ser in df.iteritems():
-                try:
-                    serConverted = pd.to_numeric(ser)
-                    df[item] = serConverted
-                except ValueError:
-                    pass
+        df = _applySchema(df, tableName, convertNumeric)
     return df
 
 
+def _convertNumeric(df, columns=None):
+    """
+    Convert the columns of df (or only those in columns) that are all 
+    numbers to numeric dtypes
+    """
+    for item, ser in df.iteritems():
+        if columns is not None and item not in columns:
+            continue
+        try:
+            serConverted = pd.to_numeric(ser)
+            df[item] = serConverted
+        except ValueError:
+            pass
+    return df
+
+
+# declared column types of the tables detex writes to sqlite, '*' is the
+# type of columns not listed
+_detTypes = {'DS': 'float', 'DS_STALTA': 'float', 'STMP': 'float',
+             'Name': 'str', 'Sta': 'str', 'MSTAMPmin': 'float',
+             'MSTAMPmax': 'float', 'Mag': 'float', 'SNR': 'float',
+             'ProEnMag': 'float'}
+_infoTypes = {'Name': 'str', 'Sta': 'str', 'Events': 'str',
+              'Threshold': 'float', 'NumBasisUsed': 'int', 'beta1': 'float',
+              'beta2': 'float', 'STALTAThreshold': 'float'}
+_histTypes = {'Name': 'str', 'Sta': 'str', 'Value': 'str'}
+table_schemas = {'ss_df': _detTypes, 'sg_df': _detTypes,
+                 'ss_info': _infoTypes, 'sg_info': _infoTypes,
+                 'ss_hist': _histTypes, 'sg_hist': _histTypes,
+                 'filt_params': {'FREQMIN': 'float', 'FREQMAX': 'float',
+                                 'CORNERS': 'int', 'ZEROPHASE': 'bool'},
+                 'ind': {'Path': 'str', 'FileName': 'str',
+                         'Starttime': 'float', 'Endtime': 'float',
+                         'Gaps': 'float', 'Nc': 'int', 'Nt': 'int',
+                         'Duration': 'float', 'Station': 'str'},
+                 'indkey': {'*': 'str'}}
+_sqlTypes = {'float': 'REAL', 'int': 'INTEGER', 'bool': 'INTEGER',
+             'str': 'TEXT'}
+
+
+def _castColumn(ser, colType):
+    """
+    Cast Series ser to colType (float, int, bool or str) of table_schemas, 
+    int columns with nulls become float
+    """
+    if colType == 'str':  # sqlite returns text as str
+        return ser
+    if colType == 'bool':
+        if ser.dtype.kind in 'biuf':
+            return ser.astype(bool)
+        return ser.astype(str).str.lower().isin(['true', '1', '1.0'])
+    dtype = np.float64 if colType == 'float' else np.int64
+    if ser.dtype == dtype:
+        return ser
+    try:
+        return ser.astype(dtype)
+    except (ValueError, TypeError):  # nulls in int column or bad values
+        return pd.to_numeric(ser, errors='coerce')
+
+
+def _applySchema(df, tableName, convertNumeric=True):
+    """
+    Cast the columns of df declared for tableName in table_schemas, the 
+    other columns are converted with _convertNumeric if convertNumeric
+    """
+    schema = table_schemas.get(tableName, {})
+    undeclared = []
+    for col in df.columns:
+        colType = schema.get(col, schema.get('*'))
+        if colType is None:
+            undeclared.append(col)
+        else:
+            df[col] = _castColumn(df[col], colType)
+    if convertNumeric and undeclared:
+        df = _convertNumeric(df, undeclared)
+    return df
+
+
+# indexes of detection tables (ss_df, sg_df) used by detResults
+detection_indexes = {'sta_mstamp': ['Sta', 'MSTAMPmin'],
+                     'sta_name_ds': ['Sta', 'Name', 'DS']}
+
+
+def _hasTable(con, tableName):
+    """
+    Return True if sqlite connection con has table tableName
+    """
+    sql = "SELECT name FROM sqlite_master WHERE type='table' AND name=?"
+    return con.execute(sql, (tableName,)).fetchone() is not None
+
+
+def _createDetectionIndexes(con, tableName):
+    """
+    Create the indexes in detection_indexes on table tableName (if it 
+    exists) of sqlite connection con, a warning is logged if the database
+    is read only
+    """
+    if not _hasTable(con, tableName):
+        return
+    for name, cols in detection_indexes.items():
+        sql = 'CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s)' % (
+            tableName, name, tableName, ', '.join(cols))
+        try:
+            con.execute(sql)
+        except OperationalError as e:
+            msg = 'could not index %s: %s' % (tableName, str(e))
+            detex.log(__name__, msg, level='warning')
+            return
+
+
+def _getSQLType(ser, tableName=None):
+    """
+    Return the sqlite column type (INTEGER, REAL or TEXT) of Series ser,
+    the type declared in table_schemas is used if tableName has one, 
+    object columns are typed by their first non null value
+    """
+    schema = table_schemas.get(tableName, {})
+    colType = schema.get(ser.name, schema.get('*'))
+    if colType is not None:
+        return _sqlTypes[colType]
+    kind = ser.dtype.kind
+    if kind == 'O':
+        vals = ser.dropna()
+        if len(vals) < 1:
+            return 'REAL'
+        val = vals.iloc[0]
+        if isinstance(val, (bool, np.bool_, numbers.Integral)):
+            kind = 'i'
+        elif isinstance(val, numbers.Real):
+            kind = 'f'
+    if kind in 'biu':
+        return 'INTEGER'
+    if kind == 'f':
+        return 'REAL'
+    return 'TEXT'
+
+
+def _getSQLValues(df):
+    """
+    Return the rows of DataFrame df as a list of tuples of python objects
+    that sqlite can bind (numpy scalars converted)
+    """
+    cols = []
+    for col in df.columns:
+        ser = df[col]
+        if ser.dtype.kind == 'O':
+            cols.append([x.item() if isinstance(x, np.generic) else x
+                         for x in ser])
+        else:
+            cols.append(ser.tolist())
+    return list(zip(*cols))
+
+
+def _getCreateSQL(df, tableName):
+    """
+    Return the statement creating table tableName with the columns of df
+    (typed by _getSQLType)
+    """
+    fields = ['"%s" %s' % (col, _getSQLType(df[col], tableName))
+              for col in df.columns]
+    return 'CREATE TABLE IF NOT EXISTS %s (%s)' % (tableName,
+                                                  ', '.join(fields))
+
+
+class DetectionStore(object):
+    """
+    Writer for the detection database (subspaceDB) of SubSpace.detex.
+    Owns one connection in WAL mode so several detection processes can
+    append to the same database (writers wait on each other for up to 
+    timeout seconds while readers are not blocked), creates typed tables
+    the first time a table is written and inserts rows in batches with one
+    prepared statement per table.
+    
+    Parameters
+    ----------
+    path : str
+        Path to the sqlite database (created if it does not exist)
+    batchSize : int
+        Number of buffered rows of a table that triggers a write
+    timeout : float
+        Seconds to wait on other writers before raising
+    """
+
+    def __init__(self, path, batchSize=500, timeout=60.):
+        self.path = path
+        self.batchSize = batchSize
+        self.con = connect(path, timeout=timeout, isolation_level=None)
+        self.con.execute('PRAGMA journal_mode=WAL')
+        self.con.execute('PRAGMA synchronous=NORMAL')
+        self._inserts = {}  # table: (columns, insert statement)
+        self._buffers = {}  # table: list of row tuples
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _prepare(self, df, tableName):
+        """
+        Create table tableName from the columns of df if needed, return 
+        the columns and insert statement of the table
+        """
+        if tableName not in self._inserts:
+            cols = [str(x) for x in df.columns]
+            if _hasTable(self.con, tableName):  # use existing column order
+                info = self.con.execute('PRAGMA table_info(%s)' % tableName)
+                cols = [x[1] for x in info.fetchall()]
+            else:
+                self.con.execute(_getCreateSQL(df, tableName))
+            sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+                tableName, ', '.join(['"%s"' % x for x in cols]),
+                ', '.join(['?'] * len(cols)))
+            self._inserts[tableName] = (cols, sql)
+        return self._inserts[tableName]
+
+    def write(self, df, tableName):
+        """
+        Append the rows of DataFrame df to table tableName, rows are 
+        buffered until batchSize rows are waiting or flush is called
+        """
+        if df is None or len(df) < 1:
+            return
+        cols, sql = self._prepare(df, tableName)
+        missing = set(cols) - set(df.columns)
+        if missing:
+            msg = '%s missing from rows written to %s' % (
+                sorted(missing), tableName)
+            detex.log(__name__, msg, level='error', e=ValueError)
+        buf = self._buffers.setdefault(tableName, [])
+        buf.extend(_getSQLValues(df[cols]))
+        if len(buf) >= self.batchSize:
+            self.flush(tableName)
+
+    def flush(self, tableName=None):
+        """
+        Write the buffered rows of tableName (all tables if None) in one
+        transaction
+        """
+        tables = self._buffers.keys() if tableName is None else [tableName]
+        for table in list(tables):
+            buf = self._buffers.get(table)
+            if not buf:
+                continue
+            self.con.execute('BEGIN IMMEDIATE')  # wait for other writers
+            try:
+                self.con.executemany(self._inserts[table][1], buf)
+            except Exception:
+                self.con.execute('ROLLBACK')
+                raise
+            self.con.execute('COMMIT')
+            self._buffers[table] = []
+
+    def createIndexes(self, tableNames=('ss_df', 'sg_df')):
+        """
+        Flush and create the indexes used by detResults (detection_indexes)
+        on the detection tables in tableNames
+        """
+        self.flush()
+        for tableName in tableNames:
+            _createDetectionIndexes(self.con, tableName)
+
+    def close(self):
+        """
+        Flush buffered rows and close the connection
+        """
+        if self.con is None:
+            return
+        self.flush()
+        self.con.close()
+        self.con = None
+
+
 def loadClusters(filename='clust.pkl'):
     """
     Function that uses pandas.read_pickle to load a pickled cluster
-    (instance of detex.subspace.ClusterStream)
+    (instance of detex.subspace.ClusterStream), or detex.persist to load 
+    one written with binary=True
     Parameters
     ----------
     filename : str
@@ -942,29 +1398,42 @@ def loadClusters(filename='clust.pkl'):
     ----------
     An instance of detex.subspace.ClusterStream 
     """
-    cl = pd.read_pickle(filename)
+    if detex.persist.isBinary(filename):
+        cl = detex.persist.readBinary(filename)
+    else:
+        cl = pd.read_pickle(filename)
     if not isinstance(cl, detex.subspace.ClusterStream):
         msg = '%s is not a ClusterStream instance' % filename
         detex.log(__name__, msg, level='error')
+    _upgradeKeys(cl)
     return cl
 
 
-def loadSubSpace(filename='subspace.pkl'):
+def loadSubSpace(filename='subspace.pkl', stations=None):
     """
     Function that uses pandas.read_pickle to load a pickled subspace
-    (instance of detex.subspace.SubSpaceStream)
+    (instance of detex.subspace.SubSpaceStream), or detex.persist to load 
+    one written with binary=True
     Parameters
     ----------
     filename : str
         Path to the saved subspace instance
+    stations : None or list of str
+        Only used if filename was written with binary=True. If a list of 
+        stations is passed only the subspaces and singles on those stations
+        are loaded, else all are loaded
     Returns
     ----------
     An instance of detex.subspace.SubSpaceStream 
     """
-    ss = pd.read_pickle(filename)
+    if detex.persist.isBinary(filename):
+        ss = detex.persist.readBinary(filename, stations=stations)
+    else:
+        ss = pd.read_pickle(filename)
     if not isinstance(ss, detex.subspace.SubSpace):
         msg = '%s is not a SubSpaceStream instance' % filename
         detex.log(__name__, msg, level='error')
+    _upgradeKeys(ss.clusters)
     return ss
 
 
@@ -13,6 +13,10 @@ import os
 import glob
 import sys
 
+import numpy as np
+import obspy
+import pandas as pd
+
 ##### add paths so that all the detex dependents can simply be in the same dir
 ## add detex path to start of python path (doesnt test installed version)
 pypo_path = os.path.dirname(os.path.dirname(__file__))
@@ -70,4 +74,111 @@ def pytest_addoption(parser):
 
 # Create Subpace
 
-        
+
+###### Synthetic events
+syn_rate = 20.  # sampling rate of the synthetic events
+syn_channels = ['BHZ', 'BHN']
+
+
+def _syn_wavelets():
+    """
+    return the 3 wavelets the synthetic events are made from, events with 
+    the same wavelet form a cluster
+    """
+    t = np.arange(0, 30, 1. / syn_rate)
+    return [np.exp(-((t - 12) / 1.5) ** 2) * np.sin(2 * np.pi * 3 * t),
+            np.exp(-((t - 15) / 1.0) ** 2) * np.sin(2 * np.pi * 5 * t + 1),
+            np.exp(-((t - 8) / 3.0) ** 2) * np.sin(2 * np.pi * t ** 1.3)]
+
+
+@pytest.fixture
+def synthetic_events(tmpdir):
+    """
+    Write 9 synthetic events (an hour apart) recorded on station TA.SYN to
+    an EventWaveForms directory with a station key and template key. Events
+    e0 to e7 alternate between two wavelets (two clusters), e8 is a 
+    singleton. Returns the directory
+    """
+    root = str(tmpdir.join('synthetic'))
+    evedir = os.path.join(root, 'EventWaveForms')
+    rs = np.random.RandomState(0)
+    wavelets = _syn_wavelets()
+    t0 = obspy.UTCDateTime('2010-01-01')
+    rows = []
+    for num in range(9):
+        name = 'e%d' % num
+        otime = t0 + 3600 * num
+        wavelet = wavelets[2] if num == 8 else wavelets[num % 2]
+        st = obspy.Stream()
+        for cnum, chan in enumerate(syn_channels):
+            data = rs.randn(int(120 * syn_rate)) * .05
+            start = int(10 * syn_rate) + rs.randint(-5, 5)
+            data[start:start + len(wavelet)] += wavelet * (1 + cnum)
+            tr = obspy.Trace(data)
+            tr.stats.sampling_rate = syn_rate
+            tr.stats.starttime = otime - 20
+            tr.stats.network, tr.stats.station = 'TA', 'SYN'
+            tr.stats.channel = chan
+            st += tr
+        os.makedirs(os.path.join(evedir, name))
+        st.write(os.path.join(evedir, name, 'TA.SYN.%s.msd' % name), 'mseed')
+        rows.append([name, str(otime), 40., -111., 1. + .1 * num, 5.])
+    detex.getdata.indexDirectory(evedir)
+    temkey = pd.DataFrame(rows, columns=['NAME', 'TIME', 'LAT', 'LON', 'MAG',
+                                         'DEPTH'])
+    temkey.to_csv(os.path.join(root, 'TemplateKey.csv'), index=False)
+    stakey = pd.DataFrame([['TA', 'SYN', '2009-01-01', '2011-01-01', 40.,
+                            -111., 1000., '-'.join(syn_channels)]],
+                          columns=['NETWORK', 'STATION', 'STARTTIME',
+                                   'ENDTIME', 'LAT', 'LON', 'ELEVATION',
+                                   'CHANNELS'])
+    stakey.to_csv(os.path.join(root, 'StationKey.csv'), index=False)
+    return root
+
+
+@pytest.fixture
+def cluster_kwargs(synthetic_events):
+    """
+    createCluster arguments for the synthetic events
+    """
+    root = synthetic_events
+    return dict(fetch_arg=os.path.join(root, 'EventWaveForms'),
+                stationKey=os.path.join(root, 'StationKey.csv'),
+                templateKey=os.path.join(root, 'TemplateKey.csv'),
+                trim=[5, 25], filt=[1, 8, 2, True], CCreq=.5, saveclust=False)
+
+
+@pytest.fixture
+def synthetic_cluster(cluster_kwargs):
+    """
+    ClusterStream of the synthetic events (holding their waveforms)
+    """
+    return detex.createCluster(keepWaveforms=True, **cluster_kwargs)
+
+
+@pytest.fixture
+def subset_key(synthetic_events):
+    """
+    Return a function that writes a template key of some of the synthetic
+    events and returns its path
+    """
+    temkey = pd.read_csv(os.path.join(synthetic_events, 'TemplateKey.csv'))
+
+    def write(events):
+        path = os.path.join(synthetic_events, '%s.csv' % '_'.join(events))
+        temkey[temkey.NAME.isin(events)].to_csv(path, index=False)
+        return path
+    return write
+
+
+@pytest.fixture
+def synthetic_subspace(synthetic_events, synthetic_cluster):
+    """
+    SubSpace of the synthetic cluster with its SVD performed (thresholds 
+    set from the fractional energy so no continuous data are needed)
+    """
+    fetcher = detex.getdata.quickFetch(os.path.join(synthetic_events,
+                                                    'EventWaveForms'))
+    ss = detex.createSubSpace(clust=synthetic_cluster, conDatFetcher=fetcher)
+    ss.SVD(selectCriteria=3, selectValue=.5)
+    return ss
@@ -7,9 +7,12 @@ tests for construct module
 """
 import detex
 import os
+import pickle
 import numpy as np
 import obspy
+import pandas as pd
 import pytest
+from scipy.cluster.hierarchy import linkage
 
 
 ##### Tests for waveforms handling
@@ -57,4 +60,143 @@ class Test_merge_channels():
         st = load_gap_all_chans
         st_out = detex.construct._mergeChannels(st)
         nc = len(set([x.stats.channel for x in st_out]))
-        assert nc == len(st_out) 
\ No newline at end of file
+        assert nc == len(st_out) 
+
+
+##### Tests for alignment delays
+class Test_get_delays():
+    def test_consistent_lags_recover_offsets(self):
+        # lags between events that are exactly consistent with offsets
+        offsets = np.array([0, 12, -7, 30, 3])
+        i, j = np.triu_indices(len(offsets), 1)
+        lags = (offsets[j] - offsets[i]).astype(float)
+        cx = 1 - np.linspace(.95, .6, len(lags))
+        link = linkage(cx)
+        delays = detex.construct._getDelays(link, cx, -lags)
+        aligned = offsets + delays  # aligned events have the same offset
+        assert len(set(aligned)) == 1
+
+    def test_deterministic_with_equal_ccs(self):
+        cx = np.full(10, .2)  # all pairs equally similar
+        lags = np.arange(10.)
+        link = linkage(cx)
+        d1 = detex.construct._getDelays(link, cx, lags)
+        d2 = detex.construct._getDelays(link, cx, lags)
+        assert np.array_equal(d1, d2)
+
+
+##### Tests for start time updates in subspace creation
+class Test_update_start_times():
+    def test_uses_template_info(self):
+        temkey = pd.DataFrame({'NAME': ['ev1', 'ev2'], 'MAG': [1.5, 2.0],
+                               'TIME': ['2010-01-01T00-00-00',
+                                        '2010-01-01T01-00-00'],
+                               'LAT': [40, 40], 'LON': [-111, -111],
+                               'DEPTH': [1, 1]})
+        temkey = detex.util.readKey(temkey, 'template')
+        temInfo = detex.construct._getTemInfo(temkey)
+        otime = obspy.UTCDateTime('2010-01-01T01:00:00').timestamp
+        assert temInfo['ev2'] == (otime, 2.0)
+        stats = {x: {'Nc': 3, 'sampling_rate': 50., 'starttime': y}
+                 for x, y in zip(temkey.NAME, [otime - 3600, otime + 5])}
+        srow = pd.Series({'Stats': stats})
+        delayDF = pd.DataFrame({'Events': ['ev2', 'ev1'],
+                                'SampleDelays': [300, 0]})
+        out = detex.construct._updateStartTimes(srow, delayDF, temInfo)
+        assert np.isclose(out['ev2']['starttime'], otime + 7)
+        assert np.isclose(out['ev2']['offset'], 7)
+        assert out['ev1']['magnitude'] == 1.5
+        assert np.isclose(out['ev1']['offset'], 0)
+
+    def test_template_info_without_stamps(self):
+        temkey = pd.DataFrame({'NAME': ['ev1'], 'MAG': [1.5],
+                               'TIME': ['2010-01-01T01-00-00']})
+        temInfo = detex.construct._getTemInfo(temkey)
+        otime = obspy.UTCDateTime('2010-01-01T01:00:00').timestamp
+        assert temInfo == {'ev1': (otime, 1.5)}
+
+
+##### Tests for lazily calculated spectra
+class Test_lazy_spectra():
+    def test_cache_eviction(self):
+        cache = detex.construct._SpectraCache(maxBytes=3 * 800)
+        arrays = {x: np.full(100, float(x)) for x in range(5)}  # 800 bytes
+        for key in range(3):
+            cache.get(key, lambda: arrays[key])
+        cache.get(0, lambda: None)  # 0 is now the most recently used
+        cache.get(3, lambda: arrays[3])
+        assert list(cache._cache.keys()) == [2, 0, 3]  # 1 dropped
+        assert cache.nbytes == 3 * 800
+        out = cache.get(1, lambda: arrays[1] * 2)  # recalculated
+        assert np.all(out == 2)
+        assert cache.nbytes <= cache.maxBytes
+        cache.clear()
+        assert cache.nbytes == 0 and not cache._cache
+
+    def test_spectra_evicted_and_recalculated(self, monkeypatch):
+        rs = np.random.RandomState(0)
+        mptd = {'e%d' % x: rs.randn(100) for x in range(4)}
+        size = detex.construct._getSpectrum(mptd['e0']).nbytes
+        cache = detex.construct._SpectraCache(maxBytes=2 * size)
+        monkeypatch.setattr(detex.construct, 'spectraCache', cache)
+        lazy = detex.construct.LazySpectra(mptd)
+        for _ in range(2):
+            for key in sorted(mptd):
+                expected = detex.construct._getSpectrum(mptd[key])
+                assert np.allclose(lazy[key], expected)
+                assert cache.nbytes <= 2 * size
+        assert len(cache._cache) == 2
+
+    def test_replaced_array(self):
+        rs = np.random.RandomState(1)
+        mptd = {'e0': rs.randn(100)}
+        lazy = detex.construct.LazySpectra(mptd)
+        lazy['e0']
+        for _ in range(3):
+            del mptd['e0']  # free the array so its id can be reused
+            mptd['e0'] = rs.randn(100)
+            expected = detex.construct._getSpectrum(mptd['e0'])
+            assert np.allclose(lazy['e0'], expected)
+        mptd['e0'] = mptd['e0'][:80]  # trimmed
+        expected = detex.construct._getSpectrum(mptd['e0'])
+        assert np.allclose(lazy['e0'], expected)
+
+    def test_pickle(self):
+        mptd = {'e0': np.random.RandomState(2).randn(100)}
+        lazy = detex.construct.LazySpectra(mptd)
+        lazy['e0']
+        lazy2 = pickle.loads(pickle.dumps(lazy))
+        assert lazy2._token != lazy._token
+        assert np.allclose(lazy2['e0'], lazy['e0'])
+
+
+##### Tests for adding events to a cluster analysis
+class Test_update_cluster():
+    @pytest.mark.parametrize('keep', [False, True])
+    def test_matches_create_cluster(self, cluster_kwargs, subset_key, keep):
+        initKey = subset_key(['e%d' % x for x in range(6)])
+        cl = detex.createCluster(**dict(cluster_kwargs, templateKey=initKey,
+                                        keepWaveforms=keep))
+        assert ('MPtd' in cl.trdf.columns) == keep
+        clu = detex.construct.updateCluster(cl, cluster_kwargs['templateKey'],
+                                            saveclust=False)
+        clf = detex.createCluster(**cluster_kwargs)
+        assert ('MPtd' in clu.trdf.columns) == keep
+        assert list(clu.temkey.NAME) == list(clf.temkey.NAME)
+        assert list(clu.trdf.Events[0]) == list(clf.trdf.Events[0])
+        for col in ['CCs', 'Lags', 'Subsamp']:
+            ar1 = np.asarray(clu.trdf[col][0], dtype=float)
+            ar2 = np.asarray(clf.trdf[col][0], dtype=float)
+            assert np.allclose(ar1, ar2, equal_nan=True)
+        assert np.allclose(clu.trdf.Link[0], clf.trdf.Link[0])
+        clusts1 = sorted(sorted(x) for x in clu['TA.SYN'].clusts)
+        clusts2 = sorted(sorted(x) for x in clf['TA.SYN'].clusts)
+        assert clusts1 == clusts2 == [['e0', 'e2', 'e4', 'e6'],
+                                      ['e1', 'e3', 'e5', 'e7']]
+        assert clu['TA.SYN'].singles == clf['TA.SYN'].singles == ['e8']
+
+    def test_nothing_new(self, synthetic_cluster, cluster_kwargs):
+        clu = detex.construct.updateCluster(synthetic_cluster,
+                                            cluster_kwargs['templateKey'],
+                                            saveclust=False)
+        assert clu is synthetic_cluster
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+tests for detect module
+"""
+import detex
+import numpy as np
+import pytest
+
+
+##### Tests for sta/lta of detection statistic
+@pytest.fixture(scope='module')
+def ds_vector():
+    rs = np.random.RandomState(42)
+    ds = rs.beta(1.5, 40, size=5000)
+    ds[2500] = .8  # a detection like spike
+    return ds
+
+
+class Test_sta_lta():
+    def test_rolling_mean_matches_window_mean(self, ds_vector):
+        win = 101
+        rm = detex.detect._rollingMean(ds_vector, win)
+        assert len(rm) == len(ds_vector)
+        # interior values are the mean of the centered window
+        ind = 1000
+        expected = ds_vector[ind - win // 2: ind - win // 2 + win].mean()
+        assert np.isclose(rm[ind], expected)
+        # edges take the value of the nearest full window
+        assert rm[0] == rm[win // 2]
+        assert rm[-1] == rm[len(ds_vector) - win + win // 2]
+
+    def test_sta_lta_peaks_at_spike(self, ds_vector):
+        stalta = detex.detect._getStaLtaArray(ds_vector, 500, 0)
+        assert len(stalta) == len(ds_vector)
+        assert stalta.argmax() == 2500
+        assert np.all(np.isfinite(stalta))
+
+    def test_zero_lta_is_zero(self):
+        stalta = detex.detect._getStaLtaArray(np.zeros(100), 10, 2)
+        assert not np.any(stalta)
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""
+tests for fas module
+"""
+import detex
+import os
+import random
+import numpy as np
+import obspy
+import pandas as pd
+import pytest
+import scipy.stats
+
+
+##### Tests for the null space sample cache
+@pytest.fixture
+def cache_key():
+    return {'filt': [1, 10, 2, True], 'decimate': None, 'Nc': 3}
+
+
+class _FakeFetcher(object):
+    """
+    Continuous data fetcher returning reproducible noise, each fetch is 
+    logged (one line per fetch) to logPath so fetches made by other 
+    processes can be counted
+    """
+    method = 'dir'
+    client = None
+    removeResponse = False
+    opType = 'VEL'
+    prefilt = [.05, .1, 15, 20]
+    conDatDuration = 600
+    conBuff = 20
+
+    def __init__(self, directory, logPath):
+        self.directory = directory
+        self.logPath = logPath
+
+    def getStream(self, start, end, net, sta, chan='???', loc='??'):
+        with open(self.logPath, 'a') as fi:
+            fi.write('%s.%s %s\n' % (net, sta, start.timestamp))
+        seed = int(start.timestamp) % 2 ** 31 + len(sta)
+        rs = np.random.RandomState(seed)
+        st = obspy.Stream()
+        for ch in chan:
+            tr = obspy.Trace(rs.randn(int((end - start) * 20)))
+            tr.stats.sampling_rate = 20.
+            tr.stats.starttime = start
+            tr.stats.network, tr.stats.station, tr.stats.channel = net, sta, ch
+            st += tr
+        return st
+
+    def fetches(self):
+        if not os.path.exists(self.logPath):
+            return []
+        with open(self.logPath) as fi:
+            return [tuple(x.split()) for x in fi.read().splitlines()]
+
+
+class _FakeCluster(object):
+    filt = [1, 8, 2, True]
+    decimate = None
+
+    def __init__(self, stations):
+        rows = [[net, sta, '2010-01-01', '2010-01-11', 40., -111., 1000.,
+                 'BHZ-BHN'] for net, sta in [x.split('.') for x in stations]]
+        cols = ['NETWORK', 'STATION', 'STARTTIME', 'ENDTIME', 'LAT', 'LON',
+                'ELEVATION', 'CHANNELS']
+        self.stakey = detex.util.readKey(pd.DataFrame(rows, columns=cols),
+                                         'station')
+
+
+def _make_detectors(stations, numPerStation=2, seed=0):
+    """
+    make subspace detectors (rows with 2 random basis vectors for 2 
+    channels) for _initFAS
+    """
+    rs = np.random.RandomState(seed)
+    detectors = {}
+    for sta in stations:
+        for num in range(numPerStation):
+            basis = rs.randn(2, 200)
+            basis /= np.linalg.norm(basis, axis=1)[:, np.newaxis]
+            row = pd.Series({'UsedSVDKeys': [2., 1.],
+                             'SVD': {2.: basis[0], 1.: basis[1]},
+                             'Channels': {'e0': ['BHZ', 'BHN']},
+                             'Stats': {'e0': {'sampling_rate': 20.,
+                                              'Nc': 2}}})
+            detectors.setdefault(sta, []).append(((sta, num), row, True))
+    return detectors
+
+
+@pytest.fixture
+def fake_fas(tmpdir):
+    stations = ['TA.AAA', 'TA.BBB']
+    fetcher = _FakeFetcher(str(tmpdir), str(tmpdir.join('fetches.log')))
+    return _make_detectors(stations), _FakeCluster(stations), fetcher
+
+
+def _run_fas(fake_fas, conDatNum=4, **kwargs):
+    detectors, cluster, fetcher = fake_fas
+    random.seed(0)  # for the random continuous data chunks
+    return detex.fas._initFAS(detectors, conDatNum, cluster, fetcher,
+                              **kwargs)
+
+
+class Test_sample_cache():
+    def test_write_read(self, tmpdir, cache_key):
+        cdir = str(tmpdir)
+        assert detex.fas._readSampleCache(cdir, 'TA.M17A', cache_key) is None
+        detex.fas._clearSampleCache(cdir, 'TA.M17A')
+        starts, files = [], []
+        for utc, ar in [(obspy.UTCDateTime(10.), np.arange(6.)),
+                        (obspy.UTCDateTime(20.5), np.ones(4))]:
+            fname = detex.fas._saveSample(cdir, 'TA.M17A', utc, ar)
+            starts.append(utc.timestamp)
+            files.append(fname)
+            detex.fas._writeSampleCache(cdir, 'TA.M17A', cache_key, starts,
+                                        files)
+        assert len(set(files)) == 2
+        cache = detex.fas._readSampleCache(cdir, 'TA.M17A', cache_key)
+        assert cache == {'starts': [10., 20.5], 'files': files}
+        ar = detex.fas._loadSample(cdir, 'TA.M17A', cache['files'][1])
+        assert np.all(ar == 1) and len(ar) == 4
+        assert not [x for x in os.listdir(os.path.join(cdir, 'TA.M17A'))
+                    if x.endswith('.tmp')]
+
+    def test_changed_key_invalidates(self, tmpdir, cache_key):
+        cdir = str(tmpdir)
+        detex.fas._clearSampleCache(cdir, 'TA.M17A')
+        fname = detex.fas._saveSample(cdir, 'TA.M17A', obspy.UTCDateTime(10.),
+                                      np.arange(6.))
+        detex.fas._writeSampleCache(cdir, 'TA.M17A', cache_key, [10.],
+                                    [fname])
+        cache_key['decimate'] = 2
+        assert detex.fas._readSampleCache(cdir, 'TA.M17A', cache_key) is None
+
+    def test_key_includes_source(self, fake_fas, tmpdir):
+        detectors, cluster, fetcher = fake_fas
+        info = {'stakey': cluster.stakey.iloc[0], 'Nc': 2,
+                'utc1': obspy.UTCDateTime(0), 'utc2': obspy.UTCDateTime(10)}
+        params = {'filt': cluster.filt, 'deci': None, 'dtype': 'double',
+                  'STATime': .5, 'LTATime': 5}
+        key1 = detex.fas._getSampleCacheKey(info, params, fetcher, 8)
+        fetcher.directory = str(tmpdir.join('other'))
+        key2 = detex.fas._getSampleCacheKey(info, params, fetcher, 8)
+        assert key1 != key2
+        assert key1['source']['method'] == 'dir'
+
+    def test_samples_written_and_reused(self, fake_fas, tmpdir):
+        cdir = str(tmpdir.join('NullSpaceSamples'))
+        fetcher = fake_fas[2]
+        res1 = _run_fas(fake_fas, sampleCache=cdir)
+        fetched = fetcher.fetches()
+        assert len(fetched) == 8
+        for sta in ['TA.AAA', 'TA.BBB']:
+            files = [x for x in os.listdir(os.path.join(cdir, sta))
+                     if x.endswith('.npy')]
+            assert len(files) == 4
+        # a second call uses the cached samples and fetches nothing
+        res2 = _run_fas(fake_fas, sampleCache=cdir)
+        assert len(fetcher.fetches()) == len(fetched)
+        for key in res1:
+            assert np.allclose(res1[key]['betadist'], res2[key]['betadist'])
+        # a different data source replaces the samples
+        fetcher.directory = str(tmpdir.join('other'))
+        _run_fas(fake_fas, sampleCache=cdir)
+        assert len(fetcher.fetches()) == 2 * len(fetched)
+        files = [x for x in os.listdir(os.path.join(cdir, 'TA.AAA'))
+                 if x.endswith('.npy')]
+        assert len(files) == 4
+
+    def test_no_cache_by_default(self, fake_fas, tmpdir):
+        _run_fas(fake_fas)
+        assert sorted(os.listdir(str(tmpdir))) == ['fetches.log']
+
+
+##### Tests for sampling the null space with several processes
+class Test_parallel_fas():
+    def test_processes_match(self, fake_fas, tmpdir):
+        fetcher = fake_fas[2]
+        res1 = _run_fas(fake_fas, processes=1)
+        fetched1 = fetcher.fetches()
+        os.remove(fetcher.logPath)
+        res2 = _run_fas(fake_fas, processes=2)
+        fetched2 = fetcher.fetches()
+        assert sorted(res1) == sorted(res2)
+        for key in res1:
+            assert np.allclose(res1[key]['betadist'], res2[key]['betadist'])
+            assert np.array_equal(res1[key]['hist'], res2[key]['hist'])
+        assert sorted(fetched1) == sorted(fetched2)
+
+    @pytest.mark.parametrize('processes', [1, 2])
+    def test_fetched_once_per_station(self, fake_fas, processes):
+        # two detectors on each station share each sample
+        fetcher = fake_fas[2]
+        _run_fas(fake_fas, conDatNum=5, processes=processes)
+        fetched = fetcher.fetches()
+        assert len(fetched) == len(set(fetched)) == 10
+        assert sorted(set(x[0] for x in fetched)) == ['TA.AAA', 'TA.BBB']
+
+
+##### Tests for the memory used by null space sampling
+class Test_fas_memory():
+    def _peak(self, fake_fas, conDatNum, **kwargs):
+        tracemalloc = pytest.importorskip('tracemalloc')
+        tracemalloc.start()
+        try:
+            res = _run_fas(fake_fas, conDatNum=conDatNum, **kwargs)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        return res, peak
+
+    @pytest.mark.parametrize('cache', [False, True])
+    def test_independent_of_condatnum(self, fake_fas, tmpdir, cache):
+        kwargs = {}
+        if cache:
+            kwargs['sampleCache'] = str(tmpdir.join('NullSpaceSamples'))
+        self._peak(fake_fas, 2, **kwargs)  # warm up (imports, fft plans)
+        res1, peak1 = self._peak(fake_fas, 4, **kwargs)
+        res2, peak2 = self._peak(fake_fas, 16, **kwargs)
+        # the statistics of one sample (per detector) are about 270 kB,
+        # holding the 12 extra samples would add over 6 MB
+        assert peak2 - peak1 < 1024 ** 2
+        for key in res1:
+            for name in ['bins', 'hist']:
+                assert res1[key][name].shape == res2[key][name].shape
+            assert res2[key]['hist'].sum() > 3 * res1[key]['hist'].sum()
+
+
+##### Tests for the streaming beta fit
+@pytest.fixture(scope='module')
+def ds_chunks():
+    rs = np.random.RandomState(0)
+    return [rs.beta(1.2, 90, size=20000) for _ in range(5)]
+
+
+class Test_streaming_fit():
+    params = {'histBins': np.linspace(-.01, 1, 401), 'triggerLTATime': 5,
+              'triggerSTATime': 0}
+
+    def _stats(self, chunks):
+        stats = None
+        for ds in chunks:
+            new = detex.fas._getDSStats(ds, 20, self.params)
+            stats = detex.fas._addDSStats(stats, new)
+        return stats
+
+    def test_beta_fit_matches_mle(self, ds_chunks):
+        stats = self._stats(ds_chunks)
+        a, b, loc, scale = detex.fas._fitBeta(stats)
+        alld = np.concatenate(ds_chunks)
+        a2, b2 = scipy.stats.beta.fit(alld, floc=0, fscale=1)[:2]
+        assert (loc, scale) == (0, 1)
+        assert abs(a - a2) / a2 < .01
+        assert abs(b - b2) / b2 < .01
+        nnlf = detex.fas._betaNNLF((a, b, 0, 1), stats)
+        assert np.isclose(nnlf, scipy.stats.beta.nnlf((a, b, 0, 1), alld))
+
+    def test_stats_combine(self, ds_chunks):
+        stats = self._stats(ds_chunks)
+        assert stats['moments'][0] == 100000
+        assert stats['fine'].sum() == 100000
+        assert stats['hist'].sum() == 100000
+        assert detex.fas._fitSTALTA(stats)[0] > 0
+
+
+##### Tests for the vectorized beta threshold solver
+class Test_beta_thresholds():
+    def test_matches_survival_function(self):
+        beta_a = np.array([.5, 1., 1.3, 40.])
+        beta_b = np.array([100., 100., 300., 60.])
+        for Pf in [1e-3, 1e-8, 1e-12]:
+            th = detex.fas._getBetaThresholds(Pf, beta_a, beta_b)
+            pfs = scipy.stats.beta.sf(th, beta_a, beta_b)
+            assert np.allclose(pfs / Pf, 1, rtol=1e-6)
+
+    def test_invalid_is_nan(self):
+        th = detex.fas._getBetaThresholds(1e-8, [np.nan, -1, 2], [3, 3, 3])
+        assert np.all(np.isnan(th[:2]))
+        assert np.isfinite(th[2])
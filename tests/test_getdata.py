@@ -8,6 +8,9 @@ tests for get data module
 import pytest
 import detex
 import obspy
+import glob
+import os
+import numpy as np
 from collections import namedtuple
 
 ##### General tests on method inputs
@@ -284,4 +287,64 @@ class TestNEICFetcher():
     
     
     
-    
\ No newline at end of file
+    
+
+##### Tests for waveform extraction from directories
+@pytest.fixture
+def con_dir(tmpdir):
+    root = str(tmpdir.join('ContinuousWaveForms'))
+    t0 = obspy.UTCDateTime('2010-01-01')
+    rs = np.random.RandomState(0)
+    for hour in range(3):
+        st = obspy.Stream()
+        for chan in ['BHZ', 'BHN']:
+            tr = obspy.Trace(rs.randn(3600 * 10))
+            tr.stats.sampling_rate = 10
+            tr.stats.starttime = t0 + 3600 * hour
+            tr.stats.network, tr.stats.station = 'TA', 'M17A'
+            tr.stats.channel = chan
+            st += tr
+        path, fname = detex.getdata._makePathFile(root, 'TA.M17A', 
+                                                  t0 + 3600 * hour)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        st.write(os.path.join(path, fname + '.msd'), 'mseed')
+    detex.getdata.indexDirectory(root)
+    return root, t0
+
+
+class TestExtractWaveforms():
+    def test_matches_get_stream(self, con_dir, tmpdir):
+        root, t0 = con_dir
+        fetcher = detex.getdata.DataFetcher('dir', directoryName=root,
+                                            removeResponse=False)
+        reqs = []
+        for num, utc in enumerate([t0 + 100, t0 + 3590, t0 + 7300]):
+            path = str(tmpdir.join('TA.M17A.e%d.msd' % num))
+            reqs.append((path, utc - 60, utc + 240, 'e%d' % num))
+        written = detex.getdata.extractWaveforms(fetcher, 
+                                                 {('TA', 'M17A'): reqs})
+        assert sorted(written) == sorted([x[0] for x in reqs])
+        for path, start, end, name in reqs:
+            st1 = obspy.read(path).sort()
+            st2 = fetcher.getStream(start, end, 'TA', 'M17A').sort()
+            assert len(st1) == len(st2) == 2
+            for tr1, tr2 in zip(st1, st2):
+                assert tr1.stats.starttime == tr2.stats.starttime
+                assert np.allclose(tr1.data, tr2.data)
+
+    def test_update_index(self, con_dir):
+        root, t0 = con_dir
+        t1, t2 = t0.timestamp, t0.timestamp + 86400
+        st = obspy.read(glob.glob(os.path.join(root, '*', '*', '*', '*'))[0])
+        st[0].stats.station = st[1].stats.station = 'M18A'
+        path = os.path.join(root, 'TA.M18A', 'new', 'TA.M18A.msd')
+        os.makedirs(os.path.dirname(path))
+        st.write(path, 'mseed')
+        detex.getdata.updateIndex(root, [path])
+        detex.getdata.updateIndex(root, [path])  # replaced, not duplicated
+        df = detex.getdata._loadIndexDb(root, 'TA.M18A', t1, t2)
+        assert len(df) == 1
+        assert os.path.join(df.Path[0], df.FileName[0]).endswith(
+            os.path.join('TA.M18A', 'new', 'TA.M18A.msd'))
+        assert len(detex.getdata._loadIndexDb(root, 'TA.M17A', t1, t2)) == 3
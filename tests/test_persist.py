@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+tests for the binary (directory based) storage of ClusterStream and 
+SubSpace instances
+"""
+import detex
+import os
+import numpy as np
+import pytest
+
+
+def _assert_dicts_equal(dic1, dic2):
+    assert set(dic1.keys()) == set(dic2.keys())
+    for key in dic1:
+        assert np.array_equal(dic1[key], dic2[key])
+
+
+##### Tests for ClusterStream round trips
+class Test_cluster_round_trip():
+    @pytest.mark.parametrize('mmap', [True, False])
+    def test_round_trip(self, synthetic_cluster, tmpdir, mmap):
+        path = str(tmpdir.join('clust'))
+        synthetic_cluster.write(path, binary=True)
+        assert detex.persist.isBinary(path)
+        assert detex.persist.readManifest(path)['class'] == 'ClusterStream'
+        cl = detex.persist.readBinary(path, mmap=mmap)
+        assert isinstance(cl, detex.subspace.ClusterStream)
+        assert cl.stalist == synthetic_cluster.stalist
+        assert cl['TA.SYN'].clusts == synthetic_cluster['TA.SYN'].clusts
+        for col in ['Link', 'CCs', 'Lags']:
+            assert np.allclose(np.asarray(cl.trdf[col][0], dtype=float),
+                               np.asarray(synthetic_cluster.trdf[col][0],
+                                          dtype=float), equal_nan=True)
+        mptd = cl.trdf.MPtd[0]
+        _assert_dicts_equal(mptd, synthetic_cluster.trdf.MPtd[0])
+        assert all(isinstance(x, np.memmap) == mmap for x in mptd.values())
+
+    def test_load_clusters(self, synthetic_cluster, tmpdir):
+        path = str(tmpdir.join('clust'))
+        synthetic_cluster.write(path, binary=True)
+        cl = detex.loadClusters(path)
+        assert cl['TA.SYN'].clusts == synthetic_cluster['TA.SYN'].clusts
+
+    def test_not_binary(self, tmpdir):
+        with pytest.raises(IOError):
+            detex.persist.readBinary(str(tmpdir))
+
+
+##### Tests for SubSpace round trips
+class Test_subspace_round_trip():
+    @pytest.mark.parametrize('mmap', [True, False])
+    def test_round_trip(self, synthetic_subspace, tmpdir, mmap):
+        path = str(tmpdir.join('subspace'))
+        synthetic_subspace.write(path, binary=True)
+        ss = detex.persist.readBinary(path, mmap=mmap)
+        assert isinstance(ss, detex.subspace.SubSpace)
+        assert ss.Stations == synthetic_subspace.Stations
+        for frames1, frames2 in [(ss.subspaces, synthetic_subspace.subspaces),
+                                 (ss.singles, synthetic_subspace.singles)]:
+            assert set(frames1) == set(frames2)
+            for sta in frames1:
+                df1, df2 = frames1[sta], frames2[sta]
+                assert 'MPfd' not in df1.columns
+                assert [list(x) for x in df1.Events] == \
+                    [list(x) for x in df2.Events]
+                for ind in df1.index:
+                    _assert_dicts_equal(df1.AlignedTD[ind], df2.AlignedTD[ind])
+                    assert list(df1.Threshold) == list(df2.Threshold)
+        for svd1, svd2 in zip(ss.subspaces['TA.SYN'].SVD,
+                              synthetic_subspace.subspaces['TA.SYN'].SVD):
+            _assert_dicts_equal(svd1, svd2)
+        assert ss.singletons is ss.singles
+
+    @pytest.mark.parametrize('stations', ['SYN', 'TA.SYN', ['TA.SYN', 'XX']])
+    def test_stations(self, synthetic_subspace, tmpdir, stations):
+        path = str(tmpdir.join('subspace'))
+        synthetic_subspace.write(path, binary=True)
+        ss = detex.loadSubSpace(path, stations=stations)
+        assert ss.Stations == ['TA.SYN']
+        assert len(ss.subspaces['TA.SYN']) == \
+            len(synthetic_subspace.subspaces['TA.SYN'])
+
+    def test_missing_stations(self, synthetic_subspace, tmpdir):
+        path = str(tmpdir.join('subspace'))
+        synthetic_subspace.write(path, binary=True)
+        with pytest.raises(ValueError):
+            detex.persist.readBinary(path, stations=['XX', 'TA.XX'])
+
+    def test_station_subset(self, synthetic_subspace, tmpdir):
+        # add a second station, only the requested one should be loaded
+        ss = synthetic_subspace
+        ss.subspaces['UU.SYN2'] = ss.subspaces['TA.SYN'].copy()
+        ss._setStations()
+        path = str(tmpdir.join('subspace'))
+        ss.write(path, binary=True)
+        assert detex.persist.readManifest(path)['stations'] == \
+            ['TA.SYN', 'UU.SYN2']
+        ss2 = detex.persist.readBinary(path, stations='SYN2')
+        assert ss2.Stations == ['UU.SYN2']
+        assert list(ss2.subspaces) == ['UU.SYN2']
+        assert not ss2.singles
+
+
+##### Tests for the atomic replacement of the directory
+class Test_write_replace():
+    def test_stale_tmp_replaced(self, synthetic_cluster, tmpdir):
+        path = str(tmpdir.join('clust'))
+        tmp = path + '.tmp'
+        os.makedirs(tmp)  # left by an interrupted write
+        with open(os.path.join(tmp, 'junk'), 'w') as fi:
+            fi.write('junk')
+        detex.persist.writeBinary(synthetic_cluster, path)
+        assert not os.path.exists(tmp)
+        assert not os.path.exists(os.path.join(path, 'junk'))
+        assert detex.persist.isBinary(path)
+
+    def test_overwrite(self, synthetic_cluster, tmpdir):
+        path = str(tmpdir.join('clust'))
+        detex.persist.writeBinary(synthetic_cluster, path)
+        with open(os.path.join(path, 'junk'), 'w') as fi:
+            fi.write('junk')
+        detex.persist.writeBinary(synthetic_cluster, path)
+        assert not os.path.exists(os.path.join(path, 'junk'))
+        assert not os.path.exists(path + '.tmp')
+        cl = detex.persist.readBinary(path)
+        assert cl['TA.SYN'].clusts == synthetic_cluster['TA.SYN'].clusts
+
+    def test_bad_type(self, tmpdir):
+        with pytest.raises(TypeError):
+            detex.persist.writeBinary({}, str(tmpdir.join('x')))
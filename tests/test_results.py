@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+tests for results module
+"""
+import detex
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import sqlite3
+import stat
+
+
+##### Tests for association of detections
+@pytest.fixture
+def detections():
+    # an event on 3 stations (twice on A), one on 1 station, an auto on 3
+    times = [100., 100.5, 100.8, 101., 500., 1000., 1000.2, 1000.4]
+    df = pd.DataFrame({'MSTAMPmin': times, 'Sta': list('AABCAABC'),
+                       'DS': [.3, .5, .4, .6, .9, .5, .6, .7]})
+    df['MSTAMPmax'] = df.MSTAMPmin + .5
+    df['DS_STALTA'] = 2.
+    df['Mag'] = [np.nan] * 7 + [1.5]
+    df['ProEnMag'] = np.nan
+    df['Name'] = 'SS0'
+    temkey = pd.DataFrame({'NAME': ['ev1', 'ev2'], 'STAMP': [20., 1000.1]})
+    return df, temkey
+
+
+class Test_associate():
+    def test_dets_and_autos(self, detections):
+        df, temkey = detections
+        dets, autos = detex.results._associateDetections(df, 0, 3, 1., None,
+                                                         temkey, None)
+        assert len(dets) == 1 and len(autos) == 1
+        assert dets.NumStations[0] == 3  # only best detection on A kept
+        assert dets.DSmax[0] == .6 and np.isclose(dets.DSav[0], .5)
+        assert dets.Dets[0].DS.tolist() == [.5, .4, .6]
+        assert dets.Event[0] == '1970-01-01T00-01-41'
+        assert autos.Event[0] == 'ev2' and autos.Mag[0] == 1.5
+
+    def test_exceptional_threshold(self, detections):
+        df, temkey = detections
+        dets, autos = detex.results._associateDetections(df, 0, 3, 1., None,
+                                                         temkey, .85)
+        assert len(dets) == 2
+        assert dets.MSTAMPmin.tolist() == [100.5, 500.]
+
+
+##### Tests for verification of detections
+class Test_verify():
+    def test_best_unverified_detection_matched(self):
+        dets = pd.DataFrame({'Event': ['d1', 'd2', 'd3'],
+                             'DSav': [.5, .7, .4],
+                             'MSTAMPmin': [10., 10.5, 50.],
+                             'MSTAMPmax': [11., 11.5, 51.],
+                             'Verified': False})
+        autos = pd.DataFrame(columns=dets.columns)
+        ver = pd.DataFrame({'TIME': [10.8, 10.9, 30., 50.2], 'LAT': 1.,
+                            'LON': 2., 'MAG': 1., 'DEPTH': 3.,
+                            'NAME': ['v1', 'v2', 'v3', 'v4']})
+        verifs = detex.results._verifyEvents(dets, autos, ver, 1., True)
+        # v1 takes the best detection, v2 the next, v3 has none
+        assert verifs.Event.tolist() == ['d2', 'd1', 'd3']
+        assert verifs.VerName.tolist() == ['v1', 'v2', 'v4']
+        assert dets.Verified.all()
+
+
+##### Tests for loading detections and removing duplicates
+@pytest.fixture
+def detection_db(tmpdir):
+    times = [10., 10.5, 11., 50., 10.2, 80.]
+    df = pd.DataFrame({'DS': [.3, .6, .4, .5, .2, .9],
+                       'DS_STALTA': 2., 'MSTAMPmin': times,
+                       'Sta': ['TA.A'] * 4 + ['TA.B'] * 2,
+                       'Name': ['SS0', 'SS1', 'SS0', 'SS0', 'SS0', 'SS1']})
+    df['MSTAMPmax'] = df.MSTAMPmin + .5
+    df['Mag'] = np.nan
+    df['ProEnMag'] = np.nan
+    path = str(tmpdir.join('SubSpace.db'))
+    with sqlite3.connect(path) as con:
+        df.to_sql('ss_df', con, index=False)
+    return path
+
+
+class Test_delete_dets_dups():
+    def test_best_of_each_group_kept(self, detection_db):
+        df = detex.results._deleteDetDups(detection_db, 0, 0, 1., None,
+                                          None, None, 'ss_df', chunksize=2)
+        assert df.DS.tolist() == [.6, .5, .2, .9]
+        assert df.Gnum.tolist() == [1, 2, 3, 4]
+
+    def test_pf_thresholds_joined(self, detection_db):
+        pf = pd.DataFrame({'Sta': ['TA.A', 'TA.B'], 'Name': ['SS0', 'SS0'],
+                           'DS': [.35, .1]})
+        df = detex.results._deleteDetDups(detection_db, 0, 0, 1., None, None,
+                                          None, 'ss_df', PfKey=pf)
+        assert df.DS.tolist() == [.4, .5, .2]
+        with sqlite3.connect(detection_db) as con:  # nothing written
+            sql = "SELECT name FROM sqlite_master WHERE type='index'"
+            assert not con.execute(sql).fetchall()
+
+    def test_read_only(self, detection_db):
+        os.chmod(detection_db, stat.S_IREAD)
+        try:
+            pf = pd.DataFrame({'Sta': ['TA.A', 'TA.B'],
+                               'Name': ['SS0', 'SS0'], 'DS': [.35, .1]})
+            df = detex.results._deleteDetDups(detection_db, 0, 0, 1., None,
+                                              None, None, 'ss_df', PfKey=pf)
+            assert df.DS.tolist() == [.4, .5, .2]
+        finally:
+            os.chmod(detection_db, stat.S_IREAD | stat.S_IWRITE)
+
+    def test_same_with_indexes(self, detection_db):
+        df1 = detex.results._deleteDetDups(detection_db, 0, 0, 1., None,
+                                           None, None, 'ss_df')
+        with detex.util.DetectionStore(detection_db) as store:
+            store.createIndexes(['ss_df'])
+        df2 = detex.results._deleteDetDups(detection_db, 0, 0, 1., None,
+                                           None, None, 'ss_df')
+        assert df1.equals(df2)
+
+
+##### Tests for associating detections in time windows
+class Test_windowed_results():
+    def test_matches_in_memory(self, detection_db, tmpdir):
+        temkey = pd.DataFrame({'NAME': ['ev1'], 'STAMP': [80.2]})
+        args = (0, 0, 0, 1, 1., 2.5, 1., None, True, None, temkey, None,
+                None, None, None, None, None)
+        out = str(tmpdir.join('Results.db'))
+        detex.results._windowedResults(detection_db, out, 20., None, *args)
+        with sqlite3.connect(out) as con:
+            dets = pd.read_sql('SELECT * FROM Dets', con)
+            autos = pd.read_sql('SELECT * FROM Autos', con)
+            members = pd.read_sql('SELECT * FROM DetsStations', con)
+        # events at 10 (on 2 stations) and 50 are dets, 80 is an auto
+        assert dets.MSTAMPmin.tolist() == [10.2, 50.]
+        assert dets.NumStations.tolist() == [2, 1]
+        assert autos.Event.tolist() == ['ev1']
+        assert len(members) == 3 and set(members.Event) == set(dets.Event)
+
+    def test_event_on_window_edge_verified(self, detection_db, tmpdir):
+        # windows start at 10, 30, 50 and 70, v2 is in the window before
+        # the one of the event at 50
+        ver = pd.DataFrame({'TIME': [10.1, 49.9, 80.], 'LAT': 1., 'LON': 2.,
+                            'MAG': 1., 'DEPTH': 3., 'NAME': ['v1', 'v2', 'v3']})
+        temkey = pd.DataFrame({'NAME': ['ev1'], 'STAMP': [1000.]})
+        args = (0, 0, 0, 1, 1., 2.5, 1., ver, True, None, temkey, None,
+                None, None, None, None, None)
+        out = str(tmpdir.join('Results.db'))
+        detex.results._windowedResults(detection_db, out, 20., None, *args)
+        with sqlite3.connect(out) as con:
+            dets = pd.read_sql('SELECT * FROM Dets', con)
+            vers = pd.read_sql('SELECT * FROM Vers', con)
+        assert dets.Verified.tolist() == [1, 1, 1]
+        assert vers.VerName.tolist() == ['v1', 'v2', 'v3']
+        assert vers.MSTAMPmin.tolist() == [10.2, 50., 80.]
+
+
+##### Tests for reading detections from columnar directories
+class Test_columnar():
+    def test_matches_sqlite(self, detection_db, tmpdir):
+        path = detex.columnar.exportDetections(detection_db,
+                                               str(tmpdir.join('dets')))
+        manifest = detex.columnar.readManifest(path)
+        assert len(manifest['partitions']['ss_df']) == 2  # 2 stations, 1 day
+        pf = pd.DataFrame({'Sta': ['TA.A', 'TA.B'], 'Name': ['SS0', 'SS0'],
+                           'DS': [.35, .1]})
+        for kwargs in [{}, {'PfKey': pf}]:
+            df1 = detex.results._deleteDetDups(detection_db, 0, .25, 1., 5,
+                                               None, None, 'ss_df', **kwargs)
+            df2 = detex.results._deleteDetDups(path, 0, .25, 1., 5, None,
+                                               None, 'ss_df', **kwargs)
+            cols = ['Sta', 'Name', 'DS', 'MSTAMPmin', 'Gnum']
+            assert df1[cols].values.tolist() == df2[cols].values.tolist()
+
+    def test_partitions_pruned(self, detection_db, tmpdir):
+        path = detex.columnar.exportDetections(detection_db,
+                                               str(tmpdir.join('dets')))
+        df = detex.columnar.readDetections(path, 'ss_df', minDS=.7)
+        assert df.DS.tolist() == [.9]
+        assert detex.columnar.readDetections(path, 'ss_df', 'TA.A', 60.) is None
+        assert detex.columnar.getTimeRange(path) == (10., 80.)
+
+
+##### Tests for reading detections from partitioned directories
+@pytest.fixture
+def partitioned_dets(tmpdir):
+    rs = np.random.RandomState(0)
+    num = 400
+    times = np.sort(rs.rand(num)) * 3600 * 24 * 55  # two months
+    df = pd.DataFrame({'DS': rs.rand(num), 'DS_STALTA': 2.,
+                       'MSTAMPmin': times,
+                       'Sta': rs.choice(['TA.A', 'TA.B'], num),
+                       'Name': rs.choice(['SS0', 'SS1'], num)})
+    df['MSTAMPmax'] = df.MSTAMPmin + 30.
+    df['Mag'] = np.nan
+    df['ProEnMag'] = np.nan
+    flat = str(tmpdir.join('SubSpace.db'))
+    with sqlite3.connect(flat) as con:
+        df.to_sql('ss_df', con, index=False)
+    path = str(tmpdir.join('SubSpace'))
+    with detex.partitioned.PartitionedStore(path, batchSize=50) as store:
+        for num in range(0, len(df), 70):  # written in pieces
+            store.write(df.iloc[num:num + 70], 'ss_df')
+        store.createIndexes()
+    return flat, path
+
+
+class Test_partitioned():
+    def test_matches_single_database(self, partitioned_dets):
+        flat, path = partitioned_dets
+        parts = detex.partitioned.getPartitions(path, 'ss_df')
+        assert len(parts) == 4  # 2 stations, 2 months
+        for args in [(None, None, None), (86400 * 20, 86400 * 40, 'TA.B')]:
+            df1 = detex.results._deleteDetDups(flat, 0, .2, 60., *args,
+                                               tableName='ss_df')
+            df2 = detex.results._deleteDetDups(path, 0, .2, 60., *args,
+                                               tableName='ss_df')
+            cols = ['Sta', 'DS', 'MSTAMPmin', 'Gnum']
+            assert df1[cols].values.tolist() == df2[cols].values.tolist()
+
+    def test_clear_replaces_only_range(self, partitioned_dets):
+        flat, path = partitioned_dets
+        before = detex.partitioned.readTable(path, 'ss_df')
+        with detex.partitioned.PartitionedStore(path) as store:
+            store.clear(['TA.A'], 0, 86400 * 40)  # all of jan, part of feb
+        after = detex.partitioned.readTable(path, 'ss_df')
+        gone = (before.Sta == 'TA.A') & (before.MSTAMPmin <= 86400 * 40)
+        assert len(after) == (~gone).sum()
+        parts = detex.partitioned.getPartitions(path, 'ss_df')
+        assert parts.Month.tolist() == ['1970-02', '1970-01', '1970-02']
+        assert parts.Tmin[0] > 86400 * 40
+
+    def test_filter_parameters_kept_and_replaced(self, partitioned_dets):
+        flat, path = partitioned_dets
+        filt = pd.DataFrame({'FREQMIN': [1.], 'FREQMAX': [10.],
+                             'CORNERS': [2], 'ZEROPHASE': [True]})
+        with detex.partitioned.PartitionedStore(path) as store:
+            store.write(filt, 'filt_params')
+        with detex.partitioned.PartitionedStore(path) as store:
+            store.clear(['TA.A'])  # TA.B still uses the filter
+            read = detex.partitioned.readTable(path, 'filt_params')
+            assert read.FREQMAX.tolist() == [10.]
+            store.write(filt.assign(FREQMAX=8.), 'filt_params')
+        read = detex.partitioned.readTable(path, 'filt_params')
+        assert read.FREQMAX.tolist() == [8.]
+
+
+##### Tests for writing detections as new templates
+class Test_write_detections():
+    def test_template_key_columns(self, synthetic_events, tmpdir):
+        temkeyPath = os.path.join(synthetic_events, 'TemplateKey.csv')
+        temkey = detex.util.readKey(temkeyPath, 'template')
+        stakey = detex.util.readKey(os.path.join(synthetic_events,
+                                                 'StationKey.csv'), 'station')
+        fetcher = detex.getdata.quickFetch(os.path.join(synthetic_events,
+                                                        'EventWaveForms'))
+        otime = temkey.STAMP.iloc[0] + 10
+        dets = pd.DataFrame({'Event': ['det1'], 'MSTAMPmin': [otime - .5],
+                             'MSTAMPmax': [otime + .5], 'Mag': [1.2]})
+        res = detex.results.SSResults(dets, None, None, None, None, temkey,
+                                      stakey, temkeyPath, fetcher)
+        newPath = str(tmpdir.join('NewTemplateKey.csv'))
+        res.writeDetections(eventDir=str(tmpdir.join('Detections')),
+                            temkeyPath=newPath, timeBeforeOrigin=5,
+                            timeAfterOrigin=20)
+        new = pd.read_csv(newPath)
+        assert list(new.columns) == list(pd.read_csv(temkeyPath).columns)
+        assert 'STAMP' not in new.columns
+        assert list(new.NAME) == list(temkey.NAME) + ['ddet1']
+        newkey = detex.util.readKey(newPath, 'template')
+        assert np.isclose(newkey.getEvent('ddet1').STAMP, otime, atol=1e-3)
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+tests for subspace module
+"""
+import detex
+import numpy as np
+import pandas as pd
+import pickle
+import pytest
+
+
+##### Tests for ArrayDict container
+@pytest.fixture
+def array_dict():
+    dic = {'ev2': np.arange(5.), 'ev1': np.ones(5)}
+    return detex.subspace.ArrayDict.fromDict(dic)
+
+
+class Test_array_dict():
+    def test_keys_map_to_rows(self, array_dict):
+        assert array_dict.keys() == ['ev1', 'ev2']
+        assert np.all(array_dict['ev2'] == np.arange(5.))
+        mat = array_dict.matrix(['ev2', 'ev1'])
+        assert mat.shape == (2, 5)
+        assert np.all(mat[1] == 1)
+
+    def test_add_and_remove(self, array_dict):
+        array_dict['ev3'] = np.zeros(5)
+        assert len(array_dict) == 3
+        array_dict.pop('ev1')
+        assert array_dict.keys() == ['ev2', 'ev3']
+        assert array_dict.data.shape == (2, 5)
+
+    def test_unequal_length_raises(self, array_dict):
+        with pytest.raises(ValueError):
+            array_dict['ev3'] = np.zeros(3)
+
+    def test_pickle(self, array_dict):
+        ad = pickle.loads(pickle.dumps(array_dict))
+        assert ad.keys() == array_dict.keys()
+        assert np.all(ad.data == array_dict.data)
+
+
+##### Tests for randomized SVD
+class Test_randomized_svd():
+    def test_matches_full_svd(self):
+        rs = np.random.RandomState(1)
+        # 2000 samples, 60 events spanning a 5 dimensional space + noise
+        arr = np.dot(rs.randn(2000, 5), rs.randn(5, 60))
+        arr += .01 * rs.randn(2000, 60)
+        U, s = detex.subspace._randomizedSVD(arr, 5)
+        Uf, sf, Vh = np.linalg.svd(arr, full_matrices=False)
+        assert U.shape == (2000, 5)
+        assert np.allclose(s, sf[:5], rtol=1e-6)
+        # same subspace (vectors may differ in sign)
+        assert np.allclose(np.abs(np.sum(U * Uf[:, :5], axis=0)), 1)
+
+    def test_small_falls_back_to_full(self):
+        arr = np.random.RandomState(2).randn(100, 6)
+        U, s = detex.subspace._randomizedSVD(arr, 3)
+        assert np.allclose(s, np.linalg.svd(arr, compute_uv=False)[:3])
+
+
+##### Tests for low rank SVD update
+class Test_update_svd():
+    def test_matches_svd_of_full_matrix(self):
+        rs = np.random.RandomState(3)
+        arr = rs.randn(500, 8)
+        new = rs.randn(500, 3)
+        U, s, Vh = np.linalg.svd(arr, full_matrices=False)
+        U2, s2 = detex.subspace._updateSVD(U, s, new)
+        Uf, sf, Vhf = np.linalg.svd(np.hstack([arr, new]),
+                                    full_matrices=False)
+        assert np.allclose(s2, sf)
+        assert np.allclose(np.abs(np.sum(U2 * Uf, axis=0)), 1)
+
+
+##### Tests for selecting the basis vectors used
+@pytest.fixture
+def basis_row():
+    rs = np.random.RandomState(6)
+    U = np.linalg.qr(rs.randn(50, 6))[0]
+    svdDict = detex.subspace.ArrayDict(np.arange(6., 0, -1), U.T)
+    row = pd.Series({'Name': 'SS0', 'Events': list('abcdef')})
+    return row, svdDict
+
+
+class Test_used_basis():
+    def _select(self, row, svdDict, average, selectValue):
+        ss = object.__new__(detex.subspace.SubSpace)
+        frac = {'Average': np.array(average)}
+        keys = ss._getUsedBasis(0, row, svdDict, frac, 2, selectValue)
+        return keys, frac['Average']
+
+    def test_full_rank_ends_at_one(self, basis_row):
+        row, svdDict = basis_row
+        average = [0, .5, .7, .8, .9, .95, .99]
+        keys, average = self._select(row, svdDict, average, .92)
+        assert keys == [6., 5., 4., 3., 2.] and average[-1] == 1.
+
+    def test_truncated_keeps_real_energy(self, basis_row):
+        row, svdDict = basis_row
+        for key in [1., 2.]:  # only 4 of 6 possible vectors kept
+            svdDict.pop(key)
+        keys, average = self._select(row, svdDict, [0, .5, .7, .8, .85], .7)
+        assert keys == [6., 5.] and average[-1] == .85
+        keys, average = self._select(row, svdDict, [0, .5, .7, .8, .85], .9)
+        assert keys == [6., 5., 4., 3.] and average[-1] == .85
+
+
+##### Tests for pairwise correlation used in validation
+class Test_pairwise_cc():
+    def test_zero_lag_matches_corrcoef(self):
+        arr = np.random.RandomState(4).randn(6, 300)
+        ccs = detex.subspace._pairwiseCC(arr)
+        assert np.allclose(ccs, np.corrcoef(arr))
+
+    def test_lagged_finds_shifted_copy(self):
+        rs = np.random.RandomState(5)
+        sig = rs.randn(1000)
+        arr = np.array([sig[10:910], sig[16:916]])  # 3 samples, 2 channels
+        assert detex.subspace._pairwiseCC(arr)[0, 1] < .5
+        ccs = detex.subspace._pairwiseCC(arr, maxLag=4, Nc=2)
+        assert ccs[0, 1] > .95
+
+
+##### Tests for adding events to existing subspaces
+def _basis(row, num=None):
+    keys = sorted(row.SVD.keys(), reverse=True)[:num]
+    return np.transpose(detex.subspace._stackRows(row.SVD, keys))
+
+
+def _subspace_with(ss, event):
+    df = ss.subspaces['TA.SYN']
+    return [ind for ind, row in df.iterrows() if event in row.Events][0]
+
+
+class Test_add_events():
+    def _build(self, cluster_kwargs, subset_key, events, keep=False,
+               **kwargs):
+        cl = detex.createCluster(**dict(cluster_kwargs, keepWaveforms=keep,
+                                        templateKey=subset_key(events)))
+        fetcher = detex.getdata.quickFetch(cluster_kwargs['fetch_arg'])
+        ss = detex.createSubSpace(clust=cl, conDatFetcher=fetcher)
+        ss.SVD(**dict(dict(selectCriteria=3, selectValue=.5), **kwargs))
+        return cl, ss
+
+    @pytest.mark.parametrize('keep', [False, True])
+    def test_matches_fresh_svd(self, cluster_kwargs, subset_key, keep):
+        cl, ss = self._build(cluster_kwargs, subset_key,
+                             ['e%d' % x for x in range(6)], keep)
+        clu = detex.construct.updateCluster(cl, cluster_kwargs['templateKey'],
+                                            saveclust=False)
+        ss.addEvents(clu)
+        clf = detex.createCluster(**cluster_kwargs)
+        ssf = detex.createSubSpace(clust=clf, conDatFetcher=ss.cfetcher)
+        ssf.SVD(selectCriteria=3, selectValue=.5)
+        events = sorted(sorted(x) for x in ss.subspaces['TA.SYN'].Events)
+        eventsf = sorted(sorted(x) for x in ssf.subspaces['TA.SYN'].Events)
+        assert events == eventsf == [['e0', 'e2', 'e4', 'e6'],
+                                     ['e1', 'e3', 'e5', 'e7']]
+        for ind, row in ss.subspaces['TA.SYN'].iterrows():
+            # the updated basis spans the aligned waveforms like a new SVD
+            arr, _ = ss._trimGroups(ind, row, sorted(row.Events), 'TA.SYN')
+            U, s, Vh = np.linalg.svd(np.transpose(arr), full_matrices=False)
+            Uup = _basis(row)
+            assert np.allclose(U.dot(U.T), Uup.dot(Uup.T))
+            assert np.allclose(s, sorted(row.SVD.keys(), reverse=True))
+        # e0 cluster is aligned the same way by both so the bases match
+        ind, indf = _subspace_with(ss, 'e0'), _subspace_with(ssf, 'e0')
+        row, rowf = ss.subspaces['TA.SYN'].loc[ind], \
+            ssf.subspaces['TA.SYN'].loc[indf]
+        assert row.NumBasis == rowf.NumBasis
+        Uup, Uf = _basis(row, row.NumBasis), _basis(rowf, rowf.NumBasis)
+        assert np.allclose(Uup.dot(Uup.T), Uf.dot(Uf.T))
+        assert np.isclose(row.Threshold, rowf.Threshold)
+
+    def test_reuses_selection_and_only_updates_changed(self, cluster_kwargs,
+                                                       subset_key):
+        cl, ss = self._build(cluster_kwargs, subset_key,
+                             ['e%d' % x for x in range(6)])
+        assert (ss.selectCriteria, ss.selectValue) == (3, .5)
+        df = ss.subspaces['TA.SYN']
+        ind0, ind1 = _subspace_with(ss, 'e0'), _subspace_with(ss, 'e1')
+        # give the unchanged subspace a threshold that selectCriteria 3
+        # would not produce, it must be kept
+        df.Threshold[ind1] = .777
+        clu = detex.construct.updateCluster(
+            cl, subset_key(['e%d' % x for x in range(7)]), saveclust=False)
+        ss.addEvents(clu)  # would need continuous data if not criteria 3
+        df = ss.subspaces['TA.SYN']
+        assert sorted(df.Events[ind0]) == ['e0', 'e2', 'e4', 'e6']
+        assert df.Threshold[ind1] == .777
+        row = df.loc[ind0]
+        assert np.isclose(row.Threshold,
+                          row.FracEnergy['Minimum'][row.NumBasis] * .5)
+
+    def test_randomized_recalculated(self, cluster_kwargs, subset_key):
+        # a single (truncated) basis vector, the low rank update would
+        # lose the energy of the discarded ones
+        cl, ss = self._build(cluster_kwargs, subset_key,
+                             ['e%d' % x for x in range(6)],
+                             svdMethod='randomized', selectCriteria=4,
+                             selectValue=0, threshold=.5)
+        assert ss.svdMethod == 'randomized'
+        clu = detex.construct.updateCluster(cl, cluster_kwargs['templateKey'],
+                                            saveclust=False)
+        ss.addEvents(clu)
+        for ind, row in ss.subspaces['TA.SYN'].iterrows():
+            assert len(row.Events) == 4 and row.NumBasis == 1
+            arr, _ = ss._trimGroups(ind, row, sorted(row.Events), 'TA.SYN')
+            U, s, Vh = np.linalg.svd(np.transpose(arr), full_matrices=False)
+            assert len(row.SVD) == 1
+            assert np.isclose(row.SVD.keys()[0], s[0])
+            assert np.isclose(abs(np.dot(_basis(row)[:, 0], U[:, 0])), 1)
+            assert row.Threshold == .5
@@ -7,6 +7,7 @@ tests for utils
 """
 from __future__ import absolute_import, unicode_literals, division, print_function
 
+import numpy as np
 import pytest
 import detex
 import os
@@ -52,36 +53,126 @@ class Test_templateKey2Catalog:
         assert isinstance(cat, obspy.core.event.Catalog)
 
 
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+##### Tests for hash indexed key lookups
+class Test_key_lookups:
+    def test_event_lookup(self, key_Dfs):
+        temkey = key_Dfs.temkey
+        assert isinstance(temkey, detex.util.DetexKey)
+        for num, row in temkey.iterrows():
+            assert temkey.getEvent(row.NAME).TIME == row.TIME
+
+    def test_station_lookup(self, key_Dfs):
+        stakey = key_Dfs.stakey
+        row = stakey.iloc[0]
+        rows = stakey.getStation(row.NETWORK + '.' + row.STATION)
+        assert len(rows) and (rows.STATION == row.STATION).all()
+        assert not len(stakey.getStation('not.there'))
+
+    def test_phase_lookup(self, key_Dfs):
+        picks = key_Dfs.picks
+        row = picks.iloc[0]
+        rows = picks.getPhases(row.Event, row.Station)
+        expected = picks[(picks.Event == row.Event) &
+                         (picks.Station == row.Station)]
+        assert len(rows) == len(expected)
+        assert len(picks.getPhases(row.Event)) == (picks.Event == row.Event).sum()
+
+    def test_origin_times(self, key_Dfs):
+        temkey = key_Dfs.temkey
+        stamps, names = temkey.getOriginTimes()
+        assert np.all(np.diff(stamps) >= 0)
+        assert temkey.getEvent(names[0]).STAMP == stamps[0]
+        assert temkey.getOriginTimes()[0] is stamps  # cached
+
+    def test_lookup_after_inplace_sort(self):
+        # the id of a replaced index is often reused by a later one
+        rs = np.random.RandomState(0)
+        names = list('abcdefgh')
+        for num in range(100):
+            key = detex.util.DetexKey({'NAME': names, 'TIME': rs.rand(8)})
+            for col in ['TIME', 'NAME', 'TIME', 'NAME']:
+                key.getEvent('a')  # build the index
+                key.sort_values(col, inplace=True)
+                key.reset_index(drop=True, inplace=True)
+            for name in names:
+                assert key.getEvent(name).NAME == name
+
+
+##### Tests for key parsing
+class Test_read_key:
+    def test_time_stamps(self, key_Dfs):
+        temkey, stakey = key_Dfs.temkey, key_Dfs.stakey
+        for key, col, stampCol in [(temkey, 'TIME', 'STAMP'),
+                                   (stakey, 'STARTTIME', 'STARTSTAMP')]:
+            utcs = [obspy.UTCDateTime(x).timestamp for x in key[col]]
+            assert all(abs(key[stampCol] - utcs) < 1e-5)
+
+    def test_cached_by_mtime(self, key_files):
+        key1 = detex.util.readKey(key_files.temkey, 'template')
+        key2 = detex.util.readKey(key_files.temkey, 'template')
+        assert key1 is not key2  # copies are returned
+        assert key1.equals(key2)
+        key3 = detex.util.readKey(key1, 'template')
+        assert key3 is not key1 and key3.equals(key1)
+        assert isinstance(key3, detex.util.DetexKey)
+        assert key3.keyType == 'template'
+        key3.loc[key3.index[0], 'MAG'] = -9  # does not change key1
+        assert (key1.MAG != -9).all()
+
+
+##### Tests for detection database writer
+class Test_detection_store:
+    def _dets(self, sta, num):
+        import pandas as pd
+        cols = ['DS', 'Name', 'Sta', 'MSTAMPmin']
+        df = pd.DataFrame(columns=cols)  # object columns, as in detect
+        for ind in range(num):
+            df.loc[ind] = [.5, 'ss0', sta, float(ind)]
+        return df
+
+    def test_typed_batched_writes(self, tmpdir):
+        from sqlite3 import connect
+        path = str(tmpdir.join('SubSpace.db'))
+        store1 = detex.util.DetectionStore(path, batchSize=3)
+        store2 = detex.util.DetectionStore(path, batchSize=3)
+        store1.write(self._dets('TA.M17A', 2), 'ss_df')
+        assert not len(detex.util.loadSQLite(path, 'ss_df'))  # buffered
+        store2.write(self._dets('TA.M18A', 4), 'ss_df')  # another writer
+        store1.write(self._dets('TA.M17A', 2), 'ss_df')
+        store2.createIndexes(['ss_df', 'sg_df'])
+        store1.close()
+        store2.close()
+        with connect(path) as con:
+            mode = con.execute('PRAGMA journal_mode').fetchone()[0]
+            types = [x[2] for x in con.execute('PRAGMA table_info(ss_df)')]
+            indexes = con.execute("SELECT name FROM sqlite_master WHERE "
+                                  "type='index'").fetchall()
+        assert mode == 'wal'
+        assert types == ['REAL', 'TEXT', 'TEXT', 'REAL']
+        assert len(indexes) == len(detex.util.detection_indexes)
+        df = detex.util.loadSQLite(path, 'ss_df')
+        assert len(df) == 8
+        assert (df.Sta == 'TA.M18A').sum() == 4
+
+
+##### Tests for typed sqlite reads
+class Test_table_schemas:
+    def test_declared_types_written_and_read(self, tmpdir):
+        import pandas as pd
+        from sqlite3 import connect
+        path = str(tmpdir.join('SubSpace.db'))
+        filt = pd.DataFrame([[1., 10., 2, True]],
+                            columns=['FREQMIN', 'FREQMAX', 'CORNERS',
+                                     'ZEROPHASE'])
+        detex.util.saveSQLite(filt, path, 'filt_params')
+        with connect(path) as con:
+            types = [x[2] for x in con.execute('PRAGMA table_info(filt_params)')]
+            # tables written by older versions hold text
+            con.execute('CREATE TABLE sg_info (Name, Sta, Threshold)')
+            con.execute("INSERT INTO sg_info VALUES ('1', 'TA.A', '0.5')")
+        assert types == ['REAL', 'REAL', 'INTEGER', 'INTEGER']
+        df = detex.util.loadSQLite(path, 'filt_params')
+        assert df.CORNERS.dtype.kind == 'i' and df.ZEROPHASE.dtype == bool
+        info = detex.util.loadSQLite(path, 'sg_info')
+        assert info.Name[0] == '1'  # declared str, not converted
+        assert info.Threshold.dtype.kind == 'f'